@@ -1,13 +1,28 @@
 import base64
+from collections import OrderedDict
+import copy
 import errno
-from itertools import islice
+from fnmatch import fnmatch
+from functools import partial, wraps
+import hashlib
+import inspect
+from itertools import chain, islice
+import json
+import math
 import os
+import re
 import sys
+import threading
+import time
 import uuid
+import zlib
 
-from google.cloud.exceptions import NotFound, Forbidden, BadRequest
-from google.cloud.storage import Client as GSClient, Blob
+from google.api_core.exceptions import from_http_status
+from google.cloud.exceptions import NotFound, Forbidden, BadRequest, \
+    GoogleCloudError, PreconditionFailed
 import nbformat
+from nbformat.notebooknode import NotebookNode
+from nbformat.v4.rwbase import split_lines, strip_transient
 from notebook.services.contents.checkpoints import Checkpoints, \
     GenericCheckpointsMixin
 try:
@@ -15,10 +30,26 @@ try:
     # https://github.com/jupyter/notebook/issues/3056
 except ImportError:
     pass
-from notebook.services.contents.manager import ContentsManager
+from notebook.services.contents.manager import ContentsManager, copy_pat
 from tornado import web
 from tornado.escape import url_unescape
-from traitlets import Any, Bool, Int, Unicode, default
+from traitlets import Any, Bool, Float, Int, List, Unicode, default
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from jgscm.admission import MemoryBudget, json_size, unreserved
+from jgscm.bulk import ACTIONS as BULK_ACTIONS, BulkItem, group_by_parent, \
+    is_checkpoint, plan_paths
+from jgscm.diskcache import BlobCache
+from jgscm.hedge import Hedger
+from jgscm.index import PrefixIndex
+from jgscm.integrity import checksum_type
+from jgscm.prefetch import Prefetcher
+from jgscm.search import NameIndex, NameMatcher, SearchPage
+from jgscm.trace import ContextExecutor, Tracer
+from jgscm.usage import EMPTY as EMPTY_ROLLUP, Rollup, UsageCache
 
 
 if sys.version_info[0] == 2:
@@ -30,6 +61,52 @@ else:
     unicode = str
 
 
+def _is_blob(obj):
+    """
+    isinstance(obj, Blob) which does not import google.cloud.storage: it
+    takes long and is imported when the client is created.
+    """
+    blob = sys.modules.get("google.cloud.storage.blob")
+    return blob is not None and isinstance(obj, blob.Blob)
+
+
+def _is_corrupted(error):
+    """
+    isinstance(error, DataCorruption) which does not import
+    google.cloud.storage, see :func:`_is_blob`. google-cloud-storage < 3.0
+    raises the exception of google-resumable-media, 3.0 subclasses it in
+    google.cloud.storage.exceptions.
+    """
+    for name in ("google.cloud.storage.exceptions",
+                 "google.resumable_media.common"):
+        module = sys.modules.get(name)
+        if module is not None and isinstance(error, module.DataCorruption):
+            return True
+    return False
+
+
+def _has_exponent_floats(obj):
+    """
+    Checks if json and orjson would write some float in the object
+    differently: orjson writes 1e-05 as 0.00001, 1e+100 as 1e100 and NaN as
+    null. The floats which json writes without an exponent are the same.
+    :param obj: JSON compatible object.
+    :return: True if a float in it is written with an exponent or is not \
+             finite.
+    """
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            stack.extend(obj)
+        elif isinstance(obj, float) and (
+                not math.isfinite(obj) or "e" in repr(obj)):
+            return True
+    return False
+
+
 class GoogleStorageCheckpoints(GenericCheckpointsMixin, Checkpoints):
     checkpoint_dir = Unicode(
         ".ipynb_checkpoints",
@@ -76,6 +153,24 @@ class GoogleStorageCheckpoints(GenericCheckpointsMixin, Checkpoints):
             "last_modified": blob.updated,
         }
 
+    def copy_to_checkpoint(self, blob, path):
+        """Create a checkpoint which is a copy of the uploaded file, without
+        reading it back.
+
+        Returns a checkpoint model for the new checkpoint.
+        """
+        checkpoint_id = str(uuid.uuid4())
+        cp = self._get_checkpoint_path(checkpoint_id, path)
+        self.log.debug("copying checkpoint %s for %s as %s",
+                       checkpoint_id, path, cp)
+        bucket_name, bucket_path = self.parent._parse_path(cp)
+        bucket = self.parent._get_bucket(bucket_name, throw=True)
+        blob = self.parent._copy_blob(blob, bucket, bucket_path)
+        return {
+            "id": checkpoint_id,
+            "last_modified": blob.updated,
+        }
+
     def get_file_checkpoint(self, checkpoint_id, path):
         """Get the content of a checkpoint for a non-notebook file.
 
@@ -131,23 +226,63 @@ class GoogleStorageCheckpoints(GenericCheckpointsMixin, Checkpoints):
         cp = self._get_checkpoint_path(checkpoint_id, path)
         self.parent.delete_file(cp)
 
+    def rename_all_checkpoints(self, old_path, new_path):
+        """Rename all checkpoints for old_path to new_path."""
+        bucket, blobs = self._list_checkpoint_blobs(old_path)
+        for blob in blobs:
+            new_cp = self._get_checkpoint_path(
+                self._get_checkpoint_id(blob), new_path)
+            new_bucket_name, new_bucket_path = self.parent._parse_path(new_cp)
+            new_bucket = self.parent._get_bucket(new_bucket_name, throw=True)
+            # takes the stored outputs along to other buckets
+            self.parent._copy_blob(blob, new_bucket, new_bucket_path)
+            self.parent._forget_blobs(new_bucket_name, new_bucket_path)
+        if blobs:
+            self.parent._delete_blobs(bucket, (blob.name for blob in blobs))
+
+    def delete_all_checkpoints(self, path):
+        """Delete all checkpoints for the given path."""
+        bucket, blobs = self._list_checkpoint_blobs(path)
+        if blobs:
+            self.parent._delete_blobs(bucket, (blob.name for blob in blobs))
+            self.parent._delete_blobs(
+                bucket, sorted(self.parent._segment_names(blobs)))
+            if any(self.parent._has_stored_outputs(blob) for blob in blobs):
+                self.parent._schedule_output_gc(bucket.name)
+
     def list_checkpoints(self, path):
         """Return a list of checkpoints for a given file"""
+        _, blobs = self._list_checkpoint_blobs(path)
+        checkpoints = [{
+            "id": self._get_checkpoint_id(blob),
+            "last_modified": blob.updated,
+        } for blob in blobs]
+        checkpoints.sort(key=lambda c: c["last_modified"], reverse=True)
+        self.log.debug("list_checkpoints: %s: %s", path, checkpoints)
+        return checkpoints
+
+    def _list_checkpoint_blobs(self, path):
+        """
+        Lists the checkpoints of the file.
+        :param path: file path.
+        :return: tuple(:class:`google.cloud.storage.Bucket` instance or \
+                 None, list of :class:`google.cloud.storage.Blob`).
+        """
         cp = self._get_checkpoint_path(None, path)
         bucket_name, bucket_path = self.parent._parse_path(cp)
         try:
             bucket = self.parent._get_bucket(bucket_name)
+            if bucket is None:
+                return None, []
             it = bucket.list_blobs(prefix=bucket_path, delimiter="/",
                                    max_results=self.parent.max_list_size)
-            checkpoints = [{
-                "id": os.path.splitext(file.path)[0][-36:],
-                "last_modified": file.updated,
-            } for file in islice(it, self.parent.max_list_size)]
+            return bucket, list(islice(it, self.parent.max_list_size))
         except NotFound:
-            return []
-        checkpoints.sort(key=lambda c: c["last_modified"], reverse=True)
-        self.log.debug("list_checkpoints: %s: %s", path, checkpoints)
-        return checkpoints
+            return None, []
+
+    @staticmethod
+    def _get_checkpoint_id(blob):
+        return os.path.splitext(blob.name)[0][-36:]
 
     def _get_checkpoint_path(self, checkpoint_id, path):
         if path.startswith("/"):
@@ -185,6 +320,178 @@ class GoogleStorageContentManager(ContentsManager):
     hide_dotted_blobs = Bool(True, config=True,
                              help="Consider blobs which names start with dot "
                                   "as hidden.")
+    fast_notebook_json = Bool(True, config=True,
+                              help="Parse and serialize notebooks with orjson "
+                                   "if it is installed.")
+    notebook_check_cache_size = Int(
+        1024, config=True,
+        help="The number of distinct notebook contents for which to remember "
+             "the validation result and the signature. 0 disables caching.")
+    output_blob_threshold = Int(
+        0, config=True,
+        help="Store the notebook outputs bigger than this number of bytes in "
+             "separate content-addressed blobs, so that saving a notebook "
+             "does not upload them again. 0 disables.")
+    output_blob_prefix = Unicode(
+        ".ipynb_outputs/", config=True,
+        help="The folder in the root of the bucket where to store the "
+             "outputs moved out of notebooks.")
+    output_gc_delay = Float(
+        3600.0, config=True,
+        help="Number of seconds after a notebook with stored outputs is "
+             "saved or deleted to delete the output blobs which no notebook "
+             "in the bucket refers to anymore. The sweep lists the whole "
+             "bucket and runs at most once per delay. Negative disables.")
+    output_gc_min_age = Float(
+        3600.0, config=True,
+        help="Number of seconds for which the output blobs are kept even if "
+             "no notebook refers to them, e.g. while a notebook which uses "
+             "them is being saved by another server.")
+    segmented_save_threshold = Int(
+        0, config=True,
+        help="Save the notebooks bigger than this number of bytes as "
+             "segments composed by GCS, so that only the changed segments "
+             "are uploaded. 0 disables.")
+    segment_size = Int(
+        64 << 10, config=True,
+        help="Minimum size of a notebook segment in bytes. It is doubled "
+             "for the notebooks which would have too many segments.")
+    segment_prefix = Unicode(
+        ".ipynb_segments/", config=True,
+        help="The folder in the root of the bucket where to store the "
+             "segments of the notebooks.")
+    write_behind_dir = Unicode(
+        "", config=True,
+        help="Local directory where to journal the saved files before they "
+             "are uploaded to GCS in the background. Saves return once the "
+             "file is on the local disk. Empty disables.")
+    write_behind_delay = Float(
+        2.0, config=True,
+        help="Number of seconds to wait for the next saves of a file before "
+             "uploading the latest version.")
+    disk_cache_dir = Unicode(
+        "", config=True,
+        help="Local directory where to cache the contents of the read and "
+             "written blobs. Several servers on the same host may share it. "
+             "Empty disables.")
+    disk_cache_size = Int(
+        1 << 30, config=True,
+        help="Maximum size of the local blob cache in bytes. The least "
+             "recently used blobs are deleted first.")
+    prefetch_max_size = Int(
+        0, config=True,
+        help="Download the files not bigger than this number of bytes in the "
+             "background after listing their directory. 0 disables.")
+    prefetch_max_files = Int(
+        8, config=True,
+        help="Maximum number of files to prefetch per directory listing.")
+    prefetch_ttl = Float(
+        30.0, config=True,
+        help="Number of seconds to serve the prefetched files without "
+             "checking GCS.")
+    warm_up = Bool(
+        False, config=True,
+        help="Resolve the credentials, connect to GCS and fetch the default "
+             "path in the background when the server starts, so that the "
+             "first request does not wait for it.")
+    hedge_reads = Bool(
+        False, config=True,
+        help="Repeat the bucket and blob lookups, the listings and the small "
+             "downloads which take longer than usual and use the first "
+             "answer.")
+    hedge_percentile = Float(
+        95.0, config=True,
+        help="Hedge the requests which take longer than this percentile of "
+             "the latencies of the recent requests of the same kind.")
+    hedge_min_delay = Float(
+        0.05, config=True,
+        help="Minimum number of seconds to wait before hedging a request.")
+    hedge_max_rate = Float(
+        0.1, config=True,
+        help="Maximum fraction of the requests of each kind to hedge.")
+    hedge_max_size = Int(
+        1 << 20, config=True,
+        help="Hedge the downloads not bigger than this number of bytes.")
+    index_ttl = Float(
+        0.0, config=True,
+        help="Number of seconds to answer the directory listings from the "
+             "index without asking GCS. Older listings are refreshed by "
+             "listing only the names and generations and fetching the "
+             "changed files. 0 disables the index.")
+    index_dir = Unicode(
+        "", config=True,
+        help="Local directory to persist the index of the directory "
+             "listings in. Empty keeps the index in memory.")
+    search_max_results = Int(
+        100, config=True,
+        help="Maximum number of files a search returns.")
+    search_max_scan = Int(
+        10000, config=True,
+        help="Maximum number of objects a search lists. The results beyond "
+             "are marked incomplete.")
+    search_index_ttl = Float(
+        0.0, config=True,
+        help="Number of seconds to keep all the names under a searched "
+             "directory to answer the next searches in it without listing. "
+             "The searches list all the objects instead of only the "
+             "matching ones to fill it. 0 disables.")
+    usage_cache_ttl = Float(
+        300.0, config=True,
+        help="Number of seconds to cache the storage usage of the "
+             "directories. The writes through this server drop the affected "
+             "rollups.")
+    checksum = Unicode(
+        "auto", config=True,
+        help="Checksum which verifies the transferred bytes: \"crc32c\", "
+             "\"md5\", \"auto\" - crc32c with the C extension of "
+             "google-crc32c, md5 otherwise - or \"\" to disable. The "
+             "uploads send it and GCS rejects the corrupted ones; the "
+             "downloads are checked as the bytes arrive.")
+    transfer_memory_limit = Int(
+        0, config=True,
+        help="Maximum estimated memory in bytes of the files which are read "
+             "or saved at the same time. The transfers over the limit wait; "
+             "a transfer which alone exceeds it fails with 413. 0 disables.")
+    transfer_memory_timeout = Float(
+        30.0, config=True,
+        help="Number of seconds a transfer waits for memory before it fails "
+             "with 503.")
+    root_cache_ttl = Float(
+        60.0, config=True,
+        help="Number of seconds to cache the list of buckets shown at the "
+             "root level and the failed bucket lookups. 0 disables caching.")
+    root_buckets = List(
+        Unicode(), config=True,
+        help="The buckets to show at the root level instead of listing all "
+             "the buckets in the project.")
+    root_bucket_patterns = List(
+        Unicode(), config=True,
+        help="fnmatch() patterns of the bucket names to show at the root "
+             "level. If empty, all the buckets are shown.")
+    max_range_size = Int(
+        16 << 20, config=True,
+        help="Maximum number of bytes returned by a single partial read.")
+    range_chunk_size = Int(
+        256 << 10, config=True,
+        help="Number of bytes downloaded at once while reading lines.")
+    stream_chunk_size = Int(
+        4 << 20, config=True,
+        help="Number of bytes downloaded at once while streaming a file.")
+    batch_size = Int(
+        100, config=True,
+        help="Maximum number of requests sent in one GCS batch request. "
+             "GCS does not allow more than 100.")
+    io_threads = Int(16, config=True,
+                     help="Maximum number of parallel GCS requests.")
+    slow_request_threshold = Float(
+        2.0, config=True,
+        help="Log the contents requests which take longer than this number "
+             "of seconds as one JSON line with all their GCS calls. The "
+             "totals by request type are kept in tracer.summary(). "
+             "A negative value disables the tracing.")
+    bulk_max_paths = Int(
+        1000, config=True,
+        help="Maximum number of paths in one bulk operation.")
     # redefine untitled_directory to change the default value
     untitled_directory = Unicode(
         "untitled-folder", config=True,
@@ -212,9 +519,44 @@ class GoogleStorageContentManager(ContentsManager):
     def __init__(self, *args, **kwargs):
         # Stub for the GSClient instance (set lazily by the client property).
         self._client = None
+        self._client_lock = threading.Lock()
+        # Validation results and signatures by notebook content digest.
+        self._notebook_checks = OrderedDict()
+        self._notebook_checks_lock = threading.Lock()
+        # tuple(expiration time, list of (bucket name, writable)).
+        self._root_cache = None
+        # bucket name -> tuple(expiration time, forbidden).
+        self._inaccessible_buckets = {}
+        self._io_pool = None
+        self._request_scope = threading.local()
+        # tuple(bucket name, digest) of the output blobs known to exist.
+        self._stored_outputs = set()
+        # tuple(bucket name, digest) -> time when a save last used the
+        # output blob; the sweeps keep the recently used ones.
+        self._output_leases = {}
+        # tuple(bucket name, digest) of the output blobs which a sweep is
+        # deleting; the saves which use them wait and upload them again.
+        self._deleting_outputs = set()
+        self._stored_outputs_cond = threading.Condition(threading.Lock())
+        # bucket name -> threading.Timer of the scheduled output sweep.
+        self._output_sweeps = {}
+        self._write_journal = None
+        self._write_journal_lock = threading.Lock()
+        self._disk_cache = None
+        self._prefetcher = None
+        self._hedger = None
+        self._memory_budget = None
+        self._search_index = None
+        self._prefix_index = None
+        self._usage_cache = None
+        self._tracer = None
+        self._tracer_lock = threading.Lock()
         super(GoogleStorageContentManager, self).__init__(*args, **kwargs)
+        if self.warm_up:
+            self.start_warm_up()
 
     def debug_args(fn):
+        @wraps(fn)
         def wrapped_fn(self, *args, **kwargs):
             self.log.debug("call %s(%s%s%s)", fn.__name__,
                            ", ".join(repr(a) for a in args),
@@ -226,6 +568,88 @@ class GoogleStorageContentManager(ContentsManager):
 
         return wrapped_fn
 
+    def request_scoped(fn):
+        """
+        Memoizes the GCS lookups during the outermost call of the decorated
+        method, so that the nested calls do not repeat them. The memo is
+        discarded when the call returns.
+        """
+        @wraps(fn)
+        def wrapped_fn(self, *args, **kwargs):
+            scope = self._request_scope
+            if getattr(scope, "memo", None) is not None:
+                return fn(self, *args, **kwargs)
+            scope.memo = {}
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                scope.memo = None
+
+        return wrapped_fn
+
+    def traced(fn):
+        """
+        Records the GCS calls made during the outermost call of the decorated
+        method, see :class:`jgscm.trace.Tracer`.
+        """
+        names = list(inspect.signature(fn).parameters)[1:]
+        position = next((i for i, name in enumerate(names)
+                         if name in ("path", "from_path", "old_path")), None)
+
+        @wraps(fn)
+        def wrapped_fn(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer is None:
+                return fn(self, *args, **kwargs)
+            path = ""
+            if position is not None:
+                path = args[position] if len(args) > position \
+                    else kwargs.get(names[position], "")
+                if _is_blob(path):
+                    path = self._get_blob_path(path)
+            return tracer.run(fn.__name__, path, fn, (self,) + args, kwargs)
+
+        return wrapped_fn
+
+    new_untitled = traced(request_scoped(ContentsManager.new_untitled))
+    new = traced(request_scoped(ContentsManager.new))
+    delete = traced(request_scoped(ContentsManager.delete))
+    rename = traced(request_scoped(ContentsManager.rename))
+    update = traced(request_scoped(ContentsManager.update))
+    create_checkpoint = traced(request_scoped(
+        ContentsManager.create_checkpoint))
+    list_checkpoints = traced(request_scoped(ContentsManager.list_checkpoints))
+    restore_checkpoint = traced(request_scoped(
+        ContentsManager.restore_checkpoint))
+    delete_checkpoint = traced(request_scoped(
+        ContentsManager.delete_checkpoint))
+
+    @traced
+    @request_scoped
+    @debug_args
+    def copy(self, from_path, to_path=None):
+        """
+        Copies the file like :meth:`ContentsManager.copy`, but drops the
+        generation of the source: the copy is a new file and the save must
+        not compare it with the generation of the destination.
+        """
+        path = from_path.strip("/")
+        from_dir, from_name = path.rsplit("/", 1) if "/" in path \
+            else ("", path)
+        model = self.get(path)
+        for key in ("path", "name", "generation"):
+            model.pop(key, None)
+        if model["type"] == "directory":
+            raise web.HTTPError(400, u"Can't copy directories")
+        to_path = from_dir if to_path is None else to_path.strip("/")
+        if self.dir_exists(to_path):
+            name = copy_pat.sub(".", from_name)
+            to_name = self.increment_filename(name, to_path, insert="-Copy")
+            to_path = u"%s/%s" % (to_path, to_name)
+        return self.save(model, to_path)
+
+    @traced
+    @request_scoped
     @debug_args
     def is_hidden(self, path):
         if path == "":
@@ -233,17 +657,13 @@ class GoogleStorageContentManager(ContentsManager):
         if path.startswith("/"):
             path = path[1:]
         bucket_name, bucket_path = self._parse_path(path)
-        try:
-            bucket = self._get_bucket(bucket_name)
-        except Forbidden:
-            return True
-        if bucket is None:
-            return True
         if self.hide_dotted_blobs and \
                 self._get_blob_name(bucket_path).startswith("."):
             return True
-        return False
+        return not self._probe_bucket(bucket_name)
 
+    @traced
+    @request_scoped
     @debug_args
     def file_exists(self, path=""):
         if path == "" or path.endswith("/"):
@@ -256,10 +676,12 @@ class GoogleStorageContentManager(ContentsManager):
         bucket = self._get_bucket(bucket_name)
         if bucket is None or bucket_path == "":
             return False
-        blob = bucket.blob(bucket_path)
-        return blob.exists() and not (
+        blob = self._lookup_blob(bucket, bucket_path)
+        return blob is not None and not (
             blob.name.endswith("/") and blob.size == 0)
 
+    @traced
+    @request_scoped
     @debug_args
     def dir_exists(self, path):
         if path.startswith("/"):
@@ -277,13 +699,35 @@ class GoogleStorageContentManager(ContentsManager):
         if not blob_prefix_name:
             return True
         # Check that some blobs exist with the prefix as a path.
-        if list(bucket.list_blobs(prefix=blob_prefix_name, max_results=1)):
-            return True
-        return False
-
+        memo = self._request_memo()
+        key = ("dir", bucket_name, blob_prefix_name)
+        if memo is not None and key in memo:
+            return memo[key]
+        journal = self.write_journal
+        exists = bool(journal is not None and journal.pending(
+            "%s/%s" % (bucket_name, blob_prefix_name)) or list(
+            bucket.list_blobs(prefix=blob_prefix_name, max_results=1)))
+        if memo is not None:
+            memo[key] = exists
+        return exists
+
+    @traced
+    @request_scoped
     @debug_args
-    def get(self, path, content=True, type=None, format=None):
-        if isinstance(path, Blob):
+    def get(self, path, content=True, type=None, format=None, start=None,
+            end=None, lines=None):
+        """
+        Gets the model of a file or directory. Besides the standard
+        arguments, accepts the range of a file to read:
+        :param start: byte offset to read from, counted from the end of the \
+                      file if negative.
+        :param end: byte offset to read up to (exclusive).
+        :param lines: maximum number of lines to read.
+        The partial model has the "range" key with "start", "end" and the \
+        total "size" of the file; the next page starts at "end".
+        """
+        partial = start is not None or end is not None or lines is not None
+        if _is_blob(path):
             obj = path
             path = self._get_blob_path(obj)
         elif path.startswith("/"):
@@ -292,6 +736,8 @@ class GoogleStorageContentManager(ContentsManager):
             path = self.default_path
 
         type = self._resolve_storagetype(path, type)
+        if partial and type != "file":
+            raise web.HTTPError(400, u"Only files can be read partially")
         if type == "directory":
             if path and not path.endswith("/"):
                 path += "/"
@@ -303,12 +749,24 @@ class GoogleStorageContentManager(ContentsManager):
             exists, blob = self._fetch(path)
             if not exists:
                 raise web.HTTPError(404, u"No such file: %s" % path)
-            if type == "notebook" or (type is None and path.endswith(".ipynb")):
-                model = self._notebook_model(blob, content=content)
-            else:
-                model = self._file_model(blob, content=content, format=format)
+            size = (blob.size or 0) if content else 0
+            if partial:
+                size = min(size, self.max_range_size)
+            with self._reserve_memory(size * self.TRANSFER_COPIES, path):
+                if type == "notebook" or \
+                        (type is None and path.endswith(".ipynb")):
+                    model = self._notebook_model(blob, content=content)
+                elif partial:
+                    model = self._file_model(
+                        blob, content=content, format=format,
+                        part=(start, end, lines))
+                else:
+                    model = self._file_model(blob, content=content,
+                                             format=format)
         return model
 
+    @traced
+    @request_scoped
     @debug_args
     def save(self, model, path):
         if path.startswith("/"):
@@ -326,21 +784,69 @@ class GoogleStorageContentManager(ContentsManager):
         if bucket_path != "" and model["type"] == "directory" and \
                 bucket_path[-1] != "/":
             path += "/"
+        # the generation the client read, the write fails if it changed
+        generation = model.get("generation")
+        if generation is not None:
+            try:
+                generation = int(generation)
+            except (TypeError, ValueError):
+                raise web.HTTPError(
+                    400, u"Invalid generation: %r" % generation)
         self.log.debug("Saving %s", path)
 
         self.run_pre_save_hook(model=model, path=path)
 
+        journal = self.write_journal if model["type"] != "directory" \
+            else None
+        if journal is not None and generation is not None:
+            # the conflict must be reported now, the journaled versions of
+            # other clients are uploaded first to be compared with
+            self._flush_pending_writes(path)
+            journal = None
         try:
+            if journal is not None:
+                # fail early instead of in the background
+                self._get_bucket(bucket_name, throw=True)
             if model["type"] == "notebook":
                 nb = nbformat.from_dict(model["content"])
-                self.check_and_sign(nb, path)
-                self._save_notebook(path, nb)
-                # One checkpoint should always exist for notebooks.
-                if not self.checkpoints.list_checkpoints(path):
+                # the serialized notebook and the upload buffer, estimated
+                # before serializing
+                with self._reserve_memory(json_size(nb) * 2, path):
+                    if journal is None:
+                        data = self._writes_notebook(
+                            self._store_outputs(path, nb))
+                    else:
+                        # the outputs are stored separately when uploading
+                        data = self._writes_notebook(nb)
+                    digest = hashlib.sha256(data).hexdigest()
+                    self._check_and_sign(nb, path, digest)
+                    if journal is not None:
+                        journal.put("%s/%s" % (bucket_name, bucket_path),
+                                    "notebook", data)
+                        self._forget_blobs(bucket_name, bucket_path)
+                    else:
+                        self._save_notebook(path, nb, data,
+                                            generation=generation)
+                # One checkpoint should always exist for notebooks. It reads
+                # the notebook back with a reservation of its own.
+                if journal is None and \
+                        not self.checkpoints.list_checkpoints(path):
                     self.create_checkpoint(path)
             elif model["type"] == "file":
-                # Missing format will be handled internally by _save_file.
-                self._save_file(path, model["content"], model.get("format"))
+                content = model["content"]
+                # the content string and the encoded bytes
+                with self._reserve_memory(
+                        len(content) * 2 if isinstance(content, unicode)
+                        else 0, path):
+                    # Missing format will be handled internally by _save_file.
+                    if journal is not None:
+                        journal.put("%s/%s" % (bucket_name, bucket_path),
+                                    "file", self._encode_file(
+                                        path, content, model.get("format")))
+                        self._forget_blobs(bucket_name, bucket_path)
+                    else:
+                        self._save_file(path, content, model.get("format"),
+                                        generation=generation)
             elif model["type"] == "directory":
                 self._save_directory(path, model)
             else:
@@ -348,6 +854,10 @@ class GoogleStorageContentManager(ContentsManager):
                     00, u"Unhandled contents type: %s" % model["type"])
         except web.HTTPError:
             raise
+        except PreconditionFailed:
+            raise web.HTTPError(
+                409, u"%s was changed after generation %d was read" % (
+                    path, generation))
         except Exception as e:
             self.log.error(u"Error while saving file: %s %s", path, e,
                            exc_info=True)
@@ -356,7 +866,7 @@ class GoogleStorageContentManager(ContentsManager):
 
         validation_message = None
         if model["type"] == "notebook":
-            self.validate_notebook_model(model)
+            self._validate_notebook_model(model, digest)
             validation_message = model.get("message", None)
 
         model = self.get(path, content=False)
@@ -367,77 +877,544 @@ class GoogleStorageContentManager(ContentsManager):
 
         return model
 
+    @traced
+    @request_scoped
     @debug_args
     def delete_file(self, path):
         if path.startswith("/"):
             path = path[1:]
+        self._flush_pending_writes(path)
         bucket_name, bucket_path = self._parse_path(path)
         bucket = self._get_bucket(bucket_name, throw=True)
         if bucket_path == "":
             bucket.delete()
             del self._bucket_cache[bucket_name]
+            self._root_cache = None
+            self._inaccessible_buckets.pop(bucket_name, None)
             return
-        it = bucket.list_blobs(prefix=bucket_path, delimiter="/",
-                               max_results=self.max_list_size)
-        files = list(islice(it, self.max_list_size))
-        folders = it.prefixes
-        bucket.delete_blobs(files)
-        for folder in folders:
-            self.delete_file(bucket_name + "/" + folder)
-
+        self._forget_blobs(bucket_name, bucket_path)
+        # a flat listing includes the blobs of all the nested folders
+        it = bucket.list_blobs(prefix=bucket_path,
+                               fields="items(name,metadata),nextPageToken")
+        outputs = []
+        segments = set()
+
+        def names():
+            for blob in it:
+                if self._has_stored_outputs(blob):
+                    outputs.append(blob.name)
+                segments.update(self._segment_names((blob,)))
+                yield blob.name
+
+        self._delete_blobs(bucket, names())
+        # the copies which shared the segments upload them again when saved
+        self._delete_blobs(bucket, sorted(segments))
+        if outputs:
+            self._schedule_output_gc(bucket_name)
+
+    @traced
+    @request_scoped
     @debug_args
     def rename_file(self, old_path, new_path):
         if old_path.startswith("/"):
             old_path = old_path[1:]
         if new_path.startswith("/"):
             new_path = new_path[1:]
+        self._flush_pending_writes(old_path)
+        self._flush_pending_writes(new_path)
         old_bucket_name, old_bucket_path = self._parse_path(old_path)
         old_bucket = self._get_bucket(old_bucket_name, throw=True)
         new_bucket_name, new_bucket_path = self._parse_path(new_path)
         new_bucket = self._get_bucket(new_bucket_name, throw=True)
-        old_blob = old_bucket.get_blob(old_bucket_path)
-        if old_bucket_name == new_bucket_name:
-            if old_blob is not None:
-                old_bucket.rename_blob(old_blob, new_bucket_path)
-                return
-            if not old_bucket_path.endswith("/"):
-                old_bucket_path += "/"
-            if not new_bucket_path.endswith("/"):
-                new_bucket_path += "/"
-            it = old_bucket.list_blobs(prefix=old_bucket_path, delimiter="/",
-                                       max_results=self.max_list_size)
-            old_blobs = list(islice(it, self.max_list_size))
-            folders = it.prefixes
-            for ob in old_blobs:
-                old_bucket.rename_blob(
-                    ob, new_bucket_path + self._get_blob_name(ob))
-            for f in folders:
-                self.rename_file(
-                    old_bucket_name + "/" + f,
-                    new_bucket_name + "/" +
-                    f.replace(old_bucket_path, new_bucket_path, 1))
-            return
+        old_blob = self._lookup_blob(old_bucket, old_bucket_path)
+        self._forget_blobs(old_bucket_name, old_bucket_path)
+        self._forget_blobs(new_bucket_name, new_bucket_path)
         if old_blob is not None:
-            old_bucket.copy_blob(old_blob, new_bucket, new_bucket_path)
-            old_bucket.delete_blob(old_blob)
+            if old_bucket_name == new_bucket_name:
+                old_bucket.rename_blob(old_blob, new_bucket_path)
+            else:
+                self._copy_blob(old_blob, new_bucket, new_bucket_path)
+                old_bucket.delete_blob(old_blob.name)
+                self._delete_blobs(old_bucket,
+                                   sorted(self._segment_names((old_blob,))))
+                if self._has_stored_outputs(old_blob):
+                    self._schedule_output_gc(old_bucket_name)
             return
         if not old_bucket_path.endswith("/"):
             old_bucket_path += "/"
         if not new_bucket_path.endswith("/"):
             new_bucket_path += "/"
-        it = old_bucket.list_blobs(prefix=old_bucket_path, delimiter="/",
-                                   max_results=self.max_list_size)
-        old_blobs = list(islice(it, self.max_list_size))
-        folders = it.prefixes
+        # a flat listing includes the blobs of all the nested folders;
+        # the originals are deleted in batches after everything is copied
+        old_blobs = list(old_bucket.list_blobs(prefix=old_bucket_path))
         for ob in old_blobs:
-            old_bucket.copy_blob(ob, new_bucket, new_bucket_path +
-                                 self._get_blob_name(ob))
-            ob.delete()
-        for f in folders:
-            self.rename_file(
-                old_bucket_name + "/" + f,
-                new_bucket_name + "/" +
-                f.replace(old_bucket_path, new_bucket_path, 1))
+            self._copy_blob(ob, new_bucket,
+                            new_bucket_path + ob.name[len(old_bucket_path):])
+        self._delete_blobs(old_bucket, (ob.name for ob in old_blobs))
+        if old_bucket_name != new_bucket_name:
+            self._delete_blobs(old_bucket,
+                               sorted(self._segment_names(old_blobs)))
+            if any(self._has_stored_outputs(ob) for ob in old_blobs):
+                self._schedule_output_gc(old_bucket_name)
+
+    @traced
+    @request_scoped
+    def bulk(self, action, paths, destination=None):
+        """
+        Deletes, moves or copies the selected files and directories at once.
+        The paths inside the other selected directories are dropped, every
+        parent directory and the destination are listed once, the contents
+        of the directories are listed in parallel, the objects are copied in
+        parallel and deleted with batch requests. The checkpoints of the
+        files are deleted and moved together with them.
+        :param action: "delete", "move" or "copy".
+        :param paths: list of the file and directory paths.
+        :param destination: directory to move or copy to.
+        :return: list of dicts with "path", "status" - HTTP status code of \
+                 the item, "message" if it failed and "new_path" if it was \
+                 moved or copied, in the order of the paths. A path inside \
+                 another selected directory shares its result.
+        """
+        if action not in BULK_ACTIONS:
+            raise web.HTTPError(400, u"Unknown bulk action: %s" % action)
+        if not paths:
+            raise web.HTTPError(400, u"No paths to %s" % action)
+        if len(paths) > self.bulk_max_paths:
+            raise web.HTTPError(413, u"Too many paths: %d > %d" % (
+                len(paths), self.bulk_max_paths))
+        dest_bucket = dest_prefix = None
+        if action != "delete":
+            if destination is None:
+                raise web.HTTPError(400, u"No destination to %s to" % action)
+            destination = destination.strip("/")
+            dest_bucket_name, dest_prefix = self._parse_path(destination)
+            dest_bucket = self._get_bucket(dest_bucket_name)
+            if dest_bucket is None:
+                raise web.HTTPError(
+                    404, u"No such directory: %s" % destination)
+            if dest_prefix:
+                dest_prefix += "/"
+        roots, cover = plan_paths(paths)
+        # path -> tuple(status, message)
+        results = {}
+        buckets = {}
+        items = []
+        for path in roots:
+            bucket_name, name = self._parse_path(path)
+            if not name:
+                results[path] = (400, u"Buckets cannot be changed in bulk")
+                continue
+            if bucket_name not in buckets:
+                buckets[bucket_name] = self._get_bucket(bucket_name)
+            if buckets[bucket_name] is None or \
+                    self.is_hidden(path) and not self.allow_hidden:
+                results[path] = (404, u"No such file or directory: %s" % path)
+                continue
+            self._flush_pending_writes(path)
+            items.append(BulkItem(path, bucket_name, name,
+                                  name[:name.rfind("/") + 1]))
+
+        def list_level(key):
+            bucket, prefix = key
+            it = bucket.list_blobs(prefix=prefix, delimiter="/")
+            blobs = {blob.name: blob for blob in it}
+            return blobs, set(it.prefixes)
+
+        # one listing per parent directory tells the files from directories
+        groups = group_by_parent(items)
+        levels = [(buckets[bucket_name], parent)
+                  for bucket_name, parent in groups]
+        if dest_bucket is not None:
+            levels.append((dest_bucket, dest_prefix))
+        levels = dict(zip([(b.name, p) for b, p in levels],
+                          self.io_pool.map(list_level, levels)))
+        taken = set()
+        if dest_bucket is not None:
+            blobs, prefixes = levels[(dest_bucket.name, dest_prefix)]
+            taken.update(name[len(dest_prefix):].rstrip("/")
+                         for name in list(blobs) + list(prefixes))
+        checkpoints = self.checkpoints
+        if action == "copy" or \
+                not isinstance(checkpoints, GoogleStorageCheckpoints):
+            checkpoints = None
+        # item -> list of the blobs, the file itself or the directory contents
+        sources = {}
+        folders = []
+        # item -> tuple(bucket name, checkpoint directory prefix)
+        checkpoint_dirs = {}
+        for key, group in groups.items():
+            blobs, prefixes = levels[key]
+            for item in group:
+                base = item.name[len(item.parent):]
+                if item.name in blobs:
+                    sources[item] = [blobs[item.name]]
+                elif item.name + "/" in prefixes:
+                    folders.append(item)
+                else:
+                    results[item.path] = (
+                        404, u"No such file or directory: %s" % item.path)
+                    continue
+                if dest_bucket is not None:
+                    if item not in sources and \
+                            item.bucket == dest_bucket.name and \
+                            dest_prefix.startswith(item.name + "/"):
+                        results[item.path] = (400, u"Cannot %s %s into itself"
+                                              % (action, item.path))
+                        continue
+                    if base in taken:
+                        results[item.path] = (409, u"%s already exists in %s"
+                                              % (base, destination))
+                        continue
+                    taken.add(base)
+                if item in sources and checkpoints is not None:
+                    cp_bucket_name, cp_name = self._parse_path(
+                        checkpoints._get_checkpoint_path(None, item.path))
+                    cp_prefix = cp_name[:cp_name.rfind("/") + 1]
+                    # the parent listing shows if a sibling directory exists
+                    if cp_bucket_name != item.bucket or \
+                            cp_prefix[:cp_prefix.rfind("/", 0, -1) + 1] != \
+                            item.parent or cp_prefix in prefixes:
+                        checkpoint_dirs[item] = (cp_bucket_name, cp_prefix)
+        for bucket_name, _ in checkpoint_dirs.values():
+            if bucket_name not in buckets:
+                buckets[bucket_name] = self._get_bucket(bucket_name)
+        # the contents of the directories and the checkpoints, in parallel
+        folders = [item for item in folders if item.path not in results]
+        scans = [(item.bucket, item.name + "/") for item in folders] + \
+            sorted({key for key in checkpoint_dirs.values()
+                    if buckets[key[0]] is not None})
+        listings = dict(zip(scans, self.io_pool.map(
+            lambda key: list(buckets[key[0]].list_blobs(prefix=key[1])),
+            scans)))
+        for item in folders:
+            sources[item] = listings[(item.bucket, item.name + "/")]
+
+        # item -> list of tuple(blob, new bucket, new name)
+        copies = {}
+        # item -> list of tuple(bucket, name)
+        deletes = {}
+        # the buckets which may have unused outputs after the deletes,
+        # the unused segments are deleted with the notebooks
+        gc_buckets = set()
+        for item, blobs in sources.items():
+            if item.path in results:
+                continue
+            base = item.name[len(item.parent):]
+            deletes[item] = [(blob.bucket, blob.name) for blob in blobs]
+            if action != "copy" and (dest_bucket is None or
+                                     item.bucket != dest_bucket.name):
+                gc_buckets.update(blob.bucket.name for blob in blobs
+                                  if self._has_stored_outputs(blob))
+                deletes[item].extend(
+                    (buckets[item.bucket], name)
+                    for name in sorted(self._segment_names(blobs)))
+            if dest_bucket is not None:
+                copies[item] = [
+                    (blob, dest_bucket,
+                     dest_prefix + base + blob.name[len(item.name):])
+                    for blob in blobs]
+            if item not in checkpoint_dirs:
+                continue
+            stem, ext = os.path.splitext(base)
+            cp_bucket_name, cp_prefix = checkpoint_dirs[item]
+            for blob in listings.get(checkpoint_dirs[item], ()):
+                if not is_checkpoint(blob.name[len(cp_prefix):], stem, ext):
+                    continue
+                deletes[item].append((blob.bucket, blob.name))
+                if dest_bucket is not None:
+                    new_bucket_name, new_name = self._parse_path(
+                        checkpoints._get_checkpoint_path(
+                            checkpoints._get_checkpoint_id(blob),
+                            destination + "/" + base))
+                    copies[item].append((
+                        blob, buckets.get(new_bucket_name, dest_bucket),
+                        new_name))
+
+        def copy(task):
+            blob, new_bucket, new_name = task
+            try:
+                self._copy_blob(blob, new_bucket, new_name)
+            except GoogleCloudError as e:
+                return e.code or 500, e.message
+            except web.HTTPError as e:
+                return e.status_code, e.log_message
+            return 200, None
+
+        tasks = [(item, task) for item, item_tasks in copies.items()
+                 for task in item_tasks]
+        # the notebooks which take their outputs to other buckets wait for
+        # io_pool themselves, they are copied in this thread
+        pooled = []
+        serial = []
+        for item, task in tasks:
+            blob, new_bucket, _ = task
+            if blob.bucket.name != new_bucket.name and \
+                    self._has_stored_outputs(blob):
+                serial.append((item, task))
+            else:
+                pooled.append((item, task))
+        for (item, _), (status, message) in chain(
+                zip(pooled, self.io_pool.map(
+                    copy, [task for _, task in pooled])),
+                ((entry, copy(entry[1])) for entry in serial)):
+            if status != 200:
+                results.setdefault(item.path, (status, message))
+        if action != "copy":
+            # bucket name -> tuple(bucket, list of tuple(item, blob name))
+            by_bucket = {}
+            for item, names in deletes.items():
+                if item.path in results:
+                    # a move which failed to copy keeps the originals
+                    continue
+                for bucket, name in names:
+                    by_bucket.setdefault(bucket.name, (bucket, []))[1].append(
+                        (item, name))
+            # every batch request is built in its own thread: the batch
+            # stack of the client is thread local
+            size = max(min(self.batch_size, 100), 1)
+            chunks = [(bucket, names[i:i + size])
+                      for bucket, names in by_bucket.values()
+                      for i in range(0, len(names), size)]
+
+            def delete(chunk):
+                bucket, names = chunk
+                return self._batch(partial(bucket.delete_blob, name)
+                                   for _, name in names)
+
+            for (bucket, names), statuses in zip(
+                    chunks, self.io_pool.map(delete, chunks)):
+                for (item, name), status in zip(names, statuses):
+                    if status >= 300 and status != 404:
+                        results.setdefault(item.path, (
+                            status, u"Failed to delete %s/%s" % (
+                                bucket.name, name)))
+        for bucket_name in gc_buckets:
+            self._schedule_output_gc(bucket_name)
+        for item in items:
+            self._forget_blobs(item.bucket, item.name)
+            if dest_bucket is not None:
+                self._forget_blobs(dest_bucket.name,
+                                   dest_prefix + item.name[len(item.parent):])
+        for bucket_name, prefix in set(checkpoint_dirs.values()):
+            self._forget_blobs(bucket_name, prefix)
+        report = []
+        for path in paths:
+            root = cover[path.strip("/")]
+            status, message = results.get(root, (200, None))
+            result = {"path": path.strip("/"), "status": status}
+            if message is not None:
+                result["message"] = message
+            elif dest_bucket is not None:
+                result["new_path"] = destination + "/" + \
+                    path.strip("/")[len(root) - len(root.split("/")[-1]):]
+            report.append(result)
+        return report
+
+    # the maximum number of objects GCS returns per listing request
+    SEARCH_PAGE_SIZE = 1000
+
+    def search(self, path, query):
+        """
+        Finds the files under the directory which names match the query with
+        a flat listing, filtered by GCS if google-cloud-storage supports
+        matchGlob. Lists at most search_max_scan objects.
+        :param path: directory path inside a bucket.
+        :param query: glob of the file name, or of the path relative to the \
+                      directory if it contains "/", or a case insensitive \
+                      substring of the file name.
+        :return: generator of :class:`jgscm.search.SearchPage`, one per \
+                 listed page. The last one has no models and tells whether \
+                 the results are incomplete.
+        """
+        if not query:
+            raise web.HTTPError(400, u"The search query is empty")
+        bucket_name, bucket_path = self._parse_path(path.strip("/"))
+        if not bucket_name:
+            raise web.HTTPError(400, u"Search in a bucket")
+        bucket = self._get_bucket(bucket_name)
+        if bucket is None:
+            raise web.HTTPError(404, u"No such directory: %s" % path)
+        prefix = bucket_path.rstrip("/") + "/" if bucket_path else ""
+        matcher = NameMatcher(prefix, query)
+        index = self.search_index
+        blobs = index.get(bucket_name, prefix) if index is not None else None
+        max_scan = self.search_max_scan
+        if blobs is not None:
+            pages, it = [blobs], None
+        else:
+            kwargs = {}
+            # the index needs all the names
+            if index is None and "match_glob" in inspect.signature(
+                    bucket.list_blobs).parameters:
+                kwargs["match_glob"] = matcher.glob
+            it = bucket.list_blobs(
+                prefix=prefix, max_results=max_scan,
+                page_size=min(self.SEARCH_PAGE_SIZE, max_scan), **kwargs)
+            pages = it.pages
+        found = scanned = 0
+        listed = []
+        full = False
+        for page in pages:
+            page = list(page)
+            scanned += len(page)
+            if it is not None and index is not None:
+                listed.extend(page)
+            models = []
+            for blob in page:
+                if found >= self.search_max_results:
+                    full = True
+                    break
+                if matcher.match(blob.name) and self._searchable(blob):
+                    models.append(self._notebook_model(blob, content=False)
+                                  if blob.name.endswith(".ipynb")
+                                  else self._file_model(blob, content=False))
+                    found += 1
+            if models:
+                yield SearchPage(models, scanned, False)
+            if full and index is None:
+                break
+        cut = it is not None and it.next_page_token is not None
+        if it is not None and index is not None and not cut:
+            index.put(bucket_name, prefix, listed)
+        yield SearchPage([], scanned, full or cut)
+
+    def _searchable(self, blob):
+        """
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: True if the search may return the blob.
+        """
+        if self.hide_dotted_blobs and not self.allow_hidden and \
+                any(part.startswith(".") for part in blob.name.split("/")):
+            return False
+        return self.should_list(self._get_blob_name(blob))
+
+    # the fields of the objects which the usage needs
+    USAGE_FIELDS = "items(name,size,updated),prefixes,nextPageToken"
+
+    @traced
+    def usage(self, path):
+        """
+        Computes the storage usage of the directory. Lists the files in it
+        and every subdirectory flat, in parallel, and caches the rollups of
+        all the directories seen on the way.
+        :param path: bucket or directory path.
+        :return: dict with "path", "size" - total bytes, "count" - number of \
+                 objects and "last_modified" of everything under the \
+                 directory, and "children": the same dicts of the \
+                 subdirectories, the biggest first.
+        """
+        path = path.strip("/")
+        bucket_name, bucket_path = self._parse_path(path)
+        if not bucket_name:
+            raise web.HTTPError(400, u"Usage of a bucket or directory")
+        bucket = self._get_bucket(bucket_name)
+        if bucket is None:
+            raise web.HTTPError(404, u"No such directory: %s" % path)
+        prefix = bucket_path.rstrip("/") + "/" if bucket_path else ""
+        cache = self.usage_cache
+        cached = cache.get(bucket_name, prefix)
+        children = {}
+        if cached is not None:
+            total, folders = cached
+            for folder in folders:
+                entry = cache.get(bucket_name, folder)
+                if entry is not None:
+                    children[folder] = entry[0]
+        else:
+            it = bucket.list_blobs(prefix=prefix, delimiter="/",
+                                   fields=self.USAGE_FIELDS)
+            total = EMPTY_ROLLUP
+            for blob in it:
+                total = total.add(Rollup(blob.size or 0, 1, blob.updated))
+            folders = sorted(it.prefixes)
+        missing = [folder for folder in folders if folder not in children]
+        for folder, rollup in zip(missing, self.io_pool.map(
+                partial(self._tree_usage, bucket), missing)):
+            children[folder] = rollup
+        if cached is None:
+            for folder in folders:
+                total = total.add(children[folder])
+            cache.put(bucket_name, prefix, total, folders)
+
+        def model(path, rollup):
+            return {"path": path, "size": rollup.size, "count": rollup.count,
+                    "last_modified": rollup.last_modified}
+
+        result = model(path, total)
+        result["children"] = sorted(
+            (model(bucket_name + "/" + folder.rstrip("/"), rollup)
+             for folder, rollup in children.items()),
+            key=lambda m: (-m["size"], m["path"]))
+        return result
+
+    def _tree_usage(self, bucket, prefix):
+        """
+        Lists everything under the prefix flat and caches the rollups of
+        the directory and of all the directories in it.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param prefix: directory blob name prefix.
+        :return: :class:`jgscm.usage.Rollup` of the directory.
+        """
+        rollups = {prefix: EMPTY_ROLLUP}
+        folders = {prefix: set()}
+        for blob in bucket.list_blobs(prefix=prefix,
+                                      fields=self.USAGE_FIELDS):
+            one = Rollup(blob.size or 0, 1, blob.updated)
+            name = blob.name
+            directory = prefix
+            while True:
+                rollups[directory] = rollups.get(
+                    directory, EMPTY_ROLLUP).add(one)
+                cut = name.find("/", len(directory))
+                if cut < 0:
+                    break
+                sub = name[:cut + 1]
+                folders.setdefault(directory, set()).add(sub)
+                directory = sub
+        cache = self.usage_cache
+        for directory, rollup in rollups.items():
+            cache.put(bucket.name, directory, rollup,
+                      sorted(folders.get(directory, ())))
+        return rollups[prefix]
+
+    @property
+    def tracer(self):
+        """
+        :return: :class:`jgscm.trace.Tracer` instance or None if the tracing \
+                 is disabled.
+        """
+        if self._tracer is None and self.slow_request_threshold >= 0:
+            # the client lock is taken by self.client
+            session = self.client._http
+            with self._tracer_lock:
+                # the warm-up thread may race the first request, a second
+                # tracer would record every call twice
+                if self._tracer is None:
+                    tracer = Tracer(self.slow_request_threshold, self.log)
+                    tracer.attach(session)
+                    self._tracer = tracer
+        return self._tracer
+
+    @property
+    def usage_cache(self):
+        """
+        :return: :class:`jgscm.usage.UsageCache` instance.
+        """
+        if self._usage_cache is None:
+            self._usage_cache = UsageCache(self.usage_cache_ttl)
+        return self._usage_cache
+
+    @property
+    def search_index(self):
+        """
+        :return: :class:`jgscm.search.NameIndex` instance or None if the \
+                 listings of the searched directories are not kept.
+        """
+        if self.search_index_ttl <= 0:
+            return None
+        if self._search_index is None:
+            self._search_index = NameIndex(self.search_index_ttl)
+        return self._search_index
 
     @property
     def client(self):
@@ -446,13 +1423,42 @@ class GoogleStorageContentManager(ContentsManager):
         """
         if self._client is not None:
             return self._client
-        if not self.project:
-            self._client = GSClient()
-        else:
-            self._client = GSClient.from_service_account_json(
-                self.keyfile, project=self.project)
+        with self._client_lock:
+            if self._client is None:
+                from google.cloud.storage import Client as GSClient
+                if not self.project:
+                    self._client = GSClient()
+                else:
+                    self._client = GSClient.from_service_account_json(
+                        self.keyfile, project=self.project)
         return self._client
 
+    def start_warm_up(self):
+        """
+        Creates the client and fetches the default path in a background
+        thread. The first request refreshes the access token and opens the
+        TLS connection, the listing fills the bucket cache.
+        :return: the started :class:`threading.Thread`.
+        """
+        thread = threading.Thread(target=self._warm_up, name="jgscm-warm-up")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        start = time.time()
+        try:
+            path = self.default_path.strip("/")
+            if path:
+                self.get(path, content=True)
+            else:
+                self._list_root()
+        except Exception as e:
+            self.log.warning("Failed to warm up the GCS client: %s", e)
+        else:
+            self.log.info("Warmed up the GCS client in %.2fs",
+                          time.time() - start)
+
     def run_post_save_hook(self, model, os_path):
         """Run the post-save hook if defined, and log errors"""
         if self.post_save_hook:
@@ -489,6 +1495,13 @@ class GoogleStorageContentManager(ContentsManager):
         raise web.HTTPError(
             404, u"%s does not exist" % path, reason="bad type")
 
+    def _get_bucket_cache(self):
+        try:
+            return self._bucket_cache
+        except AttributeError:
+            self._bucket_cache = cache = {}
+            return cache
+
     def _get_bucket(self, name, throw=False):
         """
         Get the bucket by it's name. Uses cache by default.
@@ -498,23 +1511,28 @@ class GoogleStorageContentManager(ContentsManager):
         :return: instance of :class:`google.cloud.storage.Bucket` or None.
         """
         if not self.cache_buckets:
+            memo = self._request_memo()
+            if memo is not None and ("bucket", name) in memo:
+                return memo[("bucket", name)]
             try:
                 bucket_descriptor = self.client.bucket(name, user_project=self.client.project)
-                return self.client.get_bucket(bucket_descriptor)
+                bucket = self._hedged("bucket", self.client.get_bucket,
+                                      bucket_descriptor)
             except NotFound:
                 if throw:
                     raise
                 return None
-        try:
-            cache = self._bucket_cache
-        except AttributeError:
-            self._bucket_cache = cache = {}
+            if memo is not None:
+                memo[("bucket", name)] = bucket
+            return bucket
+        cache = self._get_bucket_cache()
         try:
             return cache[name]
         except KeyError:
             try:
                 bucket_descriptor = self.client.bucket(name, user_project=self.client.project)
-                bucket = self.client.get_bucket(bucket_descriptor)
+                bucket = self._hedged("bucket", self.client.get_bucket,
+                                      bucket_descriptor)
             except BrokenPipeError as e:
                 if e.errno in (None, errno.EPIPE):
                     return self._get_bucket(name, throw)
@@ -527,6 +1545,385 @@ class GoogleStorageContentManager(ContentsManager):
             cache[name] = bucket
             return bucket
 
+    @property
+    def write_journal(self):
+        """
+        :return: :class:`jgscm.journal.WriteJournal` instance or None if \
+                 write-behind is disabled.
+        """
+        if not self.write_behind_dir:
+            return None
+        if self._write_journal is None:
+            with self._write_journal_lock:
+                if self._write_journal is None:
+                    from jgscm.journal import WriteJournal
+                    self._write_journal = WriteJournal(
+                        self.write_behind_dir, self._upload_pending_write,
+                        self.write_behind_delay, self.log)
+        return self._write_journal
+
+    @property
+    def disk_cache(self):
+        """
+        :return: :class:`jgscm.diskcache.BlobCache` instance or None if the \
+                 local cache is disabled.
+        """
+        if not self.disk_cache_dir:
+            return None
+        if self._disk_cache is None:
+            self._disk_cache = BlobCache(self.disk_cache_dir,
+                                         self.disk_cache_size, self.log)
+        return self._disk_cache
+
+    @property
+    def prefetcher(self):
+        """
+        :return: :class:`jgscm.prefetch.Prefetcher` instance or None if the \
+                 prefetch is disabled.
+        """
+        if self.prefetch_max_size <= 0:
+            return None
+        if self._prefetcher is None:
+            self.client  # create the client before it is used in threads
+            self._prefetcher = Prefetcher(
+                self._download_blob, self.prefetch_max_files,
+                self.prefetch_max_size, self.prefetch_ttl, self.log)
+        return self._prefetcher
+
+    @property
+    def hedger(self):
+        """
+        :return: :class:`jgscm.hedge.Hedger` instance or None if the reads \
+                 are not hedged.
+        """
+        if not self.hedge_reads:
+            return None
+        if self._hedger is None:
+            self.client  # create the client before it is used in threads
+            self._hedger = Hedger(self.hedge_percentile, self.hedge_min_delay,
+                                  self.hedge_max_rate)
+        return self._hedger
+
+    def _hedged(self, kind, fn, *args, **kwargs):
+        """
+        Calls the idempotent GCS request function, hedged if enabled.
+        :param kind: request kind, see :class:`jgscm.hedge.Hedger`.
+        :param fn: the function to call.
+        :return: the result of fn(*args, **kwargs).
+        """
+        hedger = self.hedger
+        if hedger is None:
+            return fn(*args, **kwargs)
+        return hedger.call(kind, partial(fn, *args, **kwargs))
+
+    @property
+    def checksum_type(self):
+        """
+        :return: "crc32c", "md5" or None, see the checksum option.
+        """
+        return checksum_type(self.checksum)
+
+    def _verified(self, download, what):
+        """
+        Calls the whole-object download function once more if the bytes
+        arrived corrupted.
+        :param download: function without arguments which returns bytes.
+        :param what: downloaded file path for the messages.
+        :return: bytes.
+        """
+        try:
+            return download()
+        except Exception as e:
+            if not _is_corrupted(e):
+                raise
+            self.log.warning("Downloading %s again: %s", what, e)
+        try:
+            return download()
+        except Exception as e:
+            if not _is_corrupted(e):
+                raise
+            raise web.HTTPError(
+                502, u"%s was corrupted in transit twice: %s" % (what, e))
+
+    # the downloaded bytes, the decoded or base64 string and the JSON reply
+    TRANSFER_COPIES = 3
+
+    @property
+    def memory_budget(self):
+        """
+        :return: :class:`jgscm.admission.MemoryBudget` instance or None if \
+                 the memory of the transfers is not limited.
+        """
+        if self.transfer_memory_limit <= 0:
+            return None
+        if self._memory_budget is None:
+            self._memory_budget = MemoryBudget(self.transfer_memory_limit,
+                                               self.transfer_memory_timeout)
+        return self._memory_budget
+
+    def _reserve_memory(self, size, path):
+        """
+        :param size: estimated memory needed by the transfer in bytes.
+        :param path: transferred file path.
+        :return: context manager which holds the reservation.
+        """
+        budget = self.memory_budget
+        if budget is None or size <= 0:
+            return unreserved()
+        return budget.reserve(size, path)
+
+    def _download_blob(self, blob):
+        """
+        Downloads the whole blob through the local cache. The blob must have
+        been fetched from GCS: the generation of the metadata is the cache
+        key and the download requests that generation.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: bytes.
+        """
+        prefetcher = self._prefetcher
+        if prefetcher is not None:
+            data = prefetcher.data(blob)
+            if data is not None:
+                return data
+        if blob.size is not None and blob.size <= self.hedge_max_size:
+            download = partial(self._hedged, "download",
+                               blob.download_as_bytes,
+                               checksum=self.checksum_type)
+        else:
+            download = partial(blob.download_as_bytes,
+                               checksum=self.checksum_type)
+        download = partial(self._verified, download,
+                           "%s/%s" % (blob.bucket.name, blob.name))
+        cache = self.disk_cache
+        if cache is None or blob.generation is None:
+            return download()
+        data = cache.get(blob.bucket.name, blob.name, blob.generation,
+                         blob.size)
+        if data is None:
+            data = download()
+            cache.put(blob.bucket.name, blob.name, blob.generation, data)
+        return data
+
+    def _cache_blob(self, blob, data):
+        """
+        Adds the contents of a blob which has just been uploaded to the
+        local cache.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :param data: uploaded bytes.
+        """
+        cache = self.disk_cache
+        if cache is not None and blob.generation is not None:
+            cache.put(blob.bucket.name, blob.name, blob.generation, data)
+
+    def _upload_pending_write(self, entry):
+        """
+        Uploads a file saved to the write-behind journal.
+        :param entry: :class:`jgscm.journal.PendingWrite` instance.
+        """
+        if entry.type == "notebook":
+            if self.output_blob_threshold > 0:
+                blob = self._save_notebook(entry.path,
+                                           self._reads_notebook(entry.data))
+            else:
+                blob = self._save_notebook(entry.path, None, entry.data)
+            # One checkpoint should always exist for notebooks. It is copied
+            # from the upload: reading the notebook back marks the trusted
+            # cells, and the notary database is bound to the request thread.
+            checkpoints = self.checkpoints
+            if not checkpoints.list_checkpoints(entry.path):
+                if isinstance(checkpoints, GoogleStorageCheckpoints):
+                    checkpoints.copy_to_checkpoint(blob, entry.path)
+                else:
+                    self.create_checkpoint(entry.path)
+        else:
+            self._upload_file(entry.path, entry.data)
+
+    def _flush_pending_writes(self, path):
+        """
+        Uploads the journaled versions of the file or the files in the
+        directory, so that they can be changed in GCS.
+        :param path: file or directory path.
+        """
+        journal = self.write_journal
+        if journal is not None:
+            # the journal is keyed by the full GCS path
+            journal.flush("%s/%s" % self._parse_path(path))
+
+    @property
+    def io_pool(self):
+        """
+        :return: :class:`concurrent.futures.ThreadPoolExecutor` for the \
+                 parallel GCS requests.
+        """
+        if self._io_pool is None:
+            self.client  # create the client before it is used in threads
+            self._io_pool = ContextExecutor(
+                max_workers=self.io_threads,
+                thread_name_prefix="jgscm")
+        return self._io_pool
+
+    def _list_root(self):
+        """
+        Lists the buckets shown at the root level. Uses cache.
+        :return: list of tuple(bucket name, whether the bucket is writable).
+        """
+        cached = self._root_cache
+        now = time.time()
+        if cached is not None and now < cached[0]:
+            return cached[1]
+        patterns = self.root_bucket_patterns
+
+        def shown(name):
+            return not patterns or any(fnmatch(name, p) for p in patterns)
+
+        if self.root_buckets:
+            names = [name for name in self.root_buckets if shown(name)]
+            probes = self._probe_buckets(names)
+            buckets = [(name, probe) for name, probe in zip(names, probes)
+                       if probe is not None]
+        else:
+            buckets = []
+            for bucket in self.client.list_buckets():
+                if not shown(bucket.name):
+                    continue
+                buckets.append((bucket.name, True))
+                if self.cache_buckets:
+                    # the listing has already fetched the metadata
+                    cached_bucket = self.client.bucket(
+                        bucket.name, user_project=self.client.project)
+                    cached_bucket._set_properties(bucket._properties)
+                    self._get_bucket_cache().setdefault(
+                        bucket.name, cached_bucket)
+        self._root_cache = (now + self.root_cache_ttl, buckets)
+        return buckets
+
+    def _probe_bucket(self, name):
+        """
+        Checks whether the bucket is accessible. Answers from the bucket
+        cache and the recent failed lookups, so that only the first check
+        of an unknown bucket makes a request, which is then reused by the
+        operation itself.
+        :param name: bucket name.
+        :return: True if accessible, False if forbidden, None if not found.
+        """
+        known, accessible = self._recall_bucket(name)
+        if known:
+            return accessible
+        try:
+            if self._get_bucket(name) is not None:
+                return True
+            forbidden = False
+        except Forbidden:
+            forbidden = True
+        self._remember_inaccessible_bucket(name, forbidden)
+        return False if forbidden else None
+
+    def _probe_buckets(self, names):
+        """
+        Checks whether the buckets are accessible, like _probe_bucket(), but
+        looks up the unknown buckets with batch requests.
+        :param names: list of bucket names.
+        :return: list of True if accessible, False if forbidden, None if not \
+                 found.
+        """
+        results = {}
+        pending = []
+        for name in names:
+            known, accessible = self._recall_bucket(name)
+            if known:
+                results[name] = accessible
+            else:
+                pending.append(self.client.bucket(
+                    name, user_project=self.client.project))
+        statuses = self._batch(bucket.reload for bucket in pending)
+        for bucket, status in zip(pending, statuses):
+            if status < 300:
+                results[bucket.name] = True
+                if self.cache_buckets:
+                    self._get_bucket_cache()[bucket.name] = bucket
+            elif status in (400, 403, 404):
+                results[bucket.name] = False if status == 403 else None
+                self._remember_inaccessible_bucket(bucket.name, status == 403)
+            else:
+                raise from_http_status(
+                    status, u"Failed to get bucket %s" % bucket.name)
+        return [results[name] for name in names]
+
+    def _recall_bucket(self, name):
+        """
+        Looks up the accessibility of the bucket without requests.
+        :param name: bucket name.
+        :return: tuple(whether the answer is known, True if accessible, \
+                 False if forbidden, None if not found).
+        """
+        if self.cache_buckets and name in self._get_bucket_cache():
+            return True, True
+        failed = self._inaccessible_buckets.get(name)
+        if failed is not None:
+            if time.time() < failed[0]:
+                return True, False if failed[1] else None
+            self._inaccessible_buckets.pop(name, None)
+        return False, None
+
+    def _remember_inaccessible_bucket(self, name, forbidden):
+        if self.root_cache_ttl > 0:
+            self._inaccessible_buckets[name] = (
+                time.time() + self.root_cache_ttl, forbidden)
+
+    def _batch(self, calls):
+        """
+        Sends the GCS requests in batch requests of up to batch_size.
+        :param calls: iterable of callables which make one request each, \
+                      e.g. functools.partial(bucket.delete_blob, name).
+        :return: list with the HTTP status code of every request.
+        """
+        statuses = []
+        calls = iter(calls)
+        size = max(min(self.batch_size, 100), 1)
+        while True:
+            chunk = list(islice(calls, size))
+            if not chunk:
+                return statuses
+            batch = None
+            if len(chunk) > 1:
+                try:
+                    batch = self.client.batch(raise_exception=False)
+                except TypeError:
+                    # old google-cloud-storage cannot report every status
+                    pass
+            if batch is None:
+                for call in chunk:
+                    try:
+                        call()
+                        statuses.append(200)
+                    except GoogleCloudError as e:
+                        statuses.append(e.code)
+                continue
+            with batch:
+                for call in chunk:
+                    call()
+            statuses.extend(r.status_code for r in batch._responses)
+
+    def _delete_blobs(self, bucket, names):
+        """
+        Deletes the blobs with batch requests. Missing blobs are skipped.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param names: iterable of blob names.
+        """
+        names = iter(names)
+        while True:
+            chunk = list(islice(names, max(self.batch_size, 1)))
+            if not chunk:
+                return
+            for name in chunk:
+                self._forget_blobs(bucket.name, name)
+            statuses = self._batch(partial(bucket.delete_blob, name)
+                                   for name in chunk)
+            for name, status in zip(chunk, statuses):
+                if status >= 300 and status != 404:
+                    raise from_http_status(status, u"Failed to delete %s/%s" % (
+                        bucket.name, name))
+
     def _parse_path(self, path):
         """
         Splits the path into bucket name and path inside the bucket.
@@ -555,7 +1952,7 @@ class GoogleStorageContentManager(ContentsManager):
         :param blob: instance of :class:`google.cloud.storage.Blob`.
         :return: name string.
         """
-        if isinstance(blob, Blob):
+        if _is_blob(blob):
             return os.path.basename(blob.name)
         assert isinstance(blob, (unicode, str))
         if blob.endswith("/"):
@@ -584,8 +1981,8 @@ class GoogleStorageContentManager(ContentsManager):
         """
         if path == "":
             try:
-                buckets = self.client.list_buckets()
-                return True, ([], [b.name + "/" for b in buckets])
+                buckets = self._list_root()
+                return True, ([], [name + "/" for name, _ in buckets])
             except BrokenPipeError as e:
                 if e.errno in (None, errno.EPIPE):
                     return self._fetch(path, content)
@@ -604,23 +2001,31 @@ class GoogleStorageContentManager(ContentsManager):
         if bucket_path == "" and not content:
             return True, None
         if bucket_path == "" or bucket_path.endswith("/"):
-            if bucket_path != "":
+            if bucket_path != "" and not content:
                 try:
-                    exists = bucket.blob(bucket_path).exists()
+                    exists = self._lookup_blob(bucket, bucket_path) is not None
                 except BrokenPipeError as e:
                     if e.errno in (None, errno.EPIPE):
                         return self._fetch(path, content)
                     else:
                         raise
-                if exists and not content:
+                if exists:
                     return True, None
             # blob may not exist but at the same time be a part of a path
             max_list_size = self.max_list_size if content else 1
-            try:
+
+            def list_dir():
                 it = bucket.list_blobs(prefix=bucket_path, delimiter="/",
                                        max_results=max_list_size)
+                return list(islice(it, max_list_size)), it.prefixes
+
+            listing = partial(self._hedged, "list", list_dir)
+            if content and self.prefix_index is not None:
+                listing = partial(self._indexed_listing, bucket, bucket_path,
+                                  listing)
+            try:
                 try:
-                    files = list(islice(it, max_list_size))
+                    files, folders = listing()
                 except BrokenPipeError as e:
                     if e.errno in (None, errno.EPIPE):
                         return self._fetch(path, content)
@@ -629,13 +2034,12 @@ class GoogleStorageContentManager(ContentsManager):
             except NotFound:
                 del self._bucket_cache[bucket_name]
                 return False, None
-            folders = it.prefixes
+            if content:
+                files = self._merge_pending_writes(bucket, bucket_path, files)
             return (bool(files or folders or bucket_path == ""),
                     (files, folders) if content else None)
-        if not content:
-            return bucket.blob(bucket_path).exists(), None
         try:
-            blob = bucket.get_blob(bucket_path)
+            blob = self._lookup_blob(bucket, bucket_path)
         except BrokenPipeError as e:
             if e.errno in (None, errno.EPIPE):
                 return self._fetch(path, content)
@@ -643,6 +2047,174 @@ class GoogleStorageContentManager(ContentsManager):
                 raise
         return blob is not None, blob
 
+    # the fields of the objects which tell whether they have changed
+    INDEX_FIELDS = "items(name,generation,metageneration),prefixes," \
+                   "nextPageToken"
+
+    @property
+    def prefix_index(self):
+        """
+        :return: :class:`jgscm.index.PrefixIndex` instance or None if the \
+                 directory listings are not indexed. Its notify() method \
+                 accepts the GCS change notifications.
+        """
+        if self.index_ttl <= 0:
+            return None
+        if self._prefix_index is None:
+            self._prefix_index = PrefixIndex(self.index_ttl, self.index_dir,
+                                             self.log)
+        return self._prefix_index
+
+    def _indexed_listing(self, bucket, prefix, list_dir):
+        """
+        Lists the directory through the index.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param prefix: directory blob name prefix.
+        :param list_dir: function which lists the directory in full.
+        :return: tuple(list of :class:`google.cloud.storage.Blob`, set of \
+                 the subdirectory prefixes).
+        """
+        index = self.prefix_index
+        entry, fresh = index.get(bucket.name, prefix)
+        if entry is not None and not fresh:
+            it = bucket.list_blobs(prefix=prefix, delimiter="/",
+                                   max_results=self.max_list_size,
+                                   fields=self.INDEX_FIELDS)
+            listed = list(islice(it, self.max_list_size))
+            folders = it.prefixes
+            known = entry.files
+            changed = [blob for blob in listed
+                       if blob.name not in known or
+                       (str(blob.generation), str(blob.metageneration)) !=
+                       (str(known[blob.name].get("generation")),
+                        str(known[blob.name].get("metageneration")))]
+            index.count("refreshes")
+            index.count("changed", len(changed))
+            if len(changed) <= self.batch_size:
+                # one batch is cheaper than the full listing
+                statuses = self._batch(blob.reload for blob in changed)
+                files = {}
+                for blob in listed:
+                    files[blob.name] = known.get(blob.name)
+                for blob, status in zip(changed, statuses):
+                    if status == 200:
+                        files[blob.name] = blob._properties
+                    elif status == 404:
+                        del files[blob.name]  # deleted meanwhile
+                    else:
+                        raise from_http_status(
+                            status, u"Failed to get %s/%s" % (
+                                bucket.name, blob.name))
+                entry = index.put(bucket.name, prefix, files, folders)
+            else:
+                entry = None
+        if entry is None:
+            blobs, folders = list_dir()
+            index.count("listings")
+            entry = index.put(bucket.name, prefix, dict(
+                (blob.name, blob._properties) for blob in blobs), folders)
+        blobs = []
+        for name in sorted(entry.files):
+            blob = bucket.blob(name)
+            blob._set_properties(entry.files[name])
+            blobs.append(blob)
+        return blobs, set(entry.folders)
+
+    def _merge_pending_writes(self, bucket, prefix, blobs):
+        """
+        Adds the journaled files to the directory listing.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param prefix: directory blob name prefix.
+        :param blobs: list of the listed :class:`google.cloud.storage.Blob`.
+        :return: list of :class:`google.cloud.storage.Blob`.
+        """
+        journal = self.write_journal
+        if journal is None:
+            return blobs
+        from jgscm.journal import PendingBlob
+        root = bucket.name + "/"
+        pending = {}
+        for entry in journal.pending(root + prefix):
+            name = entry.path[len(root):]
+            if "/" not in name[len(prefix):]:
+                pending[name] = PendingBlob(bucket, name, entry)
+        if not pending:
+            return blobs
+        blobs = [blob for blob in blobs if blob.name not in pending]
+        blobs.extend(pending.values())
+        blobs.sort(key=lambda blob: blob.name)
+        return blobs
+
+    def _request_memo(self):
+        """
+        :return: dict which lives during the current top-level call or None.
+        """
+        return getattr(self._request_scope, "memo", None)
+
+    def _lookup_blob(self, bucket, name, pending=True):
+        """
+        Bucket.get_blob() which is memoized during the top-level call.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param name: blob name.
+        :param pending: return the journaled version of the file if it has \
+                        not been uploaded yet.
+        :return: :class:`google.cloud.storage.Blob` instance or None.
+        """
+        journal = self.write_journal if pending else None
+        if journal is not None:
+            entry = journal.get(bucket.name + "/" + name)
+            if entry is not None:
+                from jgscm.journal import PendingBlob
+                return PendingBlob(bucket, name, entry)
+        prefetcher = self._prefetcher
+        if prefetcher is not None:
+            blob = prefetcher.lookup(bucket.name, name)
+            if blob is not None:
+                return blob
+        memo = self._request_memo()
+        key = ("blob", bucket.name, name)
+        if memo is not None and key in memo:
+            return memo[key]
+        blob = self._hedged("blob", bucket.get_blob, name)
+        if memo is not None:
+            memo[key] = blob
+        return blob
+
+    def _remember_blob(self, blob):
+        """
+        Records the blob which has just been written in the request memo.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        """
+        self._forget_blobs(blob.bucket.name, blob.name)
+        memo = self._request_memo()
+        if memo is not None:
+            memo[("blob", blob.bucket.name, blob.name)] = blob
+
+    def _forget_blobs(self, bucket_name, prefix=""):
+        """
+        Drops the memoized lookups and the prefetched contents of the blobs
+        which start with the prefix and the memoized lookups of all the
+        directories in the bucket.
+        :param bucket_name: bucket name.
+        :param prefix: blob name prefix.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate(bucket_name, prefix)
+        if self._search_index is not None:
+            self._search_index.invalidate(bucket_name, prefix)
+        if self._prefix_index is not None:
+            self._prefix_index.invalidate(bucket_name, prefix)
+        if self._usage_cache is not None:
+            self._usage_cache.invalidate(bucket_name, prefix)
+        memo = self._request_memo()
+        if not memo:
+            return
+        for key in list(memo):
+            if key[0] == "dir" and key[1] == bucket_name or \
+                    key[0] == "blob" and key[1] == bucket_name and \
+                    key[2].startswith(prefix):
+                del memo[key]
+
     def _base_model(self, blob):
         """Builds the common base of a contents model"""
         last_modified = blob.updated
@@ -655,11 +2227,28 @@ class GoogleStorageContentManager(ContentsManager):
             "content": None,
             "format": None,
             "mimetype": blob.content_type,
-            "writable": True
+            "writable": True,
+            # save() fails with 409 if the blob has changed since
+            "generation": blob.generation,
         }
         return model
 
-    def _read_file(self, blob, format):
+    def _fetch_file(self, path):
+        """
+        Retrieves the blob of a file.
+        :param path: file path.
+        :return: :class:`google.cloud.storage.Blob` instance.
+        """
+        if path.startswith("/"):
+            path = path[1:]
+        if not path or path.endswith("/"):
+            raise web.HTTPError(404, u"No such file: %s" % path)
+        exists, blob = self._fetch(path)
+        if not exists or not _is_blob(blob):
+            raise web.HTTPError(404, u"No such file: %s" % path)
+        return blob
+
+    def _read_file(self, blob, format, bcontent=None):
         """Reads a non-notebook file.
 
         blob: instance of :class:`google.cloud.storage.Blob`.
@@ -667,8 +2256,10 @@ class GoogleStorageContentManager(ContentsManager):
           If "text", the contents will be decoded as UTF-8.
           If "base64", the raw bytes contents will be encoded as base64.
           If not specified, try to decode as UTF-8, and fall back to base64
+        bcontent: already downloaded contents, if any.
         """
-        bcontent = blob.download_as_string()
+        if bcontent is None:
+            bcontent = self._download_file(blob)
 
         if format is None or format == "text":
             # Try to interpret as unicode if format is unknown or if unicode
@@ -684,7 +2275,91 @@ class GoogleStorageContentManager(ContentsManager):
                     )
         return base64.encodebytes(bcontent).decode("ascii"), "base64"
 
-    def _file_model(self, blob, content=True, format=None):
+    def _download_file(self, blob):
+        """
+        Downloads the raw contents of the file. The outputs which
+        _store_outputs() moved out of a notebook are put back.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: bytes.
+        """
+        data = self._download_blob(blob)
+        if not self._has_stored_outputs(blob):
+            return data
+        nb = self._reads_notebook(data)
+        del data
+        self._load_outputs(blob.bucket, nb)
+        return self._writes_notebook(nb)
+
+    def _read_range(self, blob, start, end, lines):
+        """
+        Reads a part of the file with ranged downloads.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :param start: byte offset to read from, counted from the end of the \
+                      file if negative. None means 0.
+        :param end: byte offset to read up to (exclusive), None means the \
+                    end of the file.
+        :param lines: maximum number of lines to read, None means no limit.
+        :return: tuple(bytes, start, end, file size).
+        """
+        if lines is not None and lines < 0:
+            raise web.HTTPError(400, u"The number of lines may not be negative")
+        if self._has_stored_outputs(blob):
+            # the offsets are in the notebook with the outputs put back
+            data = self._download_file(blob)
+            size = len(data)
+
+            def download(start, end):
+                return data[start:end + 1]
+        else:
+            size = blob.size or 0
+            download = blob.download_as_bytes
+        start = start or 0
+        if start < 0:
+            start = max(size + start, 0)
+        start = min(start, size)
+        end = size if end is None else max(min(end, size), start)
+        end = min(end, start + self.max_range_size)
+        if lines is None:
+            if start == end:
+                return b"", start, end, size
+            return download(start=start, end=end - 1), start, end, size
+        chunks = []
+        pos = start
+        while pos < end and lines > 0:
+            chunk = download(
+                start=pos, end=min(pos + self.range_chunk_size, end) - 1)
+            if not chunk:
+                break
+            newlines = chunk.count(b"\n")
+            if newlines >= lines:
+                cut = -1
+                for _ in range(lines):
+                    cut = chunk.index(b"\n", cut + 1)
+                chunk = chunk[:cut + 1]
+            lines -= newlines
+            chunks.append(chunk)
+            pos += len(chunk)
+        return b"".join(chunks), start, pos, size
+
+    @staticmethod
+    def _trim_utf8(data):
+        """
+        Cuts off the incomplete UTF-8 sequence at the end of the data.
+        :param data: bytes.
+        :return: bytes.
+        """
+        for i in range(1, min(len(data), 4) + 1):
+            byte = data[-i]
+            if byte & 0xC0 == 0x80:
+                continue
+            if byte & 0xC0 == 0xC0:
+                needed = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+                if needed > i:
+                    return data[:-i]
+            break
+        return data
+
+    def _file_model(self, blob, content=True, format=None, part=None):
         """Builds a model for a file
 
         if content is requested, include the file contents.
@@ -693,12 +2368,23 @@ class GoogleStorageContentManager(ContentsManager):
           If "text", the contents will be decoded as UTF-8.
           If "base64", the raw bytes contents will be encoded as base64.
           If not specified, try to decode as UTF-8, and fall back to base64
+
+        part:
+          If specified, tuple(start, end, lines) of the part to read.
         """
         model = self._base_model(blob)
         model["type"] = "file"
 
         if content:
-            content, format = self._read_file(blob, format)
+            data = None
+            if part is not None:
+                data, start, end, size = self._read_range(blob, *part)
+                if format != "base64" and end < size:
+                    data = self._trim_utf8(data)
+                    end = start + len(data)
+                model["range"] = {"start": start, "end": end,
+                                  "size": size}
+            content, format = self._read_file(blob, format, data)
             if model["mimetype"] == "text/plain":
                 default_mime = {
                     "text": "text/plain",
@@ -719,10 +2405,93 @@ class GoogleStorageContentManager(ContentsManager):
         :param blob: :class:`google.cloud.storage.Blob` instance.
         :return: :class:`nbformat.notebooknode.NotebookNode` instance.
         """
-        data = blob.download_as_string().decode("utf-8")
-        nb = nbformat.reads(data, as_version=4)
-        self.mark_trusted_cells(nb, self._get_blob_path(blob))
-        return nb
+        return self._download_notebook(blob)[0]
+
+    def _download_notebook(self, blob):
+        """
+        Reads a notebook file from GCS blob and marks the trusted cells.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: tuple(:class:`nbformat.notebooknode.NotebookNode` instance, \
+                 content digest string).
+        """
+        data = self._download_blob(blob)
+        digest = hashlib.sha256(data).hexdigest()
+        nb = self._reads_notebook(data)
+        del data
+        self._load_outputs(blob.bucket, nb)
+        self._mark_trusted_cells(nb, self._get_blob_path(blob), digest)
+        return nb, digest
+
+    def _reads_notebook(self, data):
+        """
+        Parses the serialized notebook straight from bytes. Unlike
+        nbformat.reads(), does not validate the notebook: the callers
+        validate the model anyway.
+        :param data: notebook JSON bytes.
+        :return: :class:`nbformat.notebooknode.NotebookNode` instance.
+        """
+        try:
+            nb_dict = None
+            if orjson is not None and self.fast_notebook_json:
+                try:
+                    nb_dict = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    # json also reads NaN and Infinity, which nbformat writes
+                    pass
+            if nb_dict is None:
+                nb_dict = json.loads(data)
+            if not isinstance(nb_dict, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            raise nbformat.reader.NotJSONError(
+                "Notebook does not appear to be JSON: %r" % data[:50]) from e
+        major, minor = nbformat.reader.get_version(nb_dict)
+        if major not in nbformat.versions:
+            raise nbformat.NBFormatError(
+                "Unsupported nbformat version %s" % major)
+        try:
+            nb = nbformat.versions[major].to_notebook_json(nb_dict,
+                                                           minor=minor)
+        except AttributeError as e:
+            raise nbformat.ValidationError(
+                "The notebook is invalid and is missing an expected key: "
+                "%s" % e)
+        return nbformat.convert(nb, 4)
+
+    def _writes_notebook(self, nb):
+        """
+        Serializes the notebook to bytes in the canonical nbformat layout.
+        Unlike nbformat.writes(), does not validate the notebook: the
+        callers validate the model anyway.
+        :param nb: :class:`nbformat.notebooknode.NotebookNode` instance.
+        :return: notebook JSON bytes.
+        """
+        def default(obj):
+            if isinstance(obj, bytes):
+                return obj.decode("ascii")
+            raise TypeError(type(obj))
+
+        version, _ = nbformat.reader.get_version(nb)
+        fast = orjson is not None and self.fast_notebook_json and \
+            version == 4
+        if fast:
+            nb = strip_transient(split_lines(copy.deepcopy(nb)))
+            fast = not _has_exponent_floats(nb)
+        if fast:
+            try:
+                data = orjson.dumps(nb, default=default, option=(
+                    orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+            except orjson.JSONEncodeError:
+                # e.g. integers wider than 64 bits, let json handle them
+                pass
+            else:
+                # nbformat indents with one space, orjson with two. JSON
+                # strings never contain raw newlines, so every line starts
+                # with the indentation.
+                return b"\n".join([
+                    line[(len(line) - len(line.lstrip(b" "))) // 2:]
+                    for line in data.split(b"\n")])
+        return nbformat.versions[version].writes_json(nb).encode("utf-8")
 
     def _notebook_model(self, blob, content=True):
         """Builds a notebook model.
@@ -733,18 +2502,80 @@ class GoogleStorageContentManager(ContentsManager):
         model = self._base_model(blob)
         model["type"] = "notebook"
         if content:
-            nb = self._read_notebook(blob)
+            nb, digest = self._download_notebook(blob)
             model["content"] = nb
             model["mimetype"] = "application/x-ipynb+json"
             model["format"] = "json"
+            self._validate_notebook_model(model, digest)
+        return model
+
+    def _check_notebook(self, digest, kind, check):
+        """
+        Memoizes the outcome of an expensive notebook check by the digest of
+        the serialized notebook, so unchanged contents are checked only once.
+        :param digest: SHA-256 hex digest of the notebook JSON bytes.
+        :param kind: name of the check.
+        :param check: callable without arguments which performs the check.
+        :return: the result of check().
+        """
+        cache = self._notebook_checks
+        with self._notebook_checks_lock:
+            try:
+                entry = cache[digest]
+                cache.move_to_end(digest)
+            except KeyError:
+                entry = {}
+                if self.notebook_check_cache_size > 0:
+                    cache[digest] = entry
+                    while len(cache) > self.notebook_check_cache_size:
+                        cache.popitem(last=False)
+            if kind in entry:
+                return entry[kind]
+        result = entry[kind] = check()
+        return result
+
+    def _validate_notebook_model(self, model, digest):
+        """validate_notebook_model() which remembers the outcome."""
+        def validate():
             self.validate_notebook_model(model)
+            return model.get("message")
+
+        message = self._check_notebook(digest, "validation", validate)
+        if message is not None:
+            model["message"] = message
         return model
 
-    def _dir_model(self, path, members, content=True):
+    def _mark_trusted_cells(self, nb, path, digest):
+        """mark_trusted_cells() which remembers the notebook signature."""
+        store = getattr(self.notary, "store", None)
+        if store is None or nb.nbformat < 3:
+            return self.mark_trusted_cells(nb, path)
+        signature = self._check_notebook(
+            digest, "signature", lambda: self.notary.compute_signature(nb))
+        trusted = store.check_signature(signature, self.notary.algorithm)
+        if not trusted:
+            self.log.warning("Notebook %s is not trusted", path)
+        self.notary.mark_cells(nb, trusted)
+
+    def _check_and_sign(self, nb, path, digest):
+        """check_and_sign() which remembers the notebook signature."""
+        store = getattr(self.notary, "store", None)
+        if store is None or nb.nbformat < 3:
+            return self.check_and_sign(nb, path)
+        if not self.notary.check_cells(nb):
+            self.log.info("Notebook %s is not trusted", path)
+            return
+        signature = self._check_notebook(
+            digest, "signature", lambda: self.notary.compute_signature(nb))
+        store.store_signature(signature, self.notary.algorithm)
+
+    def _dir_model(self, path, members, content=True, writable=None):
         """Builds a model for a directory
 
         if content is requested, will include a listing of the directory
         """
+        if writable is None:
+            writable = members is not None or not self.is_hidden(path)
         model = {
             "type": "directory",
             "name": self._get_dir_name(path),
@@ -754,58 +2585,503 @@ class GoogleStorageContentManager(ContentsManager):
             "content": None,
             "format": None,
             "mimetype": "application/x-directory",
-            "writable": (members is not None or not self.is_hidden(path))
+            "writable": writable
         }
         if content:
             blobs, folders = members
             model["content"] = contents = []
+            # the listing has already fetched the metadata of the children
             for blob in blobs:
                 if self._get_blob_path(blob) != path and \
                         self.should_list(self._get_blob_name(blob)):
-                    contents.append(self.get(
-                        path=blob,
-                        content=False)
-                    )
+                    if blob.name.endswith(".ipynb"):
+                        contents.append(
+                            self._notebook_model(blob, content=False))
+                    else:
+                        contents.append(self._file_model(blob, content=False))
             if path != "":
                 tmpl = "%s/%%s" % self._parse_path(path)[0]
             else:
                 tmpl = "%s"
             _, this = self._parse_path(path)
+            if path == "" and self._root_cache is not None:
+                # the root listing knows which buckets are writable
+                buckets = dict(self._root_cache[1])
+                for folder in folders:
+                    if self.should_list(folder):
+                        contents.append(self._dir_model(
+                            folder, None, content=False,
+                            writable=buckets.get(folder[:-1], True)))
+                folders = []
             for folder in folders:
                 if self.should_list(folder) and folder != this:
-                    contents.append(self.get(
-                        path=tmpl % folder,
-                        content=False)
-                    )
+                    contents.append(self._dir_model(
+                        tmpl % folder, None, content=False))
             model["format"] = "json"
+            if self.prefetcher is not None:
+                self.prefetcher.schedule(path, blobs)
 
         return model
 
-    def _save_notebook(self, path, nb):
+    def _save_notebook(self, path, nb, data=None, generation=None):
         """
         Uploads notebook to GCS.
         :param path: blob path.
         :param nb: :class:`nbformat.notebooknode.NotebookNode` instance.
+        :param data: nb already serialized by _writes_notebook(), if any.
+        :param generation: the generation the blob must have, 0 if it must \
+                           not exist, None to overwrite any.
         :return: created :class:`google.cloud.storage.Blob`.
         """
         bucket_name, bucket_path = self._parse_path(path)
         bucket = self._get_bucket(bucket_name, throw=True)
-        data = nbformat.writes(nb, version=nbformat.NO_CONVERT)
+        if data is None:
+            data = self._writes_notebook(self._store_outputs(path, nb))
         blob = bucket.blob(bucket_path)
-        blob.upload_from_string(data, "application/x-ipynb+json")
+        metadata = {}
+        if self.OUTPUT_REFS_KEY.encode() in data:
+            # copies to other buckets must take the outputs along, the
+            # output sweeps read the digests without downloading the notebook
+            digests = ",".join(sorted(self._output_digests(data)))
+            metadata[self.OUTPUT_REFS_KEY] = \
+                digests if len(digests) <= self.MAX_OUTPUT_REFS else "true"
+        threshold = self.segmented_save_threshold
+        if not (0 < threshold <= len(data) and
+                self._compose_notebook(bucket, blob, data, metadata,
+                                       generation)):
+            if metadata:
+                blob.metadata = metadata
+            blob.upload_from_string(data, "application/x-ipynb+json",
+                                    checksum=self.checksum_type,
+                                    if_generation_match=generation)
+        self._remember_blob(blob)
+        self._cache_blob(blob, data)
+        if self.output_blob_threshold > 0:
+            # the previous version may have used other outputs
+            self._schedule_output_gc(bucket_name)
         return blob
 
-    def _save_file(self, path, content, format):
+    SEGMENTS_KEY = "jgscm_segments"
+    # GCS composes at most this number of objects at once
+    MAX_SEGMENTS = 32
+    # the cells are serialized at this indentation
+    CELL_START_RE = re.compile(b"\n  {\n")
+
+    def _compose_notebook(self, bucket, blob, data, metadata,
+                          generation=None):
+        """
+        Uploads the segments of the notebook which the previous version
+        did not have and composes the blob from them. The blob metadata
+        lists the segments, the segments of the previous version which are
+        no longer used are deleted. The composed blob does not depend on
+        the segments, so losing them costs only the upload.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param blob: :class:`google.cloud.storage.Blob` to write.
+        :param data: serialized notebook.
+        :param metadata: blob metadata to set.
+        :param generation: the generation the blob must have, see \
+                           :meth:`_save_notebook`.
+        :return: False if the notebook cannot be composed, True otherwise.
+        """
+        segments = self._split_segments(data)
+        if len(segments) > self.MAX_SEGMENTS:
+            return False
+        digests = [hashlib.sha256(s).hexdigest() for s in segments]
+        previous = self._lookup_blob(bucket, blob.name, pending=False)
+        previous = set(((previous.metadata or {}).get(self.SEGMENTS_KEY) or
+                        "").split(",") if previous is not None else ())
+        previous.discard("")
+        payloads = dict(zip(digests, segments))
+        missing = {d: p for d, p in payloads.items() if d not in previous}
+        if not previous:
+            # e.g. a checkpoint: the segments are likely to exist
+            missing = self._missing_segments(bucket, missing)
+        self._upload_blobs(bucket, self.segment_prefix, missing,
+                           "application/octet-stream")
+        blob.content_type = "application/x-ipynb+json"
+        blob.metadata = dict(metadata, **{self.SEGMENTS_KEY: ",".join(digests)})
+        sources = [bucket.blob(self.segment_prefix + d) for d in digests]
+        try:
+            blob.compose(sources, if_generation_match=generation)
+        except NotFound:
+            # the segments were deleted by a save or a deletion of a copy of
+            # the notebook, including the ones which were found above
+            self._upload_blobs(bucket, self.segment_prefix,
+                               self._missing_segments(bucket, payloads),
+                               "application/octet-stream")
+            blob.compose(sources, if_generation_match=generation)
+        self._delete_blobs(bucket, [self.segment_prefix + d
+                                    for d in previous.difference(digests)])
+        return True
+
+    def _missing_segments(self, bucket, payloads):
+        """
+        Checks which segments do not exist with a batch request.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param payloads: dict from the segment digest to the bytes.
+        :return: dict with the missing segments of payloads.
+        """
+        digests = list(payloads)
+        statuses = self._batch(bucket.blob(self.segment_prefix + d).reload
+                               for d in digests)
+        return {d: payloads[d] for d, status in zip(digests, statuses)
+                if status != 200}
+
+    def _segment_names(self, blobs):
+        """
+        :param blobs: iterable of :class:`google.cloud.storage.Blob`.
+        :return: set of the names of the segments the blobs were composed \
+                 from, see :meth:`_compose_notebook`.
+        """
+        return {self.segment_prefix + d for blob in blobs
+                for d in ((blob.metadata or {}).get(self.SEGMENTS_KEY) or
+                          "").split(",") if d}
+
+    def _split_segments(self, data):
+        """
+        Splits the serialized notebook into at most MAX_SEGMENTS segments
+        if possible. The segments end at the cells chosen by the checksum
+        of the cell, so editing a cell usually changes one segment.
+        :param data: serialized notebook.
+        :return: list of bytes.
+        """
+        view = memoryview(data)
+        cuts = [m.start() + 1 for m in self.CELL_START_RE.finditer(data)]
+        cuts.append(len(data))
+        checksums = []
+        prev = 0
+        for cut in cuts:
+            checksums.append(zlib.crc32(view[prev:cut]))
+            prev = cut
+        size = self.segment_size
+        while True:
+            # a segment ends at a cell whose checksum is divisible by the
+            # average number of cells per segment, rounded to a power of 2:
+            # the cut does not depend on the previous cuts, so an edit
+            # does not move the boundaries after it
+            mask = (1 << max(int(round(math.log2(
+                size * len(cuts) / len(data)))), 0)) - 1
+            segments = []
+            start = 0
+            for cut, checksum in zip(cuts, checksums):
+                if cut < len(data) and cut - start < 4 * size and \
+                        checksum & mask:
+                    continue
+                while cut - start > 4 * size:
+                    # huge cells are cut at fixed offsets
+                    segments.append(data[start:start + size])
+                    start += size
+                segments.append(data[start:cut])
+                start = cut
+            if len(segments) <= self.MAX_SEGMENTS or size > len(data):
+                return segments
+            size *= 2
+
+    OUTPUT_REFS_KEY = "jgscm_outputs"
+    # the custom metadata of a blob is limited to 8 KiB
+    MAX_OUTPUT_REFS = 4096
+    OUTPUT_REFS_RE = re.compile(
+        b'"' + OUTPUT_REFS_KEY.encode() + b'": \\{([^}]*)\\}')
+    DIGEST_RE = re.compile(b"[0-9a-f]{64}")
+
+    def _store_outputs(self, path, nb):
+        """
+        Uploads the outputs bigger than output_blob_threshold to separate
+        blobs named by the SHA-256 of their contents, unless they already
+        exist, and replaces them with references in the output metadata.
+        :param path: notebook path.
+        :param nb: :class:`nbformat.notebooknode.NotebookNode` instance, \
+                   not modified.
+        :return: the notebook to serialize: a shallow copy with the \
+                 references or nb itself if no output is big enough.
+        """
+        threshold = self.output_blob_threshold
+        if threshold <= 0:
+            return nb
+        payloads = {}
+        cells = []
+        for cell in nb.cells:
+            outputs = None
+            for i, output in enumerate(cell.get("outputs", ())):
+                refs = {}
+                for mime, value in output.get("data", {}).items():
+                    if isinstance(value, str):
+                        size = len(value)
+                    elif isinstance(value, list):
+                        size = sum(len(line) for line in value)
+                    else:
+                        size = threshold
+                    if size < threshold:
+                        continue
+                    payload = json.dumps(value, ensure_ascii=False,
+                                         sort_keys=True).encode("utf-8")
+                    if len(payload) < threshold:
+                        continue
+                    digest = hashlib.sha256(payload).hexdigest()
+                    payloads[digest] = payload
+                    refs[mime] = digest
+                if not refs:
+                    continue
+                if outputs is None:
+                    outputs = list(cell.outputs)
+                output = NotebookNode(output)
+                output.data = NotebookNode(
+                    (mime, ({} if mime.endswith("json") else "")
+                     if mime in refs else value)
+                    for mime, value in output.data.items())
+                output.metadata = NotebookNode(
+                    output.get("metadata", {}), **{self.OUTPUT_REFS_KEY: refs})
+                outputs[i] = output
+            if outputs is not None:
+                cell = NotebookNode(cell)
+                cell.outputs = outputs
+            cells.append(cell)
+        if not payloads:
+            return nb
+        bucket = self._get_bucket(self._parse_path(path)[0], throw=True)
+        self._upload_outputs(bucket, payloads)
+        stored = NotebookNode(nb)
+        stored.cells = cells
+        return stored
+
+    def _upload_outputs(self, bucket, payloads):
+        """
+        Uploads the output blobs which do not exist yet, in parallel.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param payloads: dict from the SHA-256 hex digest to the bytes.
+        """
+        known = self._stored_outputs
+        prefix = self.output_blob_prefix
+        deleting = self._deleting_outputs
+        with self._stored_outputs_cond:
+            self._stored_outputs_cond.wait_for(lambda: not any(
+                (bucket.name, d) in deleting for d in payloads))
+            # the sweeps do not delete the leased outputs, see
+            # collect_outputs()
+            now = time.time()
+            self._output_leases.update(((bucket.name, d), now)
+                                       for d in payloads)
+            digests = [d for d in payloads if (bucket.name, d) not in known]
+        statuses = self._batch(bucket.blob(prefix + d).reload
+                               for d in digests)
+        missing = {}
+        for digest, status in zip(digests, statuses):
+            if status == 404:
+                missing[digest] = payloads[digest]
+            elif status >= 300:
+                raise from_http_status(status, u"Failed to get %s/%s%s" % (
+                    bucket.name, prefix, digest))
+        self._upload_blobs(bucket, prefix, missing, "application/json")
+        with self._stored_outputs_cond:
+            if len(known) > 1 << 20:
+                known.clear()
+            known.update((bucket.name, digest) for digest in digests)
+
+    def _upload_blobs(self, bucket, prefix, payloads, content_type):
+        """
+        Uploads the content-addressed blobs in parallel. Existing blobs are
+        not overwritten.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param prefix: blob name prefix.
+        :param payloads: dict from the blob name suffix to the bytes.
+        :param content_type: content type of the blobs.
+        """
+        def upload(item):
+            try:
+                bucket.blob(prefix + item[0]).upload_from_string(
+                    item[1], content_type, if_generation_match=0,
+                    checksum=self.checksum_type)
+            except PreconditionFailed:
+                pass  # uploaded concurrently
+
+        list(self.io_pool.map(upload, payloads.items()))
+
+    def _load_outputs(self, bucket, nb):
+        """
+        Downloads the outputs which _store_outputs() moved out of the
+        notebook, in parallel, and puts them back.
+        :param bucket: :class:`google.cloud.storage.Bucket` instance with \
+                       the output blobs.
+        :param nb: :class:`nbformat.notebooknode.NotebookNode` instance, \
+                   modified in place.
+        """
+        refs = []
+        for cell in nb.cells:
+            for output in cell.get("outputs", ()):
+                metadata = output.get("metadata", {})
+                for mime, digest in metadata.pop(
+                        self.OUTPUT_REFS_KEY, {}).items():
+                    refs.append((output, mime, digest))
+        if not refs:
+            return
+
+        def download(digest):
+            blob = bucket.blob(self.output_blob_prefix + digest)
+            try:
+                return self._verified(partial(
+                    blob.download_as_bytes, checksum=self.checksum_type),
+                    "%s/%s" % (bucket.name, blob.name))
+            except NotFound:
+                raise web.HTTPError(500, u"Missing notebook output %s/%s%s" % (
+                    bucket.name, self.output_blob_prefix, digest))
+
+        digests = list({digest for _, _, digest in refs})
+        payloads = dict(zip(digests, self.io_pool.map(download, digests)))
+        for output, mime, digest in refs:
+            output.data[mime] = nbformat.from_dict(json.loads(payloads[digest]))
+
+    def _has_stored_outputs(self, blob):
+        """
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: True if _store_outputs() moved some outputs of the notebook \
+                 out of the blob.
+        """
+        return bool((blob.metadata or {}).get(self.OUTPUT_REFS_KEY))
+
+    def _output_digests(self, data):
+        """
+        :param data: serialized notebook.
+        :return: set of the digests of the output blobs it refers to.
+        """
+        return {digest.decode("ascii")
+                for refs in self.OUTPUT_REFS_RE.findall(data)
+                for digest in self.DIGEST_RE.findall(refs)}
+
+    def collect_outputs(self, bucket_name):
+        """
+        Deletes the output blobs which no notebook or checkpoint in the
+        bucket refers to and which are older than output_gc_min_age and
+        have not been used by a save of this server for as long. Lists the
+        whole bucket; the notebooks saved before the digests were kept in
+        the metadata, or with too many outputs for it, are downloaded.
+        The sweeps do not see the saves of the other servers which share
+        the bucket, output_gc_min_age protects them. The saves of this
+        server are not blocked by the deletes, except the ones which use an
+        output being deleted: they wait for its batch and upload it again.
+        :param bucket_name: bucket name.
+        :return: number of the deleted output blobs.
+        """
+        bucket = self._get_bucket(bucket_name, throw=True)
+        prefix = self.output_blob_prefix
+        expired = time.time() - self.output_gc_min_age
+        referenced = set()
+        candidates = []
+        for blob in bucket.list_blobs(
+                fields="items(name,metadata,updated),nextPageToken"):
+            if blob.name.startswith(prefix):
+                if blob.updated is not None and \
+                        blob.updated.timestamp() < expired:
+                    candidates.append(blob.name[len(prefix):])
+                continue
+            refs = (blob.metadata or {}).get(self.OUTPUT_REFS_KEY)
+            if refs == "true":
+                referenced.update(self._output_digests(
+                    self._download_blob(blob)))
+            elif refs:
+                referenced.update(refs.split(","))
+        cond = self._stored_outputs_cond
+        leases = self._output_leases
+
+        def unleased(digests):
+            return [d for d in digests
+                    if leases.get((bucket_name, d), expired) <= expired]
+
+        with cond:
+            garbage = unleased(d for d in candidates if d not in referenced)
+        deleted = 0
+        size = max(self.batch_size, 1)
+        for i in range(0, len(garbage), size):
+            # the saves may have used some outputs since
+            with cond:
+                chunk = unleased(garbage[i:i + size])
+                keys = {(bucket_name, d) for d in chunk}
+                self._deleting_outputs.update(keys)
+                # the saves which wait for the chunk upload it again
+                self._stored_outputs.difference_update(keys)
+            try:
+                self._delete_blobs(bucket, [prefix + d for d in chunk])
+            finally:
+                with cond:
+                    self._deleting_outputs.difference_update(keys)
+                    cond.notify_all()
+            deleted += len(chunk)
+        with cond:
+            for key in [k for k, t in leases.items() if t <= expired]:
+                del leases[key]
+        return deleted
+
+    def _schedule_output_gc(self, bucket_name):
+        """
+        Runs collect_outputs() in the background after output_gc_delay
+        unless it is already scheduled for the bucket.
+        :param bucket_name: bucket name.
+        """
+        delay = self.output_gc_delay
+        if delay < 0:
+            return
+        with self._stored_outputs_cond:
+            if bucket_name in self._output_sweeps:
+                return
+            timer = threading.Timer(delay, self._sweep_outputs,
+                                    (bucket_name,))
+            timer.daemon = True
+            self._output_sweeps[bucket_name] = timer
+        timer.start()
+
+    def _sweep_outputs(self, bucket_name):
+        with self._stored_outputs_cond:
+            # the changes made during the sweep schedule the next one
+            self._output_sweeps.pop(bucket_name, None)
+        try:
+            deleted = self.collect_outputs(bucket_name)
+        except Exception as e:
+            self.log.warning(u"Failed to delete the unused outputs in %s: %s",
+                             bucket_name, e, exc_info=True)
+            return
+        if deleted:
+            self.log.info(u"Deleted %d unused outputs in %s", deleted,
+                          bucket_name)
+
+    def _copy_blob(self, blob, new_bucket, new_name):
+        """
+        Copies the blob. Notebooks with stored outputs are copied to other
+        buckets together with the outputs, this waits for io_pool.
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :param new_bucket: :class:`google.cloud.storage.Bucket` instance.
+        :param new_name: blob name in new_bucket.
+        :return: the new :class:`google.cloud.storage.Blob`.
+        """
+        if blob.bucket.name != new_bucket.name and \
+                self._has_stored_outputs(blob):
+            # the copy is not trusted more than the original, the cells
+            # are not marked
+            nb = self._reads_notebook(self._download_blob(blob))
+            self._load_outputs(blob.bucket, nb)
+            return self._save_notebook(new_bucket.name + "/" + new_name, nb)
+        return blob.bucket.copy_blob(blob, new_bucket, new_name)
+
+    def _save_file(self, path, content, format, generation=None):
         """Uploads content of a generic file to GCS.
         :param: path blob path.
         :param: content file contents string.
         :param: format the description of the input format, can be either
                 "text" or "base64".
+        :param: generation the generation the blob must have, see
+                :meth:`_save_notebook`.
         :return: created :class:`google.cloud.storage.Blob`.
         """
-        bucket_name, bucket_path = self._parse_path(path)
-        bucket = self._get_bucket(bucket_name, throw=True)
+        return self._upload_file(path, self._encode_file(path, content,
+                                                         format), generation)
 
+    @staticmethod
+    def _encode_file(path, content, format):
+        """
+        Converts the contents of a file from the model to bytes.
+        :param path: file path.
+        :param content: file contents string.
+        :param format: "text" or "base64".
+        :return: bytes.
+        """
         if format not in {"text", "base64"}:
             raise web.HTTPError(
                 400,
@@ -822,15 +3098,31 @@ class GoogleStorageContentManager(ContentsManager):
             raise web.HTTPError(
                 400, u"Encoding error saving %s: %s" % (path, e)
             )
+        return bcontent
+
+    def _upload_file(self, path, bcontent, generation=None):
+        """
+        Uploads the bytes of a generic file to GCS.
+        :param path: blob path.
+        :param bcontent: file contents bytes.
+        :param generation: the generation the blob must have, see \
+                           :meth:`_save_notebook`.
+        :return: created :class:`google.cloud.storage.Blob`.
+        """
+        bucket_name, bucket_path = self._parse_path(path)
+        bucket = self._get_bucket(bucket_name, throw=True)
         blob = bucket.blob(bucket_path)
-        blob.upload_from_string(bcontent)
+        blob.upload_from_string(bcontent, checksum=self.checksum_type,
+                                if_generation_match=generation)
+        self._remember_blob(blob)
+        self._cache_blob(blob, bcontent)
         return blob
 
     def _save_directory(self, path, model):
         """Creates a directory in GCS."""
         exists, obj = self._fetch(path)
         if exists:
-            if isinstance(obj, Blob):
+            if _is_blob(obj):
                 raise web.HTTPError(400, u"Not a directory: %s" % path)
             else:
                 self.log.debug("Directory %r already exists", path)
@@ -838,9 +3130,31 @@ class GoogleStorageContentManager(ContentsManager):
         bucket_name, bucket_path = self._parse_path(path)
         if bucket_path == "":
             self.client.create_bucket(bucket_name)
+            self._root_cache = None
+            self._inaccessible_buckets.pop(bucket_name, None)
         else:
             bucket = self._get_bucket(bucket_name, throw=True)
-            bucket.blob(bucket_path).upload_from_string(
+            blob = bucket.blob(bucket_path)
+            blob.upload_from_string(
                 b"", content_type="application/x-directory")
+            self._remember_blob(blob)
 
     debug_args = staticmethod(debug_args)
+    request_scoped = staticmethod(request_scoped)
+
+
+def _jupyter_server_extension_paths():
+    return [{"module": "jgscm"}]
+
+
+def load_jupyter_server_extension(nbapp):
+    """
+    Registers the handlers from :mod:`jgscm.handlers` in the notebook server.
+    :param nbapp: :class:`notebook.notebookapp.NotebookApp` instance.
+    """
+    from notebook.utils import url_path_join
+    from jgscm.handlers import default_handlers
+    web_app = nbapp.web_app
+    base_url = web_app.settings["base_url"]
+    web_app.add_handlers(".*$", [(url_path_join(base_url, pattern), handler)
+                                 for pattern, handler in default_handlers])
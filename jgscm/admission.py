@@ -0,0 +1,122 @@
+"""
+Admission control for the memory of the concurrent transfers. Every read or
+write of a whole file reserves an estimate of the memory which it needs and
+waits while the reservations of the other transfers exceed the budget.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import time
+
+from tornado import web
+
+
+class MemoryBudget(object):
+    """
+    Byte-weighted semaphore.
+    """
+
+    def __init__(self, limit, timeout):
+        """
+        :param limit: maximum total size of the reservations in bytes.
+        :param timeout: maximum number of seconds to wait for the memory.
+        """
+        self.limit = limit
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._used = 0
+        self._waiting = 0
+        # "admitted", "queued", "rejected", "too_large" and "peak" bytes
+        self.stats = Counter()
+
+    @property
+    def usage(self):
+        """
+        :return: dict with the reserved bytes, the limit and the number of \
+                 the waiting transfers.
+        """
+        with self._cond:
+            return {"used": self._used, "limit": self.limit,
+                    "waiting": self._waiting}
+
+    @contextmanager
+    def reserve(self, size, what=""):
+        """
+        Reserves the memory for the duration of the with block.
+        :param size: number of bytes to reserve.
+        :param what: description of the transfer for the error messages.
+        :raise tornado.web.HTTPError: 413 if size exceeds the limit, 503 if \
+                                      the memory is not freed in time.
+        """
+        self.acquire(size, what)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def acquire(self, size, what=""):
+        if size > self.limit:
+            with self._cond:
+                self.stats["too_large"] += 1
+            raise web.HTTPError(
+                413, u"%s is too large to transfer at once: it needs %d bytes"
+                     u" of memory, the limit is %d" % (what, size, self.limit))
+        deadline = time.time() + self.timeout
+        with self._cond:
+            if self._used + size > self.limit:
+                self.stats["queued"] += 1
+                self._waiting += 1
+                try:
+                    while self._used + size > self.limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.stats["rejected"] += 1
+                            raise web.HTTPError(
+                                503, u"The server is busy transferring other "
+                                     u"files, retry %s later" % what)
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._used += size
+            self.stats["admitted"] += 1
+            self.stats["peak"] = max(self.stats["peak"], self._used)
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+
+@contextmanager
+def unreserved():
+    """
+    The context manager to use instead of :meth:`MemoryBudget.reserve` when
+    nothing is reserved.
+    """
+    yield
+
+
+def json_size(value):
+    """
+    Estimates the size of the JSON of the parsed value without serializing
+    it: every value is counted with the quotes, the separators and the
+    indentation around it and the strings at their length.
+    :param value: dict, list or scalar.
+    :return: number of bytes.
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            size += len(value) + 8
+        elif isinstance(value, dict):
+            size += 8
+            stack.extend(value)
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            size += 8
+            stack.extend(value)
+        else:
+            size += 8
+    return size
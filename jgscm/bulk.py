@@ -0,0 +1,56 @@
+"""
+Bulk operations on the files and directories selected together: delete, move
+and copy. The selection is reduced to the topmost paths, which are resolved
+with one listing per parent directory instead of a lookup per path.
+"""
+from collections import namedtuple
+
+
+ACTIONS = ("delete", "move", "copy")
+
+BulkItem = namedtuple("BulkItem", ("path", "bucket", "name", "parent"))
+
+
+def plan_paths(paths):
+    """
+    Drops the duplicate paths and the paths inside the other selected
+    directories: deleting or moving a directory takes its contents along.
+    :param paths: list of the selected paths.
+    :return: tuple(sorted list of the topmost paths, dict from every \
+             selected path to the topmost path which covers it).
+    """
+    roots = []
+    cover = {}
+    # a directory sorts right before its contents when "/" sorts first
+    for path in sorted({p.strip("/") for p in paths},
+                       key=lambda p: p.split("/")):
+        if roots and path.startswith(roots[-1] + "/"):
+            cover[path] = roots[-1]
+        else:
+            roots.append(path)
+            cover[path] = path
+    return roots, cover
+
+
+def group_by_parent(items):
+    """
+    :param items: iterable of :class:`BulkItem`.
+    :return: dict from tuple(bucket name, parent prefix) to the list of \
+             the items in that directory.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault((item.bucket, item.parent), []).append(item)
+    return groups
+
+
+def is_checkpoint(name, stem, ext):
+    """
+    :param name: blob name inside the checkpoint directory.
+    :param stem: file name without the extension.
+    :param ext: file name extension.
+    :return: True if the blob is a checkpoint of the file: \
+             "<stem>-<uuid4><ext>".
+    """
+    return len(name) == len(stem) + 37 + len(ext) and \
+        name.startswith(stem + "-") and name.endswith(ext)
@@ -0,0 +1,138 @@
+"""
+Persistent local cache of the blob contents. The files are named by the blob
+path and generation, so a cached file never changes: a new version of a blob
+has a new generation. The files are written atomically and the least
+recently used ones are deleted when the cache grows too big, which makes the
+cache safe to share between the processes on the same host.
+"""
+import errno
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+
+class BlobCache(object):
+    """
+    The contents of the blobs by bucket name, blob name and generation.
+    """
+
+    SUFFIX = ".blob"
+    # the eviction deletes the files until the cache is this much smaller
+    LOW_WATERMARK = 0.9
+    # the temporary files older than this were left by crashed processes
+    STALE_TMP_AGE = 3600
+
+    def __init__(self, directory, max_size, log):
+        """
+        :param directory: local directory to keep the files in.
+        :param max_size: maximum total size of the files in bytes.
+        :param log: :class:`logging.Logger` instance.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.log = log
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # estimated total size, other processes may add files
+        self._size = sum(size for _, size, _ in self._scan())
+
+    def get(self, bucket, name, generation, size):
+        """
+        :param bucket: bucket name.
+        :param name: blob name.
+        :param generation: blob generation.
+        :param size: blob size to check the cached file against.
+        :return: the cached contents or None.
+        """
+        file_name = self._file_name(bucket, name, generation)
+        try:
+            with open(file_name, "rb") as fin:
+                data = fin.read()
+        except (IOError, OSError):
+            return None
+        if len(data) != size:
+            self.log.warning("Dropped the corrupted cache file %s", file_name)
+            self._remove(file_name)
+            return None
+        try:
+            # the modification time orders the files for the eviction
+            os.utime(file_name, None)
+        except OSError:
+            pass  # evicted meanwhile
+        return data
+
+    def put(self, bucket, name, generation, data):
+        """
+        Adds the contents of a blob to the cache.
+        :param bucket: bucket name.
+        :param name: blob name.
+        :param generation: blob generation.
+        :param data: blob contents bytes.
+        """
+        if len(data) > self.max_size * (1 - self.LOW_WATERMARK):
+            return
+        file_name = self._file_name(bucket, name, generation)
+        tmp = "%s.%s.tmp" % (file_name, uuid.uuid4().hex)
+        try:
+            with open(tmp, "wb") as fout:
+                fout.write(data)
+            os.replace(tmp, file_name)
+        except (IOError, OSError) as e:
+            self.log.warning("Failed to cache %s/%s: %s", bucket, name, e)
+            self._remove(tmp)
+            return
+        with self._lock:
+            self._size += len(data)
+            if self._size <= self.max_size:
+                return
+            self._evict()
+
+    def _file_name(self, bucket, name, generation):
+        key = "%s/%s#%s" % (bucket, name, generation)
+        return os.path.join(self.directory, hashlib.sha256(
+            key.encode("utf-8")).hexdigest() + self.SUFFIX)
+
+    def _scan(self):
+        """
+        :return: list of tuple(modification time, size, file name).
+        """
+        files = []
+        stale = time.time() - self.STALE_TMP_AGE
+        for name in os.listdir(self.directory):
+            file_name = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue  # evicted by another process
+            if name.endswith(self.SUFFIX):
+                files.append((stat.st_mtime, stat.st_size, file_name))
+            elif name.endswith(".tmp") and stat.st_mtime < stale:
+                self._remove(file_name)
+        return files
+
+    def _evict(self):
+        files = sorted(self._scan())
+        size = sum(s for _, s, _ in files)
+        limit = self.max_size * self.LOW_WATERMARK
+        evicted = 0
+        for _, file_size, file_name in files:
+            if size <= limit:
+                break
+            self._remove(file_name)
+            size -= file_size
+            evicted += 1
+        self._size = size
+        self.log.debug("Evicted %d files from %s", evicted, self.directory)
+
+    @staticmethod
+    def _remove(file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
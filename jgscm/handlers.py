@@ -0,0 +1,313 @@
+"""
+Tornado handlers which extend the Jupyter contents API for the files in
+Google Cloud Storage. Enable them with
+
+    jupyter serverextension enable --py jgscm
+"""
+from functools import partial
+import json
+import mimetypes
+import re
+
+from notebook.base.handlers import APIHandler, IPythonHandler, path_regex
+from notebook.services.contents.handlers import validate_model
+from notebook.utils import maybe_future
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+try:
+    from jupyter_client.jsonutil import json_default
+except ImportError:
+    from jupyter_client.jsonutil import date_default as json_default
+
+from jgscm.integrity import StreamChecksum
+
+
+class RangeHandler(APIHandler):
+    """
+    Returns the model of a part of a file: GET /api/gcs/range/<path> accepts
+    the "start", "end" and "lines" query arguments besides "format". See
+    :meth:`jgscm.GoogleStorageContentManager.get`. Read only, the files are
+    changed through the contents API.
+    """
+
+    def _get_int_argument(self, name):
+        value = self.get_query_argument(name, default=None)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise web.HTTPError(400, u"%s must be an integer: %r" % (
+                name, value))
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, path=""):
+        path = path or ""
+        cm = self.contents_manager
+        format = self.get_query_argument("format", default=None)
+        if format not in {None, "text", "base64"}:
+            raise web.HTTPError(400, u"Format %r is invalid" % format)
+        if cm.is_hidden(path) and not cm.allow_hidden:
+            raise web.HTTPError(
+                404, u"file or directory %r does not exist" % path)
+        model = yield maybe_future(cm.get(
+            path=path, type="file", format=format,
+            start=self._get_int_argument("start"),
+            end=self._get_int_argument("end"),
+            lines=self._get_int_argument("lines")))
+        validate_model(model, expect_content=True)
+        self.set_header("Last-Modified", model["last_modified"])
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(model, default=json_default))
+
+
+class StreamingFilesHandler(IPythonHandler):
+    """
+    Serves the raw bytes of a file: GET /gcs/files/<path> is the same as
+    /files/<path>, but streams the blob with ranged downloads instead of
+    loading the whole file into memory. Supports Range and If-None-Match.
+    The notebooks with the outputs stored in separate blobs are put together
+    in memory.
+    """
+
+    RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    @property
+    def content_security_policy(self):
+        # In case we're serving HTML/SVG, confine any Javascript to a unique
+        # origin so it can't interact with the notebook server.
+        return super().content_security_policy + "; sandbox allow-scripts"
+
+    @web.authenticated
+    def head(self, path):
+        self.check_xsrf_cookie()
+        return self.get(path, include_body=False)
+
+    @web.authenticated
+    async def get(self, path, include_body=True):
+        # /files/ requests must originate from the same site
+        self.check_xsrf_cookie()
+        cm = self.contents_manager
+        path = path.strip("/")
+        loop = IOLoop.current()
+        blob = await loop.run_in_executor(
+            cm.io_pool, partial(self._fetch, cm, path))
+        name = path.rsplit("/", 1)[-1]
+        etag = '"%s"' % blob.etag
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("ETag", etag)
+        if blob.updated is not None:
+            self.set_header("Last-Modified", blob.updated)
+        if self.get_argument("download", False):
+            self.set_attachment_header(name)
+        self.set_header("Content-Type", self._content_type(blob, name))
+        if self._not_modified(etag):
+            self.set_status(304)
+            self.clear_header("Content-Type")
+            return
+        data = None
+        if cm._has_stored_outputs(blob):
+            # loading the outputs fans out to io_pool, it must not wait
+            # inside it
+            data = await loop.run_in_executor(
+                None, cm._download_file, blob)
+            size = len(data)
+        else:
+            size = blob.size or 0
+        start, end = self._range(size)
+        if start is None:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            self.clear_header("Content-Type")
+            return
+        self.set_header("Content-Length", end - start)
+        if not include_body:
+            return
+        if data is not None:
+            self.write(data[start:end])
+            return
+        # the chunks are ranged downloads which the library does not verify
+        checksum = StreamChecksum.create(blob, cm.checksum_type) \
+            if start == 0 and end == size else None
+        while start < end:
+            chunk = await loop.run_in_executor(cm.io_pool, partial(
+                blob.download_as_bytes, start=start,
+                end=min(start + cm.stream_chunk_size, end) - 1))
+            if not chunk:
+                break
+            start += len(chunk)
+            if checksum is not None:
+                checksum.update(chunk)
+                if start >= end and not checksum.matches():
+                    # the headers are sent, failing drops the connection
+                    # before the last chunk and the client sees the file
+                    # is incomplete
+                    raise web.HTTPError(
+                        502, u"%s was corrupted in transit: %s %s, expected "
+                             u"%s" % (path, checksum.checksum, checksum.actual,
+                                      checksum.expected))
+            self.write(chunk)
+            del chunk
+            # wait until the chunk is sent to keep the memory bounded
+            await self.flush()
+
+    @staticmethod
+    def _fetch(cm, path):
+        if cm.is_hidden(path) and not cm.allow_hidden:
+            raise web.HTTPError(404)
+        return cm._fetch_file(path)
+
+    @staticmethod
+    def _content_type(blob, name):
+        if name.lower().endswith(".ipynb"):
+            return "application/x-ipynb+json"
+        mime = blob.content_type
+        if not mime or mime in ("application/octet-stream", "text/plain"):
+            mime = mimetypes.guess_type(name)[0] or mime or \
+                "application/octet-stream"
+        if mime == "text/plain":
+            mime += "; charset=UTF-8"
+        return mime
+
+    def _not_modified(self, etag):
+        header = self.request.headers.get("If-None-Match")
+        if not header:
+            return False
+        if header.strip() == "*":
+            return True
+        tags = [t.strip() for t in header.split(",")]
+        return any((t[2:] if t.startswith("W/") else t) == etag
+                   for t in tags)
+
+    def _range(self, size):
+        """
+        Parses the Range header and sets the partial content status.
+        :param size: file size.
+        :return: tuple(start, end), end is exclusive. tuple(None, None) if \
+                 the range is not satisfiable.
+        """
+        header = self.request.headers.get("Range")
+        match = self.RANGE_RE.match(header.strip()) if header else None
+        if match is None or match.groups() == ("", ""):
+            # no range or an unsupported one: serve the whole file
+            return 0, size
+        first, last = match.groups()
+        if first == "":
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+        if start >= size or start >= end:
+            return None, None
+        self.set_status(206)
+        self.set_header("Content-Range",
+                        "bytes %d-%d/%d" % (start, end - 1, size))
+        return start, end
+
+
+class SearchHandler(APIHandler):
+    """
+    Finds the files by name under a directory: GET /api/gcs/search/<path>
+    with the "q" query argument, see
+    :meth:`jgscm.GoogleStorageContentManager.search`. Streams one model
+    without content per line as the pages are listed; the last line is
+    {"scanned": <number of listed objects>, "truncated": <bool>}.
+    """
+
+    @web.authenticated
+    async def get(self, path=""):
+        cm = self.contents_manager
+        path = (path or "").strip("/")
+        if cm.is_hidden(path) and not cm.allow_hidden:
+            raise web.HTTPError(
+                404, u"file or directory %r does not exist" % path)
+        query = self.get_query_argument("q", default="")
+        loop = IOLoop.current()
+        # lists nothing until the first page is requested
+        pages = cm.search(path, query)
+        # replaces the APIHandler default; every page is flushed, so the
+        # header is sent before APIHandler.finish() would set JSON again
+        self.set_header("Content-Type", "application/x-ndjson")
+        while True:
+            page = await loop.run_in_executor(cm.io_pool, next, pages, None)
+            if page is None:
+                break
+            for model in page.models:
+                self.write(json.dumps(model, default=json_default) + "\n")
+            if not page.models:
+                self.write(json.dumps({"scanned": page.scanned,
+                                       "truncated": page.truncated}) + "\n")
+            await self.flush()
+
+
+class UsageHandler(APIHandler):
+    """
+    Reports the storage usage of a directory: GET /api/gcs/usage/<path>, see
+    :meth:`jgscm.GoogleStorageContentManager.usage`.
+    """
+
+    @web.authenticated
+    async def get(self, path=""):
+        cm = self.contents_manager
+        path = (path or "").strip("/")
+        if cm.is_hidden(path) and not cm.allow_hidden:
+            raise web.HTTPError(
+                404, u"file or directory %r does not exist" % path)
+        # usage() fans out to io_pool itself, it must not wait inside it
+        usage = await IOLoop.current().run_in_executor(None, cm.usage, path)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(usage, default=json_default))
+
+
+class BulkHandler(APIHandler):
+    """
+    Deletes, moves or copies many files and directories at once: POST
+    /api/gcs/bulk with {"action": "delete" | "move" | "copy", "paths": [...],
+    "destination": <directory>}, see
+    :meth:`jgscm.GoogleStorageContentManager.bulk`. Responds with
+    {"results": [{"path", "status", "message" or "new_path"}, ...]}.
+    """
+
+    @web.authenticated
+    async def post(self):
+        try:
+            body = json.loads(self.request.body.decode("utf-8"))
+        except ValueError:
+            raise web.HTTPError(400, u"Invalid JSON in the request body")
+        if not isinstance(body, dict) or \
+                not isinstance(body.get("paths"), list) or \
+                not all(isinstance(p, str) for p in body["paths"]):
+            raise web.HTTPError(400, u"\"paths\" must be a list of strings")
+        cm = self.contents_manager
+        # bulk() fans out to io_pool itself, it must not wait inside it
+        results = await IOLoop.current().run_in_executor(
+            None, cm.bulk, body.get("action"), body["paths"],
+            body.get("destination"))
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"results": results}))
+
+
+class TraceHandler(APIHandler):
+    """
+    Reports the GCS calls by request type: GET /api/gcs/trace, see
+    :meth:`jgscm.trace.Tracer.summary`.
+    """
+
+    @web.authenticated
+    def get(self):
+        tracer = self.contents_manager.tracer
+        if tracer is None:
+            raise web.HTTPError(404, u"The request tracing is disabled")
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(tracer.summary()))
+
+
+default_handlers = [
+    (r"/api/gcs/bulk", BulkHandler),
+    (r"/api/gcs/range%s" % path_regex, RangeHandler),
+    (r"/api/gcs/search%s" % path_regex, SearchHandler),
+    (r"/api/gcs/trace", TraceHandler),
+    (r"/api/gcs/usage%s" % path_regex, UsageHandler),
+    (r"/gcs/files/(.*)", StreamingFilesHandler),
+]
@@ -0,0 +1,100 @@
+"""
+Hedged requests: if an idempotent GCS call has not answered within the
+usual time, the same call is issued again and the first answer wins. This
+cuts the tail latency caused by the occasional slow response at the cost of
+a bounded number of duplicate requests.
+"""
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import threading
+import time
+
+from jgscm.trace import ContextExecutor
+
+
+class Hedger(object):
+    """
+    Issues the calls and tracks their latencies by kind, e.g. "blob".
+    """
+
+    # the number of latencies to calculate the percentile from
+    WINDOW = 256
+    # do not hedge until this number of latencies is known
+    MIN_SAMPLES = 16
+
+    def __init__(self, percentile, min_delay, max_rate, threads=16):
+        """
+        :param percentile: the call is hedged after this percentile of the \
+                           latencies of the recent calls of the same kind.
+        :param min_delay: minimum number of seconds to wait before hedging.
+        :param max_rate: maximum fraction of the calls to hedge.
+        :param threads: maximum number of parallel calls.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self._pool = ContextExecutor(max_workers=threads,
+                                     thread_name_prefix="jgscm-hedge")
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=self.WINDOW))
+        # "<kind>.calls", "<kind>.hedged" and "<kind>.wins" - the number of
+        # the hedged calls which the duplicate answered first
+        self.stats = Counter()
+
+    def threshold(self, kind):
+        """
+        :param kind: call kind.
+        :return: number of seconds after which the call is hedged or None \
+                 if it is not known yet.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies[kind])
+        if len(latencies) < self.MIN_SAMPLES:
+            return None
+        index = min(int(len(latencies) * self.percentile / 100),
+                    len(latencies) - 1)
+        return max(latencies[index], self.min_delay)
+
+    def call(self, kind, fn):
+        """
+        Calls fn, and once more in parallel if it takes longer than usual.
+        :param kind: call kind, the latencies are tracked per kind.
+        :param fn: idempotent callable without arguments.
+        :return: the result of the first successful call.
+        """
+        start = time.time()
+        delay = self.threshold(kind)
+        with self._lock:
+            self.stats[kind + ".calls"] += 1
+            if self.stats[kind + ".hedged"] >= \
+                    self.max_rate * self.stats[kind + ".calls"]:
+                delay = None
+        if delay is None:
+            result = fn()
+            self._record(kind, time.time() - start)
+            return result
+        first = self._pool.submit(fn)
+        if wait([first], delay).done:
+            result = first.result()
+            self._record(kind, time.time() - start)
+            return result
+        with self._lock:
+            self.stats[kind + ".hedged"] += 1
+        pending = {first, self._pool.submit(fn)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                if future is not first:
+                    with self._lock:
+                        self.stats[kind + ".wins"] += 1
+                self._record(kind, time.time() - start)
+                return future.result()
+        raise error
+
+    def _record(self, kind, latency):
+        with self._lock:
+            self._latencies[kind].append(latency)
@@ -0,0 +1,222 @@
+"""
+Index of the directory listings. A listing is answered from the index while
+it is fresh; a stale one is refreshed by a listing which asks only for the
+names and generations, and only the changed objects are fetched in full.
+Change notifications, e.g. forwarded from Pub/Sub, update the entries in
+place. The entries may be persisted to a local directory to survive restarts.
+"""
+from collections import Counter
+import errno
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+
+class DirectoryEntry(object):
+    """
+    The listing of one directory.
+    """
+
+    def __init__(self, files, folders, updated, stale=False):
+        """
+        :param files: dict from the blob name to the blob resource.
+        :param folders: list of the subdirectory prefixes.
+        :param updated: time of the last listing.
+        :param stale: True if the entry must be checked before use.
+        """
+        self.files = files
+        self.folders = folders
+        self.updated = updated
+        self.stale = stale
+
+    def to_json(self, bucket, prefix):
+        return {"bucket": bucket, "prefix": prefix, "files": self.files,
+                "folders": self.folders, "updated": self.updated}
+
+
+class PrefixIndex(object):
+    """
+    The directory listings by bucket name and prefix.
+    """
+
+    SUFFIX = ".json"
+    DELETE_EVENTS = ("OBJECT_DELETE", "OBJECT_ARCHIVE")
+
+    def __init__(self, ttl, directory, log, max_entries=4096):
+        """
+        :param ttl: number of seconds to use an entry without checking GCS.
+        :param directory: local directory to persist the entries in or "".
+        :param log: :class:`logging.Logger` instance.
+        :param max_entries: maximum number of the directories to keep.
+        """
+        self.ttl = ttl
+        self.directory = directory
+        self.log = log
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # tuple(bucket name, prefix) -> DirectoryEntry
+        self._entries = {}
+        # tuple(attributes, resource) of the change notifications
+        self.changes = queue.Queue()
+        # "hits", "refreshes", "listings", "changed", "notifications"
+        self.stats = Counter()
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def notify(self, attributes, resource=None):
+        """
+        Queues a change notification in the format of the GCS Pub/Sub
+        notifications. It is applied before the next lookup.
+        :param attributes: dict with "eventType", "bucketId", "objectId" \
+                           and "objectGeneration".
+        :param resource: the object resource, the message payload.
+        """
+        self.changes.put((attributes, resource))
+
+    def count(self, stat, value=1):
+        """
+        :param stat: name of the statistic.
+        :param value: the increment.
+        """
+        with self._lock:
+            self.stats[stat] += value
+
+    def get(self, bucket, prefix):
+        """
+        :param bucket: bucket name.
+        :param prefix: directory blob name prefix.
+        :return: tuple(:class:`DirectoryEntry` or None, True if it is fresh).
+        """
+        self._apply_changes()
+        key = (bucket, prefix)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.directory:
+            entry = self._load(bucket, prefix)
+            if entry is not None:
+                with self._lock:
+                    entry = self._entries.setdefault(key, entry)
+        if entry is None:
+            return None, False
+        fresh = not entry.stale and time.time() - entry.updated < self.ttl
+        if fresh:
+            with self._lock:
+                self.stats["hits"] += 1
+        return entry, fresh
+
+    def put(self, bucket, prefix, files, folders):
+        """
+        Stores the fresh listing of the directory.
+        :param bucket: bucket name.
+        :param prefix: directory blob name prefix.
+        :param files: dict from the blob name to the blob resource.
+        :param folders: list of the subdirectory prefixes.
+        :return: the stored :class:`DirectoryEntry`.
+        """
+        entry = DirectoryEntry(files, sorted(folders), time.time())
+        with self._lock:
+            if len(self._entries) >= self.max_entries and \
+                    (bucket, prefix) not in self._entries:
+                del self._entries[min(
+                    self._entries, key=lambda k: self._entries[k].updated)]
+            self._entries[(bucket, prefix)] = entry
+        if self.directory:
+            self._save(bucket, prefix, entry)
+        return entry
+
+    def invalidate(self, bucket, name):
+        """
+        Marks stale the directories which may list the changed blob: its
+        ancestors, which may get a new subdirectory, and its descendants.
+        :param bucket: bucket name.
+        :param name: changed blob name or prefix.
+        """
+        with self._lock:
+            for (b, prefix), entry in self._entries.items():
+                if b == bucket and (name.startswith(prefix) or
+                                    prefix.startswith(name)):
+                    entry.stale = True
+
+    def _apply_changes(self):
+        while True:
+            try:
+                attributes, resource = self.changes.get_nowait()
+            except queue.Empty:
+                return
+            bucket = attributes.get("bucketId")
+            name = attributes.get("objectId")
+            if not bucket or not name:
+                continue
+            event = attributes.get("eventType")
+            generation = attributes.get("objectGeneration")
+            prefix = name[:name.rfind("/") + 1]
+            with self._lock:
+                self.stats["notifications"] += 1
+                entry = self._entries.get((bucket, prefix))
+                if entry is not None:
+                    # copy on write, the readers do not lock
+                    files = dict(entry.files)
+                    known = files.get(name)
+                    if event in self.DELETE_EVENTS:
+                        # a delete of an older generation is not news
+                        if known is not None and (
+                                generation is None or
+                                str(known.get("generation")) == str(generation)):
+                            del files[name]
+                    elif resource is not None:
+                        files[name] = resource
+                    else:
+                        entry.stale = True
+                    entry.files = files
+                # the ancestors may get or lose a subdirectory
+                for (b, p), other in self._entries.items():
+                    if b == bucket and p != prefix and prefix.startswith(p):
+                        folder = prefix[:prefix.index("/", len(p)) + 1]
+                        if event in self.DELETE_EVENTS:
+                            other.stale = True
+                        elif folder not in other.folders:
+                            other.folders = sorted(other.folders + [folder])
+
+    def _file_name(self, bucket, prefix):
+        return os.path.join(self.directory, hashlib.sha256(
+            ("%s/%s" % (bucket, prefix)).encode("utf-8")).hexdigest() +
+            self.SUFFIX)
+
+    def _load(self, bucket, prefix):
+        file_name = self._file_name(bucket, prefix)
+        try:
+            with open(file_name, "rb") as fin:
+                data = json.loads(fin.read().decode("utf-8"))
+        except (IOError, OSError):
+            return None
+        except ValueError as e:
+            self.log.warning("Dropped the corrupted index file %s: %s",
+                             file_name, e)
+            return None
+        if data.get("bucket") != bucket or data.get("prefix") != prefix:
+            return None
+        return DirectoryEntry(data["files"], data["folders"], data["updated"])
+
+    def _save(self, bucket, prefix, entry):
+        file_name = self._file_name(bucket, prefix)
+        tmp = "%s.%s.tmp" % (file_name, uuid.uuid4().hex)
+        try:
+            with open(tmp, "wb") as fout:
+                fout.write(json.dumps(entry.to_json(bucket, prefix))
+                           .encode("utf-8"))
+            os.replace(tmp, file_name)
+        except (IOError, OSError) as e:
+            self.log.warning("Failed to persist the index of %s/%s: %s",
+                             bucket, prefix, e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
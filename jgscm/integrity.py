@@ -0,0 +1,78 @@
+"""
+Integrity checks of the transferred bytes. The whole-object uploads and
+downloads are checked by google-cloud-storage, which hashes the data as it
+streams; the ranged downloads are not, so the files which are streamed in
+chunks are hashed here while the chunks pass through.
+"""
+import base64
+import hashlib
+
+
+def checksum_type(checksum):
+    """
+    :param checksum: "crc32c", "md5", "auto" or "" to disable.
+    :return: "crc32c", "md5" or None for google-cloud-storage. "auto" is \
+             crc32c if the C extension of google-crc32c is installed - the \
+             pure Python one is too slow - and md5 otherwise.
+    """
+    if checksum != "auto":
+        return checksum or None
+    try:
+        import google_crc32c
+    except ImportError:
+        return "md5"
+    return "crc32c" if google_crc32c.implementation == "c" else "md5"
+
+
+class StreamChecksum(object):
+    """
+    Checksum of a blob which is downloaded in chunks.
+    """
+
+    def __init__(self, blob, checksum):
+        """
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :param checksum: "crc32c" or "md5".
+        """
+        self.checksum = checksum
+        if checksum == "crc32c":
+            import google_crc32c
+            self.expected = blob.crc32c
+            self._hash = google_crc32c.Checksum()
+        else:
+            # composite objects do not have MD5
+            self.expected = blob.md5_hash
+            self._hash = hashlib.md5()
+
+    @classmethod
+    def create(cls, blob, checksum):
+        """
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :param checksum: "crc32c", "md5" or None.
+        :return: :class:`StreamChecksum` or None if the blob cannot be \
+                 verified.
+        """
+        if checksum is None:
+            return None
+        verifier = cls(blob, checksum)
+        return verifier if verifier.expected else None
+
+    def update(self, chunk):
+        """
+        :param chunk: the next downloaded bytes.
+        """
+        self._hash.update(chunk)
+
+    @property
+    def actual(self):
+        """
+        :return: base64 encoded digest of the bytes seen so far, the same \
+                 format as the blob metadata.
+        """
+        return base64.b64encode(self._hash.digest()).decode("ascii")
+
+    def matches(self):
+        """
+        :return: True if the downloaded bytes match the blob metadata.
+        """
+        return self.actual == self.expected
@@ -0,0 +1,274 @@
+"""
+Write-behind journal of the saved files. A save is written to a local
+directory and fsync()-ed, a background thread uploads the latest version of
+each file to GCS later and removes it from the journal. The files left in the
+journal after a crash are uploaded when the journal is opened again.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from google.cloud.storage import Blob
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+PendingWrite = namedtuple("PendingWrite", ("path", "type", "data", "time",
+                                           "seq"))
+
+
+class PendingBlob(Blob):
+    """
+    :class:`google.cloud.storage.Blob` of a file which has not been uploaded
+    yet. Downloads return the journaled contents.
+    """
+
+    def __init__(self, bucket, name, entry):
+        super(PendingBlob, self).__init__(name, bucket)
+        self.entry = entry
+        updated = datetime.fromtimestamp(entry.time, timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%S.%fZ")
+        self._properties.update({
+            "size": str(len(entry.data)),
+            "updated": updated,
+            "timeCreated": updated,
+            "etag": "pending-%d" % entry.seq,
+            "contentType": "application/x-ipynb+json"
+                           if entry.type == "notebook"
+                           else "application/octet-stream",
+        })
+
+    def download_as_bytes(self, client=None, start=None, end=None, **kwargs):
+        return self.entry.data[start or 0:end + 1 if end is not None else None]
+
+
+class WriteJournal(object):
+    """
+    The journaled files by their full GCS path ("bucket/name").
+    """
+
+    SUFFIX = ".write"
+    MAX_RETRY_DELAY = 300
+
+    def __init__(self, directory, upload, delay, log):
+        """
+        Opens the journal and starts uploading the recovered files.
+        :param directory: local directory to keep the journal in. Only one \
+                          process may use it.
+        :param upload: callable which uploads a :class:`PendingWrite`.
+        :param delay: number of seconds to wait for the next versions of a \
+                      saved file before uploading it.
+        :param log: :class:`logging.Logger` instance.
+        """
+        self.directory = directory
+        self.delay = delay
+        self.log = log
+        self._upload = upload
+        self._cond = threading.Condition()
+        self._entries = {}
+        # path -> time when to upload
+        self._due = {}
+        # path -> number of failed uploads in a row
+        self._failures = {}
+        # paths which are being uploaded
+        self._busy = set()
+        self._seq = 0
+        self._closed = False
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._lock_fd = self._lock()
+        self._recover()
+        self._thread = threading.Thread(
+            target=self._run, name="jgscm-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, path, type, data):
+        """
+        Writes the new version of the file durably and schedules the upload.
+        :param path: full GCS path.
+        :param type: "notebook" or "file".
+        :param data: file contents bytes.
+        :return: :class:`PendingWrite` instance.
+        """
+        now = time.time()
+        name = self._file_name(path)
+        tmp = "%s.%s.tmp" % (name, uuid.uuid4().hex)
+        with open(tmp, "wb") as fout:
+            fout.write(json.dumps({"path": path, "type": type, "time": now})
+                       .encode("utf-8") + b"\n")
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        with self._cond:
+            os.replace(tmp, name)
+            self._seq += 1
+            entry = PendingWrite(path, type, data, now, self._seq)
+            self._entries[path] = entry
+            # later versions do not postpone the upload
+            self._due.setdefault(path, now + self.delay)
+            self._cond.notify_all()
+        self._sync_directory()
+        return entry
+
+    def get(self, path):
+        """
+        :param path: full GCS path.
+        :return: :class:`PendingWrite` of the file or None.
+        """
+        with self._cond:
+            return self._entries.get(path)
+
+    def pending(self, prefix):
+        """
+        :param prefix: full GCS path prefix.
+        :return: list of :class:`PendingWrite` which paths start with prefix.
+        """
+        with self._cond:
+            return [e for p, e in self._entries.items() if p.startswith(prefix)]
+
+    def flush(self, path=""):
+        """
+        Uploads the file or all the files in the directory now.
+        :param path: full GCS path of a file or directory, "" for everything.
+        """
+        prefix = path.rstrip("/") + "/" if path else ""
+        while True:
+            with self._cond:
+                paths = [p for p in self._entries
+                         if p == path or p.startswith(prefix)]
+                if not paths:
+                    return
+                free = [p for p in paths if p not in self._busy]
+                if not free:
+                    self._cond.wait()
+                    continue
+                entry = self._take(free[0])
+            self._upload_entry(entry, throw=True)
+
+    def close(self):
+        """
+        Stops the background uploads. The files which have not been uploaded
+        stay in the journal.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _file_name(self, path):
+        return os.path.join(self.directory, hashlib.sha256(
+            path.encode("utf-8")).hexdigest() + self.SUFFIX)
+
+    def _lock(self):
+        fd = os.open(os.path.join(self.directory, "lock"),
+                     os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            raise RuntimeError("The write-behind journal %s is used by another "
+                               "process" % self.directory)
+        return fd
+
+    def _sync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return  # Windows
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _recover(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            full_name = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                # the save did not return
+                os.remove(full_name)
+                continue
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                with open(full_name, "rb") as fin:
+                    header = json.loads(fin.readline().decode("utf-8"))
+                    entries.append((header["time"], header["path"],
+                                    header["type"], fin.read()))
+            except (ValueError, KeyError) as e:
+                self.log.error("Skipped the corrupted journal file %s: %s",
+                               full_name, e)
+        now = time.time()
+        for mtime, path, type, data in sorted(entries):
+            self._seq += 1
+            self._entries[path] = PendingWrite(path, type, data, mtime,
+                                               self._seq)
+            self._due[path] = now
+        if entries:
+            self.log.info("Recovered %d unsaved files from %s", len(entries),
+                          self.directory)
+
+    def _take(self, path):
+        self._busy.add(path)
+        self._due.pop(path, None)
+        return self._entries[path]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                entry = None
+                while entry is None:
+                    if self._closed:
+                        return
+                    now = time.time()
+                    waiting = [(due, p) for p, due in self._due.items()
+                               if p not in self._busy]
+                    if waiting and min(waiting)[0] <= now:
+                        entry = self._take(min(waiting)[1])
+                    else:
+                        self._cond.wait(min(waiting)[0] - now
+                                        if waiting else None)
+            self._upload_entry(entry, throw=False)
+
+    def _upload_entry(self, entry, throw):
+        path = entry.path
+        try:
+            self._upload(entry)
+        except Exception as e:
+            with self._cond:
+                self._busy.discard(path)
+                failures = self._failures.get(path, 0) + 1
+                self._failures[path] = failures
+                retry = min(max(self.delay, 1) * 2 ** failures,
+                            self.MAX_RETRY_DELAY)
+                self._due.setdefault(path, time.time() + retry)
+                self._cond.notify_all()
+            self.log.error("Failed to upload %s, retrying in %ds: %s",
+                           path, retry, e, exc_info=not throw)
+            if throw:
+                raise
+            return
+        with self._cond:
+            self._busy.discard(path)
+            self._failures.pop(path, None)
+            if self._entries.get(path) is entry:
+                del self._entries[path]
+                os.remove(self._file_name(path))
+            self._cond.notify_all()
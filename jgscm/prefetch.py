@@ -0,0 +1,169 @@
+"""
+Background prefetch of the files in the opened directory. Opening a
+directory is usually followed by opening one of the notebooks in it, so the
+small files are downloaded in advance and served for a short time without
+asking GCS.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import time
+
+
+class Prefetcher(object):
+    """
+    The prefetched contents by bucket name and blob name.
+    """
+
+    def __init__(self, download, max_files, max_size, ttl, log, threads=2):
+        """
+        :param download: callable which returns the contents of a \
+                         :class:`google.cloud.storage.Blob`.
+        :param max_files: maximum number of files to prefetch per directory.
+        :param max_size: maximum size of a prefetched file in bytes.
+        :param ttl: number of seconds to serve the prefetched file.
+        :param log: :class:`logging.Logger` instance.
+        :param threads: number of parallel downloads.
+        """
+        self.max_files = max_files
+        self.max_size = max_size
+        self.ttl = ttl
+        self.log = log
+        self._download = download
+        self._pool = ThreadPoolExecutor(max_workers=threads,
+                                        thread_name_prefix="jgscm-prefetch")
+        self._lock = threading.Lock()
+        # tuple(bucket name, blob name) -> tuple(expiration time, blob, data)
+        self._entries = {}
+        self._directory = None
+        # tuple(bucket name, blob name) -> scheduled download future
+        self._futures = {}
+        # changes on navigation and writes to discard the running downloads
+        self._epoch = 0
+        # "files", "bytes", "seconds", "hits", "cancelled"
+        self.stats = Counter()
+
+    @property
+    def bandwidth(self):
+        """
+        :return: average download speed in bytes per second.
+        """
+        seconds = self.stats["seconds"]
+        return self.stats["bytes"] / seconds if seconds > 0 else 0.0
+
+    def schedule(self, directory, blobs):
+        """
+        Starts prefetching the files in the listed directory. Cancels the
+        prefetch of the previous directory.
+        :param directory: directory path.
+        :param blobs: list of the listed :class:`google.cloud.storage.Blob`.
+        """
+        now = time.time()
+        with self._lock:
+            if directory != self._directory:
+                self._cancel()
+                self._directory = directory
+            candidates = []
+            for blob in blobs:
+                if blob.name.endswith("/") or blob.generation is None or \
+                        blob.size is None or blob.size > self.max_size:
+                    continue
+                key = (blob.bucket.name, blob.name)
+                entry = self._entries.get(key)
+                if key in self._futures or entry is not None and \
+                        entry[0] > now and \
+                        entry[1].generation == blob.generation:
+                    continue
+                candidates.append(blob)
+            # the notebooks are opened more often than the other files
+            candidates.sort(key=lambda b: (not b.name.endswith(".ipynb"),
+                                           -b.updated.timestamp()
+                                           if b.updated else 0))
+            epoch = self._epoch
+            for blob in candidates[:self.max_files - len(self._futures)]:
+                self._futures[(blob.bucket.name, blob.name)] = \
+                    self._pool.submit(self._fetch, blob, epoch)
+
+    def wait(self, timeout=None):
+        """
+        Waits for the scheduled downloads to finish.
+        :param timeout: maximum number of seconds to wait.
+        """
+        with self._lock:
+            futures = list(self._futures.values())
+        wait(futures, timeout)
+
+    def lookup(self, bucket, name):
+        """
+        :param bucket: bucket name.
+        :param name: blob name.
+        :return: the prefetched :class:`google.cloud.storage.Blob` or None.
+        """
+        with self._lock:
+            entry = self._entries.get((bucket, name))
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[(bucket, name)]
+                return None
+            return entry[1]
+
+    def data(self, blob):
+        """
+        :param blob: :class:`google.cloud.storage.Blob` instance.
+        :return: the prefetched contents of the same generation or None.
+        """
+        with self._lock:
+            entry = self._entries.get((blob.bucket.name, blob.name))
+            if entry is None or entry[0] <= time.time() or \
+                    entry[1].generation != blob.generation:
+                return None
+            self.stats["hits"] += 1
+            return entry[2]
+
+    def invalidate(self, bucket, prefix=""):
+        """
+        Drops the prefetched files which are being changed.
+        :param bucket: bucket name.
+        :param prefix: blob name prefix.
+        """
+        with self._lock:
+            self._epoch += 1
+            for key in list(self._entries):
+                if key[0] == bucket and key[1].startswith(prefix):
+                    del self._entries[key]
+
+    def _cancel(self):
+        self._epoch += 1
+        for future in self._futures.values():
+            if future.cancel():
+                self.stats["cancelled"] += 1
+        self._futures = {}
+        self._entries.clear()
+
+    def _fetch(self, blob, epoch):
+        key = (blob.bucket.name, blob.name)
+        try:
+            if epoch != self._epoch:
+                return
+            start = time.time()
+            data = self._download(blob)
+        except Exception as e:
+            self.log.debug("Failed to prefetch %s/%s: %s", blob.bucket.name,
+                           blob.name, e)
+            return
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+        elapsed = time.time() - start
+        with self._lock:
+            self.stats["files"] += 1
+            self.stats["bytes"] += len(data)
+            self.stats["seconds"] += elapsed
+            if epoch != self._epoch:
+                return
+            self._entries[(blob.bucket.name, blob.name)] = (
+                time.time() + self.ttl, blob, data)
+        self.log.debug("Prefetched %s/%s (%d bytes) at %.1f MB/s",
+                       blob.bucket.name, blob.name, len(data),
+                       self.bandwidth / (1 << 20))
@@ -0,0 +1,184 @@
+"""
+File name search under a bucket prefix. GCS filters the listing by a glob
+(matchGlob), so only the candidate objects are transferred; the names are
+then matched exactly here. The listings of the searched prefixes may be kept
+for a short time to answer the next searches without listing again.
+"""
+from collections import namedtuple
+import re
+import threading
+import time
+
+
+SearchPage = namedtuple("SearchPage", ("models", "scanned", "truncated"))
+
+GLOB_CHARS = "*?[{"
+
+
+def is_glob(query):
+    """
+    :param query: search query.
+    :return: True if the query is a glob, False if it is a substring.
+    """
+    return any(c in query for c in GLOB_CHARS)
+
+
+def escape_glob(text):
+    """
+    :param text: literal text.
+    :return: matchGlob pattern which matches only the text.
+    """
+    return "".join("[%s]" % c if c in GLOB_CHARS else c for c in text)
+
+
+def glob_to_regex(pattern):
+    """
+    Translates a matchGlob pattern: "**/" matches any number of directories,
+    including none, "**" matches any characters, "*" and "?" do not match
+    "/", "[...]" is a character class and "{a,b}" is either.
+    :param pattern: glob.
+    :return: compiled regular expression which matches the whole string.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 2
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 1
+        elif c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and pattern.find("]", i + 2) > 0:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex.append("[%s]" % body.replace("\\", "\\\\"))
+            i = end
+        elif c == "{" and pattern.find("}", i + 1) > 0:
+            end = pattern.find("}", i + 1)
+            regex.append("(?:%s)" % "|".join(
+                re.escape(p) for p in pattern[i + 1:end].split(",")))
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return re.compile("".join(regex) + r"\Z", re.S)
+
+
+class NameMatcher(object):
+    """
+    Matches the blob names under the prefix against the query. A glob
+    without "/" matches the file name, a glob with "/" matches the path
+    relative to the prefix, anything else is a case insensitive substring
+    of the file name.
+    """
+
+    def __init__(self, prefix, query):
+        """
+        :param prefix: blob name prefix, "" or ending with "/".
+        :param query: search query.
+        """
+        self.prefix = prefix
+        self.query = query
+        if not is_glob(query):
+            self._substring = query.lower()
+            self._regex = None
+            self.glob = escape_glob(prefix) + "**"
+            if query:
+                # the file name in any directory contains the query, [aA]
+                # classes make the server side filter case insensitive
+                self.glob += "/*" + "".join(
+                    "[%s%s]" % (c.lower(), c.upper())
+                    if c.lower() != c.upper() else escape_glob(c)
+                    for c in query) + "*"
+        else:
+            self._substring = None
+            self._regex = glob_to_regex(query)
+            if "/" in query:
+                self.glob = escape_glob(prefix) + query
+            else:
+                # the file name in any directory
+                self.glob = escape_glob(prefix) + "**/" + query
+
+    def match(self, name):
+        """
+        :param name: blob name.
+        :return: True if the blob matches the query.
+        """
+        if not name.startswith(self.prefix) or name.endswith("/"):
+            return False
+        relative = name[len(self.prefix):]
+        if self._regex is not None and "/" in self.query:
+            return self._regex.match(relative) is not None
+        base = relative.rsplit("/", 1)[-1]
+        if self._regex is not None:
+            return self._regex.match(base) is not None
+        return self._substring in base.lower()
+
+
+class NameIndex(object):
+    """
+    The complete listings of the recently searched prefixes by bucket name
+    and prefix.
+    """
+
+    def __init__(self, ttl, max_entries=16):
+        """
+        :param ttl: number of seconds to keep a listing.
+        :param max_entries: maximum number of the kept listings.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # tuple(bucket, prefix) -> tuple(expiration time, list of blobs)
+        self._entries = {}
+
+    def get(self, bucket, prefix):
+        """
+        :param bucket: bucket name.
+        :param prefix: blob name prefix.
+        :return: list of :class:`google.cloud.storage.Blob` under the \
+                 prefix or None.
+        """
+        now = time.time()
+        with self._lock:
+            for (b, p), (expires, blobs) in list(self._entries.items()):
+                if expires <= now:
+                    del self._entries[(b, p)]
+                elif b == bucket and prefix.startswith(p):
+                    if p == prefix:
+                        return blobs
+                    return [blob for blob in blobs
+                            if blob.name.startswith(prefix)]
+        return None
+
+    def put(self, bucket, prefix, blobs):
+        """
+        :param bucket: bucket name.
+        :param prefix: blob name prefix.
+        :param blobs: all the :class:`google.cloud.storage.Blob` under the \
+                      prefix.
+        """
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                del self._entries[min(self._entries,
+                                      key=lambda k: self._entries[k][0])]
+            self._entries[(bucket, prefix)] = (time.time() + self.ttl, blobs)
+
+    def invalidate(self, bucket, name):
+        """
+        Drops the listings which include the changed blob.
+        :param bucket: bucket name.
+        :param name: changed blob name or prefix.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == bucket and (name.startswith(key[1]) or
+                                         key[1].startswith(name)):
+                    del self._entries[key]
@@ -0,0 +1,208 @@
+"""
+Benchmarks of :class:`jgscm.GoogleStorageContentManager` against
+:class:`jgscm.tests.fakegcs.FakeGCS`.
+
+Every scenario reports the wall time and the number of GCS round trips
+per API operation. Run it with
+
+    python -m jgscm.tests.benchmark --latency 0.02
+"""
+import argparse
+from collections import Counter, namedtuple
+import json
+import os
+import subprocess
+import sys
+import time
+
+from nbformat.v4 import new_code_cell, new_notebook, new_output
+
+import jgscm
+from jgscm import GoogleStorageContentManager
+from jgscm.tests.fakegcs import FakeGCS
+
+
+BUCKET = "bench"
+Result = namedtuple("Result", ("name", "seconds", "rpcs"))
+
+
+def make_notebook(size):
+    """
+    Generates a notebook with stream outputs.
+    :param size: approximate size of the serialized notebook in bytes.
+    :return: :class:`nbformat.notebooknode.NotebookNode` instance.
+    """
+    nb = new_notebook()
+    line = "x" * 79 + "\n"
+    cell_size = 64 * 1024
+    for i in range(max(size // cell_size, 1)):
+        text = line * (min(size, cell_size) // len(line))
+        nb.cells.append(new_code_cell(
+            source="print(%d)" % i, execution_count=i + 1,
+            outputs=[new_output("stream", name="stdout", text=text)]))
+    return nb
+
+
+class Benchmark(object):
+    """Owns a fake GCS server and a contents manager which talks to it."""
+
+    def __init__(self, latency=0.0, bandwidth=None, **config):
+        self.server = FakeGCS(latency=latency, bandwidth=bandwidth)
+        self.server.create_bucket(BUCKET)
+        self.manager = self.create_manager(**config)
+
+    def create_manager(self, **config):
+        manager = GoogleStorageContentManager(**config)
+        manager._client = self.server.client()
+        return manager
+
+    def populate(self, prefix, count, data=b"data", depth=1, fanout=None):
+        """
+        Uploads a tree of objects bypassing the statistics.
+        :param prefix: path inside the bucket, ends with "/".
+        :param count: number of files in every directory.
+        :param depth: number of directory levels.
+        :param fanout: number of subdirectories in every directory.
+        """
+        for i in range(count):
+            self.server.put_object(BUCKET, "%sfile%05d.txt" % (prefix, i),
+                                   data, "text/plain")
+        if depth > 1:
+            for i in range(fanout or 2):
+                self.populate("%sdir%d/" % (prefix, i), count, data,
+                              depth - 1, fanout)
+
+    def measure(self, name, fn, *args, **kwargs):
+        self.server.reset_stats()
+        start = time.time()
+        fn(*args, **kwargs)
+        seconds = time.time() - start
+        return Result(name, seconds, Counter(self.server.round_trips))
+
+
+def bench_get_directory(bench, size):
+    prefix = "list%d/" % size
+    bench.populate(prefix, size)
+    bench.manager.max_list_size = max(size, bench.manager.max_list_size)
+    return bench.measure("get directory %d" % size, bench.manager.get,
+                         BUCKET + "/" + prefix)
+
+
+def bench_notebook(bench, size):
+    path = "%s/nb%d.ipynb" % (BUCKET, size)
+    model = {"type": "notebook", "content": make_notebook(size)}
+    saved = bench.measure("save notebook %dKB" % (size // 1024),
+                          bench.manager.save, model, path)
+    opened = bench.measure("open notebook %dKB" % (size // 1024),
+                           bench.manager.get, path)
+    return saved, opened
+
+
+def bench_tree(bench, depth, fanout=2, count=4):
+    prefix = "tree%d/" % depth
+    bench.populate(prefix, count, depth=depth, fanout=fanout)
+    renamed = bench.measure(
+        "rename tree depth %d" % depth, bench.manager.rename_file,
+        BUCKET + "/" + prefix, BUCKET + "/renamed" + prefix)
+    deleted = bench.measure(
+        "delete tree depth %d" % depth, bench.manager.delete_file,
+        BUCKET + "/renamed" + prefix)
+    return renamed, deleted
+
+
+def bench_checkpoints(bench, count=5):
+    path = "%s/cp/notebook.ipynb" % BUCKET
+    bench.manager.save({"type": "notebook", "content": make_notebook(1024)},
+                       path)
+    results = [bench.measure("create checkpoint",
+                             bench.manager.create_checkpoint, path)]
+    for _ in range(count - 1):
+        bench.manager.create_checkpoint(path)
+    results.append(bench.measure("list checkpoints",
+                                 bench.manager.list_checkpoints, path))
+    checkpoint = bench.manager.list_checkpoints(path)[0]["id"]
+    results.append(bench.measure("restore checkpoint",
+                                 bench.manager.restore_checkpoint,
+                                 checkpoint, path))
+    results.append(bench.measure("delete checkpoint",
+                                 bench.manager.delete_checkpoint,
+                                 checkpoint, path))
+    return results
+
+
+def bench_import():
+    """
+    Measures the time to import jgscm in a new process which has already
+    imported the notebook server, like the server does.
+    """
+    code = ("import time, notebook.services.contents.manager\n"
+            "start = time.time()\n"
+            "import jgscm\n"
+            "print(time.time() - start)")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(jgscm.__file__)))
+    seconds = float(subprocess.check_output(
+        [sys.executable, "-c", code], cwd=root,
+        env=dict(os.environ, PYTHONPATH=root)))
+    return Result("import jgscm", seconds, Counter())
+
+
+def bench_first_request(bench, warm_up):
+    bench.populate("home/", 10)
+    manager = bench.create_manager(default_path=BUCKET + "/home")
+    if warm_up:
+        manager.start_warm_up().join()
+    return bench.measure("first request" + (" after warm-up" if warm_up
+                                            else ""),
+                         manager.get, BUCKET + "/home/")
+
+
+def run(latency=0.0, bandwidth=None, quick=False):
+    """
+    Runs all the scenarios.
+    :param latency: simulated latency of one GCS round trip in seconds.
+    :param bandwidth: simulated bandwidth in bytes per second.
+    :param quick: If True, use only the small sizes.
+    :return: list of :class:`Result`.
+    """
+    results = [] if quick else [bench_import()]
+
+    def bench():
+        return Benchmark(latency=latency, bandwidth=bandwidth)
+
+    for warm_up in (False, True):
+        results.append(bench_first_request(bench(), warm_up))
+
+    for size in (10,) if quick else (10, 1000, 10000):
+        results.append(bench_get_directory(bench(), size))
+    for size in (64 * 1024,) if quick else (64 * 1024, 1 << 20, 16 << 20):
+        results.extend(bench_notebook(bench(), size))
+    for depth in (2,) if quick else (2, 4):
+        results.extend(bench_tree(bench(), depth))
+    results.extend(bench_checkpoints(bench()))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated GCS round trip latency in seconds.")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="Simulated GCS bandwidth in bytes per second.")
+    parser.add_argument("--quick", action="store_true",
+                        help="Run only the small scenarios.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON lines.")
+    args = parser.parse_args(args)
+    for result in run(args.latency, args.bandwidth, args.quick):
+        if args.json:
+            print(json.dumps({"name": result.name, "seconds": result.seconds,
+                              "rpcs": dict(result.rpcs)}))
+        else:
+            print("%-28s %9.3fs %7d RPCs  %s" % (
+                result.name, result.seconds, sum(result.rpcs.values()),
+                ", ".join("%s=%d" % p for p in sorted(result.rpcs.items()))))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
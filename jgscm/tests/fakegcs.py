@@ -0,0 +1,668 @@
+"""
+In-process stand-in for the Google Cloud Storage JSON API.
+
+The real :class:`google.cloud.storage.Client` is wired to a
+:class:`requests.Session` whose transport adapter serves the requests from
+memory, so every library code path (batches, ranged downloads, resumable
+uploads, preconditions, compose) is exercised without network access.
+Each HTTP round trip can be delayed to simulate the latency of GCS, and all
+the round trips are counted for the benchmarks.
+"""
+import base64
+from collections import Counter
+from datetime import datetime, timezone
+import email.parser
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+import uuid
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.storage import Client
+import google_crc32c
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+from jgscm.search import glob_to_regex
+
+
+ENDPOINT = "http://fake-gcs.invalid"
+HTTP_REASONS = {
+    200: "OK", 204: "No Content", 206: "Partial Content",
+    304: "Not Modified", 308: "Resume Incomplete", 400: "Bad Request",
+    403: "Forbidden", 404: "Not Found", 409: "Conflict", 412: "Precondition Failed",
+    416: "Requested Range Not Satisfiable",
+}
+
+
+class FakeGCSError(Exception):
+    def __init__(self, code, message):
+        super(FakeGCSError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _timestamp(seconds):
+    stamp = datetime.fromtimestamp(seconds, timezone.utc)
+    return stamp.strftime("%Y-%m-%dT%H:%M:%S.") + \
+        "%03dZ" % (stamp.microsecond // 1000)
+
+
+class FakeObject(object):
+    def __init__(self, bucket, name, data, content_type, generation,
+                 metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.data = bytes(data)
+        self.content_type = content_type or "application/octet-stream"
+        self.generation = generation
+        self.metageneration = 1
+        self.metadata = dict(metadata or {})
+        self.created = self.updated = time.time()
+        self.md5 = base64.b64encode(
+            hashlib.md5(self.data).digest()).decode("ascii")
+        self.crc32c = base64.b64encode(
+            google_crc32c.Checksum(self.data).digest()).decode("ascii")
+
+    def resource(self):
+        quoted = quote(self.name, safe="")
+        resource = {
+            "kind": "storage#object",
+            "id": "%s/%s/%d" % (self.bucket, self.name, self.generation),
+            "selfLink": "%s/storage/v1/b/%s/o/%s" % (
+                ENDPOINT, self.bucket, quoted),
+            "mediaLink": "%s/download/storage/v1/b/%s/o/%s?generation=%d"
+                         "&alt=media" % (ENDPOINT, self.bucket, quoted,
+                                         self.generation),
+            "name": self.name,
+            "bucket": self.bucket,
+            "generation": str(self.generation),
+            "metageneration": str(self.metageneration),
+            "contentType": self.content_type,
+            "storageClass": "STANDARD",
+            "size": str(len(self.data)),
+            "md5Hash": self.md5,
+            "crc32c": self.crc32c,
+            "etag": "C%d" % self.generation,
+            "timeCreated": _timestamp(self.created),
+            "updated": _timestamp(self.updated),
+        }
+        if self.metadata:
+            resource["metadata"] = dict(self.metadata)
+        return resource
+
+
+class FakeBucket(object):
+    def __init__(self, name):
+        self.name = name
+        self.created = time.time()
+        self.objects = {}
+
+    def resource(self):
+        return {
+            "kind": "storage#bucket",
+            "id": self.name,
+            "selfLink": "%s/storage/v1/b/%s" % (ENDPOINT, self.name),
+            "name": self.name,
+            "projectNumber": "1",
+            "metageneration": "1",
+            "location": "US",
+            "storageClass": "STANDARD",
+            "etag": "CAE=",
+            "timeCreated": _timestamp(self.created),
+            "updated": _timestamp(self.created),
+        }
+
+
+class _FakeAdapter(HTTPAdapter):
+    """Transport adapter which routes the requests to :class:`FakeGCS`."""
+
+    def __init__(self, server):
+        super(_FakeAdapter, self).__init__()
+        self.server = server
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        body = request.body
+        if body is None:
+            body = b""
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        elif not isinstance(body, bytes):
+            body = b"".join(body)
+        headers = requests.structures.CaseInsensitiveDict(
+            (k, v.decode("latin-1") if isinstance(v, bytes) else v)
+            for k, v in request.headers.items())
+        status, headers, payload = self.server.handle(
+            request.method, request.url, headers, body)
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(payload), headers=headers, status=status,
+            reason=HTTP_REASONS.get(status, ""), preload_content=False,
+            decode_content=False)
+        return self.build_response(request, raw)
+
+
+class FakeGCS(object):
+    """
+    Thread safe in-memory GCS server.
+
+    :param latency: seconds to sleep on every HTTP round trip, or a callable \
+                    which takes the operation name and returns the seconds.
+    :param bandwidth: bytes per second for the transferred payloads or None \
+                      for the infinite bandwidth.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, project="fake-project"):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.project = project
+        self.buckets = {}
+        # names of the buckets which the client may not access
+        self.forbidden = set()
+        # operation name -> number of the next payloads of that operation to
+        # corrupt in transit, e.g. "objects.insert" or "objects.download"
+        self.corrupt = Counter()
+        self.round_trips = Counter()
+        self.operations = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._uploads = {}
+        self._generation = int(time.time() * 1000000)
+        self._lock = threading.RLock()
+
+    def client(self, project=None):
+        """
+        Creates a new GCS client which talks to this server.
+        :param project: project name, defaults to the server's project.
+        :return: :class:`google.cloud.storage.Client` instance.
+        """
+        session = requests.Session()
+        session.mount(ENDPOINT, _FakeAdapter(self))
+        client = Client(project=project or self.project,
+                        credentials=AnonymousCredentials(), _http=session,
+                        client_options={"api_endpoint": ENDPOINT})
+        # google-cloud-storage>=3.5 fetches the bucket metadata for tracing
+        # from background threads, which makes the statistics racy.
+        client._bucket_metadata_cache = None
+        return client
+
+    @property
+    def rpc_count(self):
+        """The number of HTTP round trips served so far."""
+        return sum(self.round_trips.values())
+
+    def reset_stats(self):
+        with self._lock:
+            self.round_trips.clear()
+            self.operations.clear()
+            self.bytes_sent = self.bytes_received = 0
+
+    def create_bucket(self, name):
+        with self._lock:
+            return self.buckets.setdefault(name, FakeBucket(name))
+
+    def put_object(self, bucket, name, data, content_type=None):
+        """Stores an object bypassing the HTTP layer and the statistics."""
+        with self._lock:
+            obj = FakeObject(self.create_bucket(bucket).name, name, data,
+                             content_type, self._next_generation())
+            self.buckets[bucket].objects[name] = obj
+            return obj
+
+    def handle(self, method, url, headers, body):
+        """
+        Serves a single HTTP request.
+        :return: tuple(status code, headers dict, body bytes).
+        """
+        operation, response = self._dispatch(method, url, headers, body)
+        with self._lock:
+            self.round_trips[operation] += 1
+            self.bytes_received += len(body)
+            self.bytes_sent += len(response[2])
+        delay = self.latency(operation) if callable(self.latency) \
+            else self.latency
+        if self.bandwidth:
+            delay += (len(body) + len(response[2])) / float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    def _next_generation(self):
+        self._generation = max(self._generation + 1,
+                               int(time.time() * 1000000))
+        return self._generation
+
+    def _dispatch(self, method, url, headers, body):
+        parts = urlsplit(url)
+        query = {k: v[-1] for k, v in parse_qs(
+            parts.query, keep_blank_values=True).items()}
+        segments = [unquote(s) for s in parts.path.split("/")[1:]]
+        operation = "unknown"
+        try:
+            if segments[:2] == ["batch", "storage"]:
+                operation = "batch"
+                return operation, self._batch(headers, body)
+            operation, handler, args = self._route(method, segments, query)
+            with self._lock:
+                self.operations[operation] += 1
+                return operation, handler(query, headers, body, *args)
+        except FakeGCSError as e:
+            return operation, self._error(e.code, e.message)
+
+    def _route(self, method, segments, query):
+        if segments[:3] == ["download", "storage", "v1"]:
+            segments = segments[3:]
+            if len(segments) == 4 and segments[2] == "o":
+                return "objects.download", self._download, segments[1::2]
+        elif segments[:3] == ["upload", "storage", "v1"]:
+            segments = segments[3:]
+            if len(segments) == 3 and segments[2] == "o":
+                if method == "POST" and query["uploadType"] == "multipart":
+                    return "objects.insert", self._upload_multipart, \
+                        [segments[1]]
+                if method == "POST":
+                    return "objects.insert", self._upload_initiate, \
+                        [segments[1]]
+                return "objects.insert", self._upload_chunk, [segments[1]]
+        elif segments[:2] == ["storage", "v1"]:
+            segments = segments[2:]
+            if segments == ["b"]:
+                if method == "GET":
+                    return "buckets.list", self._list_buckets, []
+                return "buckets.insert", self._insert_bucket, []
+            if len(segments) == 2:
+                if method == "GET":
+                    return "buckets.get", self._get_bucket, [segments[1]]
+                if method == "DELETE":
+                    return "buckets.delete", self._delete_bucket, \
+                        [segments[1]]
+            if len(segments) == 3 and segments[2] == "o":
+                return "objects.list", self._list_objects, [segments[1]]
+            if len(segments) == 4 and segments[2] == "o":
+                args = [segments[1], segments[3]]
+                if method == "GET":
+                    return "objects.get", self._get_object, args
+                if method == "DELETE":
+                    return "objects.delete", self._delete_object, args
+                if method in ("PATCH", "PUT"):
+                    return "objects.patch", self._patch_object, args
+            if len(segments) == 5 and segments[4] == "compose":
+                return "objects.compose", self._compose, [segments[1],
+                                                          segments[3]]
+            if len(segments) == 9 and segments[4] in ("copyTo", "rewriteTo"):
+                kind = segments[4][:-2]
+                return "objects." + kind, self._copy, \
+                    [segments[1], segments[3], segments[6], segments[8],
+                     kind == "rewrite"]
+        raise FakeGCSError(400, "Unsupported request %s /%s" % (
+            method, "/".join(segments)))
+
+    @staticmethod
+    def _json(resource, status=200, headers=None):
+        result = {"Content-Type": "application/json; charset=UTF-8"}
+        result.update(headers or {})
+        return status, result, json.dumps(resource).encode("utf-8")
+
+    @classmethod
+    def _error(cls, code, message):
+        return cls._json({"error": {"code": code, "message": message,
+                                    "errors": [{"message": message}]}},
+                         status=code)
+
+    def _bucket(self, name):
+        if name in self.forbidden:
+            raise FakeGCSError(403, "The caller does not have "
+                                    "storage.buckets.get access.")
+        try:
+            return self.buckets[name]
+        except KeyError:
+            raise FakeGCSError(404, "The specified bucket does not exist.")
+
+    def _object(self, bucket, name, query=None, prefix=""):
+        obj = self._bucket(bucket).objects.get(name)
+        if obj is None:
+            raise FakeGCSError(404, "No such object: %s/%s" % (bucket, name))
+        if query is not None:
+            self._check_preconditions(obj, query, prefix)
+        generation = (query or {}).get(prefix and "sourceGeneration" or
+                                       "generation")
+        if generation and int(generation) != obj.generation:
+            raise FakeGCSError(404, "No such object: %s/%s#%s" % (
+                bucket, name, generation))
+        return obj
+
+    @staticmethod
+    def _check_preconditions(obj, query, prefix=""):
+        generation = obj.generation if obj is not None else 0
+        metageneration = obj.metageneration if obj is not None else None
+
+        def param(name):
+            if prefix:
+                name = prefix + name[2:]
+            value = query.get(name)
+            return int(value) if value not in (None, "") else None
+
+        match = param("ifGenerationMatch")
+        if match is not None and match != generation:
+            raise FakeGCSError(412, "Precondition Failed")
+        not_match = param("ifGenerationNotMatch")
+        if not_match is not None and not_match == generation:
+            raise FakeGCSError(304, "Not Modified")
+        match = param("ifMetagenerationMatch")
+        if match is not None and match != metageneration:
+            raise FakeGCSError(412, "Precondition Failed")
+        not_match = param("ifMetagenerationNotMatch")
+        if not_match is not None and not_match == metageneration:
+            raise FakeGCSError(304, "Not Modified")
+
+    def _store(self, bucket, name, data, content_type, query, metadata=None):
+        fb = self._bucket(bucket)
+        self._check_preconditions(fb.objects.get(name), query)
+        obj = FakeObject(bucket, name, data, content_type,
+                         self._next_generation(), metadata)
+        fb.objects[name] = obj
+        return obj
+
+    def _list_buckets(self, query, headers, body):
+        names = sorted(self.buckets)
+        prefix = query.get("prefix", "")
+        names = [n for n in names if n.startswith(prefix)]
+        items, token = self._paginate(names, query)
+        resource = {"kind": "storage#buckets",
+                    "items": [self.buckets[n].resource() for n in items]}
+        if token:
+            resource["nextPageToken"] = token
+        return self._json(resource)
+
+    def _insert_bucket(self, query, headers, body):
+        name = json.loads(body.decode("utf-8"))["name"]
+        if name in self.buckets:
+            raise FakeGCSError(409, "You already own this bucket.")
+        return self._json(self.create_bucket(name).resource())
+
+    def _get_bucket(self, query, headers, body, bucket):
+        return self._json(self._bucket(bucket).resource())
+
+    def _delete_bucket(self, query, headers, body, bucket):
+        if self._bucket(bucket).objects:
+            raise FakeGCSError(409, "The bucket you tried to delete is not "
+                                    "empty.")
+        del self.buckets[bucket]
+        return 204, {}, b""
+
+    @staticmethod
+    def _paginate(keys, query):
+        """
+        Like GCS, the page token is the last name on the previous page, so
+        that the listing stays consistent while the objects are deleted.
+        :param keys: sorted names or tuple(is prefix, name).
+        """
+        def name(key):
+            return key if isinstance(key, str) else key[1]
+
+        token = query.get("pageToken")
+        if token:
+            keys = [k for k in keys if name(k) > token]
+        size = min(int(query.get("maxResults") or 1000), 1000)
+        page = keys[:size]
+        return page, name(page[-1]) if len(keys) > size else None
+
+    def _list_objects(self, query, headers, body, bucket):
+        fb = self._bucket(bucket)
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        start = query.get("startOffset", "")
+        end = query.get("endOffset", "")
+        glob = query.get("matchGlob")
+        glob = glob_to_regex(glob) if glob else None
+        entries = []
+        seen = set()
+        for name in sorted(fb.objects):
+            if not name.startswith(prefix) or name < start or \
+                    (end and name >= end):
+                continue
+            if glob is not None and not glob.match(name):
+                continue
+            if delimiter:
+                cut = name.find(delimiter, len(prefix))
+                if cut >= 0:
+                    folder = name[:cut + len(delimiter)]
+                    if folder not in seen:
+                        seen.add(folder)
+                        entries.append((True, folder))
+                    continue
+            entries.append((False, name))
+        page, token = self._paginate(entries, query)
+        items = [fb.objects[n].resource() for p, n in page if not p]
+        # partial responses, e.g. fields=items(name,generation),prefixes
+        match = re.search(r"items\(([^)]*)\)", query.get("fields", ""))
+        if match is not None:
+            keep = set(match.group(1).split(","))
+            items = [{k: v for k, v in item.items() if k in keep}
+                     for item in items]
+        resource = {
+            "kind": "storage#objects",
+            "items": items,
+            "prefixes": [n for p, n in page if p],
+        }
+        if token:
+            resource["nextPageToken"] = token
+        return self._json(resource)
+
+    def _get_object(self, query, headers, body, bucket, name):
+        if query.get("alt") == "media":
+            return self._download(query, headers, body, bucket, name)
+        return self._json(self._object(bucket, name, query).resource())
+
+    def _delete_object(self, query, headers, body, bucket, name):
+        self._object(bucket, name, query)
+        del self.buckets[bucket].objects[name]
+        return 204, {}, b""
+
+    def _patch_object(self, query, headers, body, bucket, name):
+        obj = self._object(bucket, name, query)
+        patch = json.loads(body.decode("utf-8")) if body else {}
+        if "contentType" in patch:
+            obj.content_type = patch["contentType"]
+        if "metadata" in patch:
+            if patch["metadata"] is None:
+                obj.metadata = {}
+            else:
+                for key, value in patch["metadata"].items():
+                    if value is None:
+                        obj.metadata.pop(key, None)
+                    else:
+                        obj.metadata[key] = value
+        obj.metageneration += 1
+        obj.updated = time.time()
+        return self._json(obj.resource())
+
+    def _copy(self, query, headers, body, bucket, name, dest_bucket,
+              dest_name, rewrite):
+        source = self._object(bucket, name, query, prefix="ifSource")
+        patch = json.loads(body.decode("utf-8")) if body else {}
+        obj = self._store(dest_bucket, dest_name, source.data,
+                          patch.get("contentType", source.content_type),
+                          query, patch.get("metadata", source.metadata))
+        resource = obj.resource()
+        if rewrite:
+            size = str(len(obj.data))
+            resource = {"kind": "storage#rewriteResponse",
+                        "totalBytesRewritten": size, "objectSize": size,
+                        "done": True, "resource": resource}
+        return self._json(resource)
+
+    def _compose(self, query, headers, body, bucket, name):
+        request = json.loads(body.decode("utf-8"))
+        sources = request.get("sourceObjects", [])
+        if not 1 <= len(sources) <= 32:
+            raise FakeGCSError(400, "Compose requires 1 to 32 sources.")
+        data = []
+        for source in sources:
+            obj = self._object(bucket, source["name"])
+            generation = source.get("generation")
+            if generation is not None and int(generation) != obj.generation:
+                raise FakeGCSError(404, "No such object: %s/%s#%s" % (
+                    bucket, source["name"], generation))
+            precondition = source.get("objectPreconditions", {}).get(
+                "ifGenerationMatch")
+            if precondition is not None and \
+                    int(precondition) != obj.generation:
+                raise FakeGCSError(412, "Precondition Failed")
+            data.append(obj.data)
+        destination = request.get("destination", {})
+        obj = self._store(bucket, name, b"".join(data),
+                          destination.get("contentType"), query,
+                          destination.get("metadata"))
+        return self._json(obj.resource())
+
+    def _download(self, query, headers, body, bucket, name):
+        obj = self._object(bucket, name, query)
+        data = obj.data
+        result = {
+            "Content-Type": obj.content_type,
+            "ETag": "C%d" % obj.generation,
+            "x-goog-generation": str(obj.generation),
+            "x-goog-metageneration": str(obj.metageneration),
+            "x-goog-hash": "crc32c=%s,md5=%s" % (obj.crc32c, obj.md5),
+            "x-goog-stored-content-length": str(len(data)),
+            "x-goog-stored-content-encoding": "identity",
+        }
+        status = 200
+        match = re.match(r"bytes=(\d*)-(\d*)$", headers.get("Range", ""))
+        if match is not None:
+            first, last = match.groups()
+            if first == "":
+                first = max(len(data) - int(last), 0)
+                last = len(data) - 1
+            else:
+                first = int(first)
+                last = min(int(last), len(data) - 1) if last \
+                    else len(data) - 1
+            if first >= len(data) and len(data) > 0:
+                raise FakeGCSError(416, "Requested range not satisfiable")
+            if len(data) > 0:
+                result["Content-Range"] = "bytes %d-%d/%d" % (
+                    first, last, len(data))
+                data = data[first:last + 1]
+                status = 206
+        result["Content-Length"] = str(len(data))
+        return status, result, self._in_transit("objects.download", data)
+
+    def _in_transit(self, operation, data):
+        if not self.corrupt[operation] or not data:
+            return data
+        self.corrupt[operation] -= 1
+        return data[:-1] + bytes([data[-1] ^ 1])
+
+    @staticmethod
+    def _check_hashes(data, crc32c, md5):
+        if crc32c is not None:
+            actual = base64.b64encode(
+                google_crc32c.Checksum(data).digest()).decode("ascii")
+            if actual != crc32c:
+                raise FakeGCSError(400, "Provided CRC32C \"%s\" doesn't match "
+                                        "calculated CRC32C \"%s\"." % (
+                                            crc32c, actual))
+        if md5 is not None:
+            actual = base64.b64encode(
+                hashlib.md5(data).digest()).decode("ascii")
+            if actual != md5:
+                raise FakeGCSError(400, "Provided MD5 hash \"%s\" doesn't "
+                                        "match calculated MD5 hash \"%s\"." % (
+                                            md5, actual))
+
+    def _upload_multipart(self, query, headers, body, bucket):
+        boundary = re.search(r'boundary="?([^";]+)"?',
+                             headers["Content-Type"]).group(1).encode()
+        _, meta_part, data_part, _ = body.split(b"--" + boundary)
+        metadata = json.loads(meta_part.split(b"\r\n\r\n", 1)[1].strip())
+        head, data = data_part.split(b"\r\n\r\n", 1)
+        data = self._in_transit("objects.insert", data[:-2])
+        self._check_hashes(data, metadata.get("crc32c"),
+                           metadata.get("md5Hash"))
+        content_type = re.search(br"content-type: ([^\r\n]+)", head, re.I)
+        obj = self._store(
+            bucket, metadata.get("name") or query["name"], data,
+            metadata.get("contentType") or
+            (content_type.group(1).decode() if content_type else None),
+            query, metadata.get("metadata"))
+        return self._json(obj.resource())
+
+    def _upload_initiate(self, query, headers, body, bucket):
+        metadata = json.loads(body.decode("utf-8")) if body else {}
+        if "name" in query:
+            metadata.setdefault("name", query["name"])
+        self._bucket(bucket)
+        self._check_preconditions(
+            self.buckets[bucket].objects.get(metadata["name"]), query)
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = (bucket, metadata, query, bytearray())
+        location = "%s/upload/storage/v1/b/%s/o?uploadType=resumable" \
+                   "&upload_id=%s" % (ENDPOINT, bucket, upload_id)
+        return 200, {"Location": location}, b""
+
+    def _upload_chunk(self, query, headers, body, bucket):
+        try:
+            bucket, metadata, conditions, data = \
+                self._uploads[query["upload_id"]]
+        except KeyError:
+            raise FakeGCSError(404, "No such upload session.")
+        match = re.match(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$",
+                         headers.get("Content-Range", ""))
+        if match is None:
+            raise FakeGCSError(400, "Invalid Content-Range.")
+        if match.group(1) is not None:
+            if int(match.group(1)) != len(data):
+                raise FakeGCSError(400, "Non-contiguous upload chunk.")
+            data.extend(self._in_transit("objects.insert", body))
+        total = match.group(3)
+        if total == "*" or int(total) != len(data):
+            result = {"Range": "bytes=0-%d" % (len(data) - 1)} if data \
+                else {}
+            return 308, result, b""
+        del self._uploads[query["upload_id"]]
+        hashes = dict(h.split("=", 1) for h in headers.get(
+            "x-goog-hash", "").split(",") if "=" in h)
+        self._check_hashes(bytes(data), hashes.get("crc32c"),
+                           hashes.get("md5"))
+        obj = self._store(bucket, metadata["name"], data,
+                          metadata.get("contentType"), conditions,
+                          metadata.get("metadata"))
+        return self._json(obj.resource())
+
+    def _batch(self, headers, body):
+        content_type = headers["Content-Type"]
+        message = email.parser.Parser().parsestr(
+            "Content-Type: %s\r\nMIME-Version: 1.0\r\n\r\n%s" % (
+                content_type, body.decode("utf-8")))
+        parts = message.get_payload()
+        if len(parts) > 100:
+            raise FakeGCSError(400, "Too many requests in the batch.")
+        boundary = "batch_%s" % uuid.uuid4().hex
+        chunks = []
+        for index, part in enumerate(parts):
+            request = part.get_payload()
+            request_line, rest = request.split("\r\n", 1) \
+                if "\r\n" in request else request.split("\n", 1)
+            method, url, _ = request_line.split(" ", 2)
+            sub = email.parser.Parser().parsestr(rest)
+            sub_headers = requests.structures.CaseInsensitiveDict(sub.items())
+            sub_body = sub.get_payload().encode("utf-8")
+            _, (status, result, payload) = self._dispatch(
+                method, url, sub_headers, sub_body)
+            reason = HTTP_REASONS.get(status, "")
+            lines = ["--" + boundary, "Content-Type: application/http",
+                     "Content-ID: <response-%d>" % (index + 1), "",
+                     "HTTP/1.1 %d %s" % (status, reason)]
+            lines.extend("%s: %s" % item for item in result.items())
+            lines.extend(["", payload.decode("utf-8")])
+            chunks.append("\r\n".join(lines))
+        chunks.append("--%s--" % boundary)
+        return 200, {"Content-Type": "multipart/mixed; boundary=%s" %
+                     boundary}, "\r\n".join(chunks).encode("utf-8")
@@ -0,0 +1,293 @@
+"""
+Multi-user load test of a contents manager behind the Jupyter contents API.
+
+A Tornado server with the stock contents handlers runs in a background
+thread on top of :class:`jgscm.tests.fakegcs.FakeGCS`, and simulated users
+list directories, open and autosave notebooks, create checkpoints and rename
+files through HTTP. Besides the contents operations, a probe keeps hitting
+an endpoint which does not touch the contents manager: its latency shows how
+long the IOLoop is blocked by the other requests. Run it with
+
+    python -m jgscm.tests.loadtest --users 20 --duration 30 --latency 0.02
+"""
+import argparse
+import asyncio
+from collections import Counter, defaultdict, namedtuple
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+import nbformat
+from notebook.base.handlers import APIHandler
+from notebook.services.contents.handlers import default_handlers
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.web import Application
+from traitlets.utils.importstring import import_item
+
+from jgscm.tests.benchmark import BUCKET, make_notebook
+from jgscm.tests.fakegcs import FakeGCS
+
+
+DEFAULT_MIX = {"list": 30, "open": 25, "autosave": 25, "checkpoint": 10,
+               "rename": 10}
+OperationStats = namedtuple("OperationStats", (
+    "count", "errors", "p50", "p95", "p99", "mean"))
+
+
+class PingHandler(APIHandler):
+    """Answers immediately without touching the contents manager."""
+
+    def get(self):
+        self.finish("{}")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return float("nan")
+    index = max(int(math.ceil(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class LoadTestServer(object):
+    """Serves the contents API of the manager from a background thread."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.port = None
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self._loop = IOLoop.current()
+            app = Application(
+                default_handlers + [(r"/api/ping", PingHandler)],
+                contents_manager=self.manager, base_url="/",
+                disable_check_xsrf=True, allow_remote_access=True,
+                log_function=lambda handler: None)
+            sockets = bind_sockets(0, "127.0.0.1")
+            self.port = sockets[0].getsockname()[1]
+            server = HTTPServer(app)
+            server.add_sockets(sockets)
+            ready.set()
+            self._loop.start()
+            server.stop()
+            self._loop.close(all_fds=True)
+
+        self._thread = threading.Thread(target=run, name="loadtest-server",
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.add_callback(self._loop.stop)
+        self._thread.join()
+
+
+class LoadTest(object):
+    """
+    Drives simulated users against :class:`LoadTestServer`.
+
+    :param users: number of concurrent users.
+    :param duration: test duration in seconds.
+    :param latency: simulated GCS round trip latency in seconds.
+    :param notebook_size: approximate size of every notebook in bytes.
+    :param notebooks: number of notebooks per user.
+    :param files: number of additional small files per user.
+    :param think_time: mean pause between the actions of a user in seconds.
+    :param mix: mapping from the operation name to its relative weight.
+    :param manager_class: contents manager class or the import string.
+    """
+
+    def __init__(self, users=10, duration=10.0, latency=0.0,
+                 notebook_size=64 * 1024, notebooks=5, files=20,
+                 think_time=0.0, mix=None, probe_interval=0.05,
+                 manager_class="jgscm.GoogleStorageContentManager", seed=0,
+                 **config):
+        self.users = users
+        self.duration = duration
+        self.notebooks = notebooks
+        self.think_time = think_time
+        self.mix = mix or DEFAULT_MIX
+        self.probe_interval = probe_interval
+        self.seed = seed
+        self.gcs = FakeGCS(latency=latency)
+        self.gcs.create_bucket(BUCKET)
+        if isinstance(manager_class, str):
+            manager_class = import_item(manager_class)
+        self.manager = manager_class(**config)
+        self.manager._client = self.gcs.client()
+        nb = make_notebook(notebook_size)
+        self._notebook = nbformat.writes(nb).encode("utf-8")
+        self._autosave = json.dumps({"type": "notebook", "format": "json",
+                                     "content": nb})
+        for user in range(users):
+            for i in range(notebooks):
+                self.gcs.put_object(BUCKET, self._path(user, "nb%d.ipynb" % i),
+                                    self._notebook, "application/x-ipynb+json")
+            for i in range(files):
+                self.gcs.put_object(BUCKET, self._path(user, "file%d.txt" % i),
+                                    b"data", "text/plain")
+            self.gcs.put_object(BUCKET, self._path(user, "scratch.txt"),
+                                b"scratch", "text/plain")
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.elapsed = None
+
+    @staticmethod
+    def _path(user, name=""):
+        return "loadtest/user%d/%s" % (user, name)
+
+    def run(self):
+        """
+        Runs the load test.
+        :return: dict from the operation name to :class:`OperationStats`.
+        """
+        server = LoadTestServer(self.manager).start()
+        try:
+            asyncio.run(self._drive(server.port))
+        finally:
+            server.stop()
+        return self.report()
+
+    def report(self):
+        result = {}
+        for op, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[op] = OperationStats(
+                len(values), self.errors[op], percentile(values, 0.5),
+                percentile(values, 0.95), percentile(values, 0.99),
+                sum(values) / len(values))
+        return result
+
+    @property
+    def throughput(self):
+        """Completed contents operations per second."""
+        count = sum(len(v) for k, v in self.latencies.items() if k != "ping")
+        return count / self.elapsed if self.elapsed else 0.0
+
+    async def _drive(self, port):
+        self._http = SimpleAsyncHTTPClient(
+            max_clients=self.users + 1, force_instance=True)
+        self._base = "http://127.0.0.1:%d/api/" % port
+        deadline = time.monotonic() + self.duration
+        start = time.monotonic()
+        try:
+            await asyncio.gather(
+                self._probe(deadline),
+                *(self._user(i, deadline) for i in range(self.users)))
+        finally:
+            self.elapsed = time.monotonic() - start
+            self._http.close()
+
+    async def _fetch(self, path, method="GET", body=None):
+        return await self._http.fetch(
+            self._base + path, method=method, body=body,
+            request_timeout=3600, allow_nonstandard_methods=True)
+
+    async def _probe(self, deadline):
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            await self._fetch("ping")
+            self.latencies["ping"].append(time.monotonic() - start)
+            await asyncio.sleep(self.probe_interval)
+
+    async def _user(self, user, deadline):
+        rng = random.Random(self.seed * 1000003 + user)
+        ops, weights = zip(*sorted(self.mix.items()))
+        state = {"scratch": "scratch.txt"}
+        while time.monotonic() < deadline:
+            op = rng.choices(ops, weights)[0]
+            start = time.monotonic()
+            try:
+                await getattr(self, "_op_" + op)(user, rng, state)
+            except HTTPClientError:
+                self.errors[op] += 1
+            self.latencies[op].append(time.monotonic() - start)
+            if self.think_time:
+                await asyncio.sleep(rng.expovariate(1.0 / self.think_time))
+
+    def _contents(self, user, name=""):
+        return "contents/%s/%s" % (BUCKET, self._path(user, name).rstrip("/"))
+
+    async def _op_list(self, user, rng, state):
+        await self._fetch(self._contents(user))
+
+    async def _op_open(self, user, rng, state):
+        name = "nb%d.ipynb" % rng.randrange(self.notebooks)
+        await self._fetch(self._contents(user, name))
+
+    async def _op_autosave(self, user, rng, state):
+        name = "nb%d.ipynb" % rng.randrange(self.notebooks)
+        await self._fetch(self._contents(user, name), "PUT", self._autosave)
+
+    async def _op_checkpoint(self, user, rng, state):
+        await self._fetch(self._contents(user, "nb0.ipynb") + "/checkpoints",
+                          "POST", "")
+
+    async def _op_rename(self, user, rng, state):
+        new = "scratch-renamed.txt" if state["scratch"] == "scratch.txt" \
+            else "scratch.txt"
+        await self._fetch(self._contents(user, state["scratch"]), "PATCH",
+                          json.dumps({"path": "%s/%s" % (
+                              BUCKET, self._path(user, new))}))
+        state["scratch"] = new
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10,
+                        help="Number of concurrent users.")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Test duration in seconds.")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Simulated GCS round trip latency in seconds.")
+    parser.add_argument("--notebook-size", type=int, default=64 * 1024,
+                        help="Approximate size of every notebook in bytes.")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="Mean pause between user actions in seconds.")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+                        help="JSON object with the operation weights.")
+    parser.add_argument("--manager-class",
+                        default="jgscm.GoogleStorageContentManager",
+                        help="Contents manager class to load test.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON.")
+    args = parser.parse_args(args)
+    test = LoadTest(
+        users=args.users, duration=args.duration, latency=args.latency,
+        notebook_size=args.notebook_size, think_time=args.think_time,
+        mix=args.mix, manager_class=args.manager_class)
+    report = test.run()
+    if args.json:
+        print(json.dumps({"throughput": test.throughput, "operations": {
+            op: stats._asdict() for op, stats in report.items()}}))
+        return
+    print("%-12s %7s %6s %9s %9s %9s %9s" % (
+        "operation", "count", "errors", "p50", "p95", "p99", "mean"))
+    for op, stats in report.items():
+        print("%-12s %7d %6d %8.1fms %8.1fms %8.1fms %8.1fms" % (
+            op, stats.count, stats.errors, stats.p50 * 1000,
+            stats.p95 * 1000, stats.p99 * 1000, stats.mean * 1000))
+    print("throughput: %.1f operations/s, %d GCS round trips" % (
+        test.throughput, test.gcs.rpc_count))
+    if "ping" in report:
+        print("IOLoop blocking (ping p99): %.1fms" % (
+            report["ping"].p99 * 1000))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
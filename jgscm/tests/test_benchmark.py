@@ -0,0 +1,50 @@
+import subprocess
+import sys
+from unittest import main, TestCase
+
+import nbformat
+
+from jgscm.tests import benchmark
+
+
+class BenchmarkTest(TestCase):
+    # Upper bounds of the GCS round trips per scenario in the quick mode.
+    # Lower them together with the optimizations which cut the RPCs.
+    RPC_BUDGETS = {
+        "first request": 2,
+        "first request after warm-up": 1,
+        "get directory 10": 2,
+        "save notebook 64KB": 5,
+        "open notebook 64KB": 2,
+        "rename tree depth 2": 16,
+        "delete tree depth 2": 2,
+        "create checkpoint": 3,
+        "list checkpoints": 1,
+        "restore checkpoint": 5,
+        "delete checkpoint": 2,
+    }
+
+    def test_rpc_budgets(self):
+        results = benchmark.run(quick=True)
+        self.assertEqual({r.name for r in results}, set(self.RPC_BUDGETS))
+        for result in results:
+            with self.subTest(scenario=result.name):
+                self.assertLessEqual(sum(result.rpcs.values()),
+                                     self.RPC_BUDGETS[result.name],
+                                     dict(result.rpcs))
+
+    def test_lazy_imports(self):
+        code = ("import sys, jgscm\n"
+                "sys.exit('google.cloud.storage' in sys.modules)")
+        self.assertEqual(subprocess.call([sys.executable, "-c", code]), 0)
+
+    def test_make_notebook(self):
+        nb = benchmark.make_notebook(256 * 1024)
+        self.assertEqual(len(nb.cells), 4)
+        size = len(nbformat.writes(nb))
+        self.assertGreater(size, 200 * 1024)
+        self.assertLess(size, 300 * 1024)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1721 @@
+import base64
+from functools import partial
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import main, mock, TestCase
+
+import nbformat
+from nbformat.v4 import new_code_cell, new_notebook, new_output
+
+from tornado.web import HTTPError
+
+from jgscm import GoogleStorageContentManager, _is_corrupted
+from jgscm.admission import MemoryBudget
+from jgscm.hedge import Hedger
+from jgscm.search import NameMatcher
+from jgscm.tests import test as upstream
+from jgscm.tests.benchmark import make_notebook
+from jgscm.tests.fakegcs import FakeGCS
+from jgscm.trace import describe_rpc, Tracer
+from jgscm.usage import EMPTY as EMPTY_ROLLUP, UsageCache
+
+
+class TestGoogleStorageContentManagerFake(
+        upstream.TestGoogleStorageContentManager):
+    """Runs the whole contents manager suite against :class:`FakeGCS`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeGCS()
+        cls.server.create_bucket(cls.BUCKET)
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    def setUp(self):
+        self.contents_manager = GoogleStorageContentManager()
+        self.contents_manager._client = self.server.client()
+
+
+class FakeGCSTestCase(TestCase):
+    BUCKET = "test"
+
+    def setUp(self):
+        self.server = FakeGCS()
+        self.server.create_bucket(self.BUCKET)
+        self.contents_manager = self.create_manager()
+
+    def create_manager(self, **config):
+        manager = GoogleStorageContentManager(**config)
+        manager._client = self.server.client()
+        return manager
+
+    def path(self, sub):
+        return self.BUCKET + "/" + sub
+
+
+class NotebookJSONTest(FakeGCSTestCase):
+    def notebooks(self):
+        nb = new_notebook()
+        nb.cells.append(new_code_cell("plot()", outputs=[new_output(
+            "display_data", data={
+                "image/png": base64.b64encode(os.urandom(1000)).decode(),
+                "text/plain": "<Figure>"})]))
+        nb.cells.append(new_code_cell(u"print('прив"
+                                      u"ет')\n\n  x = {}\n"))
+        nb.metadata["deep"] = {"a": [{"b": []}, {}], "c": 1 << 70}
+        floats = new_notebook()
+        floats.metadata["plain"] = [0.1, 2.5, -3.0, 123456.789]
+        floats.cells.append(new_code_cell("x", outputs=[new_output(
+            "execute_result", data={"application/json": {
+                "small": 1e-05, "big": 1e+100, "exact": 1e16}})]))
+        return [nbformat.reads(upstream.TestGoogleStorageContentManager
+                               .NOTEBOOK, 4), make_notebook(100000), nb,
+                floats]
+
+    def test_writes_is_canonical(self):
+        for fast in (True, False):
+            self.contents_manager.fast_notebook_json = fast
+            for nb in self.notebooks():
+                self.assertEqual(
+                    self.contents_manager._writes_notebook(nb),
+                    nbformat.writes(nb).encode("utf-8"))
+
+    def test_reads(self):
+        for fast in (True, False):
+            self.contents_manager.fast_notebook_json = fast
+            for nb in self.notebooks():
+                data = nbformat.writes(nb).encode("utf-8")
+                read = self.contents_manager._reads_notebook(data)
+                self.assertIsInstance(read, nbformat.NotebookNode)
+                self.assertEqual(read, nbformat.reads(data.decode(), 4))
+            with self.assertRaises(nbformat.reader.NotJSONError):
+                self.contents_manager._reads_notebook(b"contents")
+            with self.assertRaises(nbformat.reader.NotJSONError):
+                self.contents_manager._reads_notebook(b"[1, 2]")
+
+    def test_round_trip(self):
+        nb = self.notebooks()[-1]
+        self.contents_manager.save({"type": "notebook", "content": nb},
+                                   self.path("nb.ipynb"))
+        model = self.contents_manager.get(self.path("nb.ipynb"))
+        for cell in model["content"].cells:
+            del cell.metadata["trusted"]
+        self.assertEqual(model["content"], nb)
+
+
+class NotebookChecksTest(FakeGCSTestCase):
+    def setUp(self):
+        super(NotebookChecksTest, self).setUp()
+        self.model = {"type": "notebook", "content": make_notebook(10000)}
+        self.contents_manager.notary.db_file = ":memory:"
+
+    def count_checks(self, fn, *args):
+        notary = self.contents_manager.notary
+        with mock.patch("notebook.services.contents.manager.validate_nb") \
+                as validate, mock.patch.object(
+                    notary, "compute_signature",
+                    wraps=notary.compute_signature) as sign:
+            result = fn(*args)
+        return result, validate.call_count, sign.call_count
+
+    def test_memoized(self):
+        path = self.path("nb.ipynb")
+        _, validations, signatures = self.count_checks(
+            self.contents_manager.save, self.model, path)
+        self.assertEqual((validations, signatures), (1, 1))
+        model, validations, signatures = self.count_checks(
+            self.contents_manager.get, path)
+        self.assertEqual((validations, signatures), (0, 0))
+        self.assertTrue(all(c.metadata["trusted"]
+                            for c in model["content"].cells))
+        _, validations, signatures = self.count_checks(
+            self.contents_manager.save, self.model, path)
+        self.assertEqual((validations, signatures), (0, 0))
+        self.model["content"].cells[0].source = "changed"
+        _, validations, signatures = self.count_checks(
+            self.contents_manager.save, self.model, path)
+        self.assertEqual((validations, signatures), (1, 1))
+
+    def test_validation_message(self):
+        path = self.path("nb.ipynb")
+        self.server.put_object(self.BUCKET, "nb.ipynb",
+                               b'{"nbformat": 4, "nbformat_minor": 2, '
+                               b'"metadata": {}, "cells": [{"cell_type": "code", '
+                               b'"metadata": {}, "source": ""}]}')
+        for _ in range(2):
+            model = self.contents_manager.get(path)
+            self.assertIn("Notebook validation failed", model["message"])
+
+    def test_disabled(self):
+        self.contents_manager.notebook_check_cache_size = 0
+        path = self.path("nb.ipynb")
+        self.contents_manager.save(self.model, path)
+        _, validations, signatures = self.count_checks(
+            self.contents_manager.get, path)
+        self.assertEqual((validations, signatures), (1, 1))
+        self.assertFalse(self.contents_manager._notebook_checks)
+
+
+class RootListingTest(FakeGCSTestCase):
+    def setUp(self):
+        super(RootListingTest, self).setUp()
+        for i in range(20):
+            self.server.create_bucket("bucket%02d" % i)
+
+    def test_cached(self):
+        self.server.reset_stats()
+        model = self.contents_manager.get("")
+        self.assertEqual(len(model["content"]), 21)
+        self.assertTrue(all(m["writable"] for m in model["content"]))
+        self.assertEqual(self.server.rpc_count, 1)
+        self.server.reset_stats()
+        self.contents_manager.get("")
+        self.assertEqual(self.server.rpc_count, 0)
+        # the bucket metadata comes from the listing
+        self.contents_manager.get("bucket00")
+        self.assertNotIn("buckets.get", self.server.operations)
+
+    def test_ttl(self):
+        self.contents_manager.root_cache_ttl = 0
+        self.contents_manager.get("")
+        self.server.create_bucket("late")
+        names = [m["name"] for m in self.contents_manager.get("")["content"]]
+        self.assertIn("late", names)
+
+    def test_patterns(self):
+        self.contents_manager.root_bucket_patterns = ["bucket0*", "test"]
+        names = [m["name"] for m in self.contents_manager.get("")["content"]]
+        self.assertEqual(sorted(names), ["bucket0%d" % i for i in range(10)] +
+                         ["test"])
+
+    def test_allowlist(self):
+        self.server.forbidden.add("bucket01")
+        self.contents_manager.root_buckets = ["bucket00", "bucket01",
+                                              "missing"]
+        model = self.contents_manager.get("")
+        writable = {m["name"]: m["writable"] for m in model["content"]}
+        self.assertEqual(writable, {"bucket00": True, "bucket01": False})
+        self.assertNotIn("buckets.list", self.server.operations)
+
+    def test_invalidation(self):
+        self.contents_manager.get("")
+        self.contents_manager.save({"type": "directory"}, "fresh")
+        names = [m["name"] for m in self.contents_manager.get("")["content"]]
+        self.assertIn("fresh", names)
+        self.contents_manager.delete_file("fresh")
+        names = [m["name"] for m in self.contents_manager.get("")["content"]]
+        self.assertNotIn("fresh", names)
+
+
+class HiddenTest(FakeGCSTestCase):
+    def test_no_requests(self):
+        self.server.put_object(self.BUCKET, "dir/sub/file.txt", b"data")
+        self.server.put_object(self.BUCKET, "dir/.sub/file.txt", b"data")
+        self.assertTrue(self.contents_manager.is_hidden("unknown/.file"))
+        self.assertEqual(self.server.rpc_count, 0)
+        # the lookup done by is_hidden() is reused by get()
+        self.assertFalse(self.contents_manager.is_hidden(self.path("dir")))
+        self.contents_manager.get(self.path("dir"))
+        expected = self.server.rpc_count
+        manager = self.create_manager()
+        self.server.reset_stats()
+        model = manager.get(self.path("dir"))
+        self.assertEqual(self.server.rpc_count, expected)
+        self.assertEqual({m["name"]: m["writable"] for m in model["content"]},
+                         {"sub": True, ".sub": False})
+        self.server.reset_stats()
+        for path in ("", "dir", "dir/sub", "dir/.sub/file.txt"):
+            manager.is_hidden(self.path(path))
+        self.assertEqual(self.server.rpc_count, 0)
+
+    def test_inaccessible(self):
+        self.server.create_bucket("secret")
+        self.server.forbidden.add("secret")
+        for _ in range(2):
+            self.assertTrue(self.contents_manager.is_hidden("missing/x"))
+            self.assertTrue(self.contents_manager.is_hidden("secret/x"))
+        self.assertEqual(self.server.operations["buckets.get"], 2)
+        self.contents_manager.save({"type": "directory"}, "missing")
+        self.assertFalse(self.contents_manager.is_hidden("missing/x"))
+
+
+class RangeReadTest(FakeGCSTestCase):
+    def setUp(self):
+        super(RangeReadTest, self).setUp()
+        self.data = b"".join(b"line %d\n" % i for i in range(1000))
+        self.server.put_object(self.BUCKET, "log.txt", self.data)
+
+    def test_bytes(self):
+        self.server.reset_stats()
+        model = self.contents_manager.get(self.path("log.txt"), start=7,
+                                          end=14)
+        self.assertEqual(model["content"], "line 1\n")
+        self.assertEqual(model["format"], "text")
+        self.assertEqual(model["range"], {"start": 7, "end": 14,
+                                          "size": len(self.data)})
+        self.assertLess(self.server.bytes_sent, len(self.data) // 4)
+        model = self.contents_manager.get(self.path("log.txt"), start=-9)
+        self.assertEqual(model["content"], "line 999\n")
+        model = self.contents_manager.get(self.path("log.txt"),
+                                          start=len(self.data) + 10)
+        self.assertEqual(model["content"], "")
+
+    def test_lines(self):
+        self.contents_manager.range_chunk_size = 100
+        path = self.path("log.txt")
+        model = self.contents_manager.get(path, lines=30)
+        self.assertEqual(model["content"].splitlines(),
+                         ["line %d" % i for i in range(30)])
+        model = self.contents_manager.get(path, start=model["range"]["end"],
+                                          lines=2)
+        self.assertEqual(model["content"], "line 30\nline 31\n")
+        model = self.contents_manager.get(path, start=-18, lines=10)
+        self.assertEqual(model["content"], "line 998\nline 999\n")
+        self.assertEqual(model["range"]["end"], len(self.data))
+
+    def test_limits(self):
+        self.contents_manager.max_range_size = 10
+        model = self.contents_manager.get(self.path("log.txt"), start=0)
+        self.assertEqual(model["range"]["end"], 10)
+        with self.assertRaises(HTTPError) as e:
+            self.contents_manager.get(self.path("log.txt"), lines=-1)
+        self.assertEqual(e.exception.status_code, 400)
+        self.server.put_object(self.BUCKET, "nb.ipynb", b"{}")
+        with self.assertRaises(HTTPError) as e:
+            self.contents_manager.get(self.path("nb.ipynb"), start=0)
+        self.assertEqual(e.exception.status_code, 400)
+
+    def test_utf8(self):
+        self.server.put_object(self.BUCKET, "utf8.txt",
+                               u"привет".encode("utf-8"))
+        model = self.contents_manager.get(self.path("utf8.txt"), end=5)
+        self.assertEqual(model["content"], u"пр")
+        self.assertEqual(model["range"]["end"], 4)
+        model = self.contents_manager.get(self.path("utf8.txt"), end=5,
+                                          format="base64")
+        self.assertEqual(base64.b64decode(model["content"]),
+                         u"привет".encode("utf-8")[:5])
+
+
+class BatchTest(FakeGCSTestCase):
+    def test_delete_tree(self):
+        for i in range(250):
+            self.server.put_object(self.BUCKET, "tree/d%d/f%d" % (i % 3, i),
+                                   b"data")
+        self.server.put_object(self.BUCKET, "keep", b"data")
+        self.server.reset_stats()
+        self.contents_manager.delete_file(self.path("tree"))
+        self.assertEqual(self.server.round_trips["batch"], 3)
+        self.assertEqual(self.server.operations["objects.delete"], 250)
+        self.assertEqual(list(self.server.buckets[self.BUCKET].objects),
+                         ["keep"])
+
+    def test_rename_tree(self):
+        for i in range(5):
+            self.server.put_object(self.BUCKET, "old/sub/f%d" % i, b"%d" % i)
+        self.contents_manager.rename_file(self.path("old"), self.path("new"))
+        self.assertEqual(sorted(self.server.buckets[self.BUCKET].objects),
+                         ["new/sub/f%d" % i for i in range(5)])
+        self.assertEqual(self.server.round_trips["batch"], 1)
+
+    def test_checkpoints(self):
+        path = self.path("nb.ipynb")
+        self.contents_manager.save({"type": "notebook",
+                                    "content": make_notebook(100)}, path)
+        for _ in range(5):
+            self.contents_manager.create_checkpoint(path)
+        # save() has created one more
+        ids = {c["id"] for c in self.contents_manager.list_checkpoints(path)}
+        self.assertEqual(len(ids), 6)
+        self.server.reset_stats()
+        self.contents_manager.rename(path, self.path("renamed.ipynb"))
+        self.assertEqual(self.server.round_trips["batch"], 1)
+        self.assertEqual(self.server.operations["objects.delete"], 7)
+        self.assertEqual({c["id"] for c in self.contents_manager
+                          .list_checkpoints(self.path("renamed.ipynb"))}, ids)
+        self.assertFalse(self.contents_manager.list_checkpoints(path))
+        self.server.reset_stats()
+        self.contents_manager.delete(self.path("renamed.ipynb"))
+        self.assertEqual(self.server.operations["objects.delete"], 7)
+        self.assertLessEqual(self.server.rpc_count, 4)
+        self.assertEqual(self.server.buckets[self.BUCKET].objects, {})
+
+    def test_statuses(self):
+        bucket = self.contents_manager._get_bucket(self.BUCKET)
+        self.server.put_object(self.BUCKET, "a", b"a")
+        calls = [partial(bucket.delete_blob, name) for name in ("a", "b")]
+        self.assertEqual(self.contents_manager._batch(calls), [204, 404])
+        self.assertEqual(self.contents_manager._batch(calls[:1]), [404])
+        self.contents_manager._delete_blobs(bucket, ["a", "b"])
+
+    def test_root_probes(self):
+        names = ["bucket%03d" % i for i in range(150)]
+        for name in names[:140]:
+            self.server.create_bucket(name)
+        self.server.forbidden.add(names[0])
+        self.contents_manager.root_buckets = names
+        self.server.reset_stats()
+        model = self.contents_manager.get("")
+        self.assertEqual(self.server.rpc_count, 2)
+        writable = {m["name"]: m["writable"] for m in model["content"]}
+        self.assertEqual(len(writable), 140)
+        self.assertFalse(writable[names[0]])
+        self.assertTrue(writable[names[1]])
+        self.server.reset_stats()
+        self.contents_manager.get(names[1])
+        self.assertNotIn("buckets.get", self.server.operations)
+
+
+class RequestScopeTest(FakeGCSTestCase):
+    def test_get(self):
+        self.server.put_object(self.BUCKET, "f.txt", b"one")
+        self.contents_manager.get(self.path("f.txt"))
+        self.server.reset_stats()
+        self.assertEqual(self.contents_manager.get(
+            self.path("f.txt"))["content"], "one")
+        self.assertEqual(self.server.operations["objects.get"], 1)
+        # the memo does not outlive the call
+        self.server.put_object(self.BUCKET, "f.txt", b"two")
+        self.assertEqual(self.contents_manager.get(
+            self.path("f.txt"))["content"], "two")
+        self.assertIsNone(self.contents_manager._request_memo())
+
+    def test_save(self):
+        self.contents_manager.get(self.path(""))
+        self.server.reset_stats()
+        model = self.contents_manager.save(
+            {"type": "file", "format": "text", "content": "x"},
+            self.path("f.txt"))
+        self.assertEqual(model["name"], "f.txt")
+        self.assertEqual(dict(self.server.operations), {"objects.insert": 1})
+
+    def test_writes(self):
+        self.server.reset_stats()
+        model = self.contents_manager.new_untitled(self.path(""),
+                                                   type="file")
+        self.assertEqual(model["path"], self.path("untitled"))
+        self.assertEqual(self.server.operations["objects.get"], 1)
+        model = self.contents_manager.new_untitled(self.path(""),
+                                                   type="file")
+        self.assertEqual(model["path"], self.path("untitled1"))
+        self.contents_manager.update({"path": self.path("renamed")},
+                                     self.path("untitled"))
+        self.assertFalse(self.contents_manager.file_exists(
+            self.path("untitled")))
+        self.assertTrue(self.contents_manager.file_exists(
+            self.path("renamed")))
+
+    def test_uncached_buckets(self):
+        self.contents_manager.cache_buckets = False
+        self.server.put_object(self.BUCKET, "f.txt", b"one")
+        self.server.reset_stats()
+        self.contents_manager.get(self.path("f.txt"))
+        self.assertEqual(self.server.operations["buckets.get"], 1)
+
+
+class OutputBlobsTest(FakeGCSTestCase):
+    def setUp(self):
+        super(OutputBlobsTest, self).setUp()
+        self.contents_manager.output_blob_threshold = 1000
+        self.contents_manager.notary.db_file = ":memory:"
+        self.nb = new_notebook()
+        self.image = base64.b64encode(os.urandom(100000)).decode()
+        self.nb.cells.append(new_code_cell("plot()", outputs=[new_output(
+            "display_data", data={"image/png": self.image,
+                                  "text/plain": "<Figure>"})]))
+        self.nb.cells.append(new_code_cell("data", outputs=[new_output(
+            "execute_result", execution_count=1, data={
+                "application/json": {"x": "y" * 2000}})]))
+        self.path = "%s/dir/nb.ipynb" % self.BUCKET
+
+    def objects(self, bucket=None):
+        return self.server.buckets[bucket or self.BUCKET].objects
+
+    def test_round_trip(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        outputs = [n for n in self.objects() if n.startswith(".ipynb_out")]
+        self.assertEqual(len(outputs), 2)
+        stored = self.objects()["dir/nb.ipynb"].data
+        self.assertLess(len(stored), 2000)
+        nbformat.validate(nbformat.reads(stored.decode(), 4))
+        model = self.contents_manager.get(self.path)
+        for cell in model["content"].cells:
+            del cell.metadata["trusted"]
+        self.assertEqual(model["content"], self.nb)
+
+    def test_autosave(self):
+        model = {"type": "notebook", "content": self.nb}
+        self.contents_manager.save(model, self.path)
+        self.nb.cells[1].source = "changed"
+        self.server.reset_stats()
+        self.contents_manager.save(model, self.path)
+        self.assertLess(self.server.bytes_received, 5000)
+        self.assertNotIn("batch", self.server.round_trips)
+        # a restarted server checks the existence once
+        manager = self.create_manager(output_blob_threshold=1000)
+        manager.notary.db_file = ":memory:"
+        self.server.reset_stats()
+        manager.save(model, self.path)
+        self.assertLess(self.server.bytes_received, 8000)
+        self.assertEqual(self.server.round_trips["batch"], 1)
+
+    def test_disabled_reads(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        manager = self.create_manager()
+        nb = manager.get(self.path)["content"]
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"], self.image)
+
+    def test_rename_to_other_bucket(self):
+        self.server.create_bucket("other")
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        self.contents_manager.rename_file(self.path, "other/nb.ipynb")
+        self.assertNotIn("dir/nb.ipynb", self.objects())
+        nb = self.contents_manager.get("other/nb.ipynb")["content"]
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"], self.image)
+        self.assertEqual(len(self.objects("other")), 3)
+
+    def test_rename_checkpoints_to_other_bucket(self):
+        self.server.create_bucket("other")
+        model = {"type": "notebook", "content": self.nb}
+        self.contents_manager.save(model, self.path)
+        # the checkpoint keeps the first image
+        self.nb.cells[0].outputs[0].data["image/png"] = \
+            base64.b64encode(os.urandom(100000)).decode()
+        self.contents_manager.save(model, self.path)
+        self.contents_manager.rename(self.path, "other/nb.ipynb")
+        checkpoint = self.contents_manager.list_checkpoints(
+            "other/nb.ipynb")[0]
+        self.contents_manager.restore_checkpoint(checkpoint["id"],
+                                                 "other/nb.ipynb")
+        nb = self.contents_manager.get("other/nb.ipynb")["content"]
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"], self.image)
+
+    def outputs(self):
+        return sorted(n[len(".ipynb_outputs/"):] for n in self.objects()
+                      if n.startswith(".ipynb_outputs/"))
+
+    def test_raw_download(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        model = self.contents_manager.get(self.path, type="file")
+        nb = nbformat.reads(model["content"], 4)
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"], self.image)
+        self.assertNotIn("jgscm_outputs", model["content"])
+        part = self.contents_manager.get(self.path, type="file", start=-100)
+        self.assertEqual(part["range"]["size"], len(model["content"]))
+        self.assertEqual(part["content"], model["content"][-100:])
+
+    def test_digests_in_metadata(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        metadata = self.objects()["dir/nb.ipynb"].metadata
+        self.assertEqual(metadata["jgscm_outputs"], ",".join(self.outputs()))
+
+    def test_collect_outputs(self):
+        self.contents_manager.output_gc_min_age = 0
+        model = {"type": "notebook", "content": self.nb}
+        self.contents_manager.save(model, self.path)
+        old = self.outputs()
+        self.nb.cells[0].outputs[0].data["image/png"] = \
+            base64.b64encode(os.urandom(100000)).decode()
+        self.contents_manager.save(model, self.path)
+        self.assertEqual(len(self.outputs()), 3)
+        # the checkpoint refers to the first version
+        self.assertEqual(self.contents_manager.collect_outputs(self.BUCKET), 0)
+        checkpoint = [n for n in self.objects() if "checkpoint" in n][0]
+        # saved before the digests were kept in the metadata
+        self.objects()[checkpoint].metadata["jgscm_outputs"] = "true"
+        self.assertEqual(self.contents_manager.collect_outputs(self.BUCKET), 0)
+        del self.objects()[checkpoint]
+        self.assertEqual(self.contents_manager.collect_outputs(self.BUCKET), 1)
+        self.assertEqual(len(set(old) - set(self.outputs())), 1)
+        nb = self.contents_manager.get(self.path)["content"]
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"],
+                         self.nb.cells[0].outputs[0].data["image/png"])
+        # the deleted output is uploaded again
+        self.contents_manager.save({"type": "notebook", "content": new_notebook(
+            cells=[new_code_cell("plot()", outputs=[new_output(
+                "display_data", data={"image/png": self.image})])])},
+            self.BUCKET + "/other.ipynb")
+        self.assertEqual(len(self.outputs()), 3)
+        self.contents_manager.get(self.BUCKET + "/other.ipynb")
+
+    def test_saves_during_collection(self):
+        manager = self.contents_manager
+        manager.output_gc_delay = -1
+        manager.output_gc_min_age = 0
+        manager.save({"type": "notebook", "content": self.nb}, self.path)
+        manager.delete(self.path)
+        other = new_notebook(cells=[new_code_cell("x", outputs=[new_output(
+            "display_data", data={"text/html": "z" * 5000})])])
+        reused = new_notebook(cells=[new_code_cell("plot()", outputs=[
+            new_output("display_data", data={"image/png": self.image})])])
+        delete = manager._delete_blobs
+        threads = []
+
+        def save(nb, name):
+            thread = threading.Thread(target=manager.save, args=(
+                {"type": "notebook", "content": nb},
+                "%s-%s.ipynb" % (self.path[:-6], name)))
+            thread.start()
+            threads.append(thread)
+            return thread
+
+        def delete_blobs(bucket, names):
+            if not threads and names[0].startswith(".ipynb_outputs/"):
+                # the other outputs are saved while the sweep deletes
+                save(other, "other").join(10)
+                self.assertFalse(threads[0].is_alive())
+                # the save which uses a deleted output waits for the delete
+                save(reused, "reused").join(0.2)
+                self.assertTrue(threads[1].is_alive())
+            return delete(bucket, names)
+
+        # the notary database can not be used by the saving threads
+        with mock.patch.object(manager, "_delete_blobs",
+                               side_effect=delete_blobs), \
+                mock.patch.object(manager, "_check_and_sign"), \
+                mock.patch.object(manager, "_mark_trusted_cells"):
+            self.assertEqual(manager.collect_outputs(self.BUCKET), 2)
+            for thread in threads:
+                thread.join(10)
+        nb = manager.get(self.path[:-6] + "-reused.ipynb")["content"]
+        self.assertEqual(nb.cells[0].outputs[0].data["image/png"], self.image)
+        self.assertEqual(len(self.outputs()), 2)
+
+    def test_min_age(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        self.contents_manager.delete(self.path)
+        self.assertEqual(self.contents_manager.collect_outputs(self.BUCKET), 0)
+        self.assertEqual(len(self.outputs()), 2)
+
+    def test_scheduled_collection(self):
+        self.contents_manager.output_gc_delay = -1
+        self.contents_manager.output_gc_min_age = 0
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+        self.contents_manager.output_gc_delay = 0
+        self.contents_manager.delete(self.path)
+        deadline = time.time() + 10
+        while self.outputs() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.outputs(), [])
+
+
+class SegmentedSaveTest(FakeGCSTestCase):
+    def setUp(self):
+        super(SegmentedSaveTest, self).setUp()
+        self.contents_manager.segmented_save_threshold = 10000
+        self.contents_manager.segment_size = 4096
+        self.contents_manager.notary.db_file = ":memory:"
+        # the segment boundaries depend on the contents, including the ids
+        rnd = random.Random(0)
+        self.nb = new_notebook(cells=[
+            new_code_cell("x = %d  # %s" % (i, bytes(
+                rnd.getrandbits(8) for _ in range(300)).hex()),
+                id="cell-%d" % i)
+            for i in range(400)])
+        self.path = "%s/nb.ipynb" % self.BUCKET
+
+    def objects(self):
+        return self.server.buckets[self.BUCKET].objects
+
+    def segments(self):
+        return sorted(n for n in self.objects()
+                      if n.startswith(".ipynb_segments/"))
+
+    def save(self):
+        self.contents_manager.save({"type": "notebook", "content": self.nb},
+                                   self.path)
+
+    def get(self):
+        nb = self.contents_manager.get(self.path)["content"]
+        for cell in nb.cells:
+            del cell.metadata["trusted"]
+        return nb
+
+    def test_round_trip(self):
+        self.save()
+        # the notebook and the checkpoint
+        self.assertEqual(self.server.operations["objects.compose"], 2)
+        self.assertEqual(self.server.operations["objects.insert"],
+                         len(self.segments()))
+        stored = self.objects()["nb.ipynb"].data
+        self.assertEqual(stored, self.contents_manager._writes_notebook(
+            self.nb))
+        self.assertLessEqual(len(self.segments()), 32)
+        self.assertGreater(len(self.segments()), 10)
+        self.assertEqual(self.get(), self.nb)
+
+    def test_incremental(self):
+        self.save()
+        size = len(self.objects()["nb.ipynb"].data)
+        before = self.segments()
+        self.nb.cells[200].source = "changed"
+        self.server.reset_stats()
+        self.save()
+        self.assertLess(self.server.bytes_received, size / 5)
+        self.assertEqual(self.objects()["nb.ipynb"].data,
+                         self.contents_manager._writes_notebook(self.nb))
+        after = self.segments()
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+        self.assertEqual(len(after), len(before))
+
+    def test_lost_segments(self):
+        self.save()
+        for name in self.segments():
+            del self.objects()[name]
+        self.nb.cells[0].source = "changed"
+        self.save()
+        self.assertEqual(self.get(), self.nb)
+
+    def test_segments_deleted_concurrently(self):
+        self.save()
+        count = len(self.segments())
+        upload = self.contents_manager._upload_blobs
+        calls = []
+
+        def delete_and_upload(*args):
+            if not calls:
+                # a copy is deleted after the check, before the compose
+                for name in self.segments()[:3]:
+                    del self.objects()[name]
+            calls.append(args)
+            return upload(*args)
+
+        with mock.patch.object(self.contents_manager, "_upload_blobs",
+                               side_effect=delete_and_upload):
+            self.contents_manager.save(
+                {"type": "notebook", "content": self.nb},
+                self.BUCKET + "/copy.ipynb")
+        self.assertEqual(len(calls[1][2]), 3)
+        self.assertEqual(len(self.segments()), count)
+        nb = self.contents_manager.get(self.BUCKET + "/copy.ipynb")["content"]
+        self.assertEqual(len(nb.cells), len(self.nb.cells))
+
+    def test_delete(self):
+        self.save()
+        self.contents_manager.delete(self.path)
+        self.assertEqual(self.segments(), [])
+        self.server.create_bucket("other")
+        self.save()
+        self.contents_manager.rename_file(self.path, "other/nb.ipynb")
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.contents_manager.get("other/nb.ipynb")[
+            "content"].cells[0].source, self.nb.cells[0].source)
+        self.save()
+        self.assertTrue(self.segments())
+        results = self.contents_manager.bulk("delete", [self.path])
+        self.assertEqual(results[0]["status"], 200)
+        self.assertEqual(self.segments(), [])
+
+    def test_small(self):
+        self.nb.cells = self.nb.cells[:2]
+        self.save()
+        self.assertNotIn("objects.compose", self.server.operations)
+        self.assertEqual(self.segments(), [])
+
+
+class WriteBehindTest(FakeGCSTestCase):
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.journal_dir)
+        self.contents_manager = self.create_manager()
+        self.file = self.path("dir/file.txt")
+
+    def create_manager(self, **config):
+        config.setdefault("write_behind_delay", 3600)
+        manager = super(WriteBehindTest, self).create_manager(
+            write_behind_dir=getattr(self, "journal_dir", ""), **config)
+        self.addCleanup(lambda: manager._write_journal and
+                        manager._write_journal.close())
+        return manager
+
+    def save(self, text, manager=None):
+        return (manager or self.contents_manager).save(
+            {"type": "file", "format": "text", "content": text}, self.file)
+
+    def objects(self):
+        return self.server.buckets[self.BUCKET].objects
+
+    def journal_files(self):
+        return [n for n in os.listdir(self.journal_dir)
+                if n.endswith(".write")]
+
+    def test_read_your_writes(self):
+        self.server.put_object(self.BUCKET, "dir/other.txt", b"other")
+        self.server.reset_stats()
+        model = self.save("one")
+        self.assertEqual(model["name"], "file.txt")
+        self.assertNotIn("objects.insert", self.server.operations)
+        self.assertEqual(len(self.journal_files()), 1)
+        cm = self.contents_manager
+        self.assertEqual(cm.get(self.file)["content"], "one")
+        self.assertTrue(cm.file_exists(self.file))
+        self.assertEqual(cm.get(self.file, start=1)["content"], "ne")
+        listing = cm.get(self.path("dir"))["content"]
+        self.assertEqual(sorted(m["name"] for m in listing),
+                         ["file.txt", "other.txt"])
+        self.assertTrue(cm.dir_exists(self.path("dir")))
+        cm.write_journal.flush()
+        self.assertEqual(self.objects()["dir/file.txt"].data, b"one")
+        self.assertEqual(self.journal_files(), [])
+
+    def test_coalesce(self):
+        for text in ("one", "two", "three"):
+            self.save(text)
+        self.server.reset_stats()
+        self.contents_manager.write_journal.flush()
+        self.assertEqual(self.server.operations["objects.insert"], 1)
+        self.assertEqual(self.objects()["dir/file.txt"].data, b"three")
+
+    def test_background(self):
+        self.contents_manager.write_behind_delay = 0.01
+        self.save("one")
+        deadline = time.time() + 10
+        while self.journal_files() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.objects()["dir/file.txt"].data, b"one")
+
+    def test_notebook(self):
+        path = self.path("nb.ipynb")
+        nb = new_notebook(cells=[new_code_cell("1 + 1")])
+        self.contents_manager.save({"type": "notebook", "content": nb}, path)
+        self.assertEqual(
+            self.contents_manager.get(path)["content"].cells[0].source,
+            "1 + 1")
+        self.contents_manager.write_journal.flush()
+        self.assertIn("nb.ipynb", self.objects())
+        self.assertEqual(
+            len(self.contents_manager.list_checkpoints(path)), 1)
+
+    def test_notebook_background(self):
+        self.contents_manager.write_behind_delay = 0.01
+        path = self.path("nb.ipynb")
+        nb = new_notebook(cells=[new_code_cell("1 + 1")])
+        self.contents_manager.save({"type": "notebook", "content": nb}, path)
+        deadline = time.time() + 10
+        while self.journal_files() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.journal_files(), [])
+        checkpoints = self.contents_manager.list_checkpoints(path)
+        self.assertEqual(len(checkpoints), 1)
+        self.contents_manager.restore_checkpoint(checkpoints[0]["id"], path)
+        self.assertEqual(
+            self.contents_manager.get(path)["content"].cells[0].source,
+            "1 + 1")
+
+    def test_default_path(self):
+        manager = self.create_manager(default_path=self.BUCKET)
+        model = manager.save({"type": "file", "format": "text",
+                              "content": "one"}, "sub/x.txt")
+        self.assertEqual(model["name"], "x.txt")
+        self.assertEqual(manager.get("sub/x.txt")["content"], "one")
+        self.assertTrue(manager.dir_exists("sub"))
+        self.assertEqual([m["name"] for m in manager.get("sub")["content"]],
+                         ["x.txt"])
+        self.assertNotIn("sub/x.txt", self.objects())
+        manager.rename_file("sub/x.txt", "sub/y.txt")
+        self.assertEqual(self.journal_files(), [])
+        self.assertEqual(self.objects()["sub/y.txt"].data, b"one")
+
+    def test_recovery(self):
+        self.save("one")
+        self.assertRaises(RuntimeError, lambda: self.create_manager()
+                          .write_journal)
+        self.contents_manager.write_journal.close()
+        manager = self.create_manager()
+        self.assertEqual(manager.get(self.file)["content"], "one")
+        manager.write_journal.flush()
+        self.assertEqual(self.objects()["dir/file.txt"].data, b"one")
+
+    def test_delete_and_rename(self):
+        self.save("one")
+        self.contents_manager.rename_file(self.file, self.path("dir/new.txt"))
+        self.assertEqual(self.objects()["dir/new.txt"].data, b"one")
+        self.save("two")
+        self.contents_manager.delete_file(self.path("dir"))
+        self.assertEqual(self.journal_files(), [])
+        self.assertEqual(list(self.objects()), [])
+
+
+class DiskCacheTest(FakeGCSTestCase):
+    def setUp(self):
+        super(DiskCacheTest, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.contents_manager.disk_cache_dir = self.cache_dir
+        self.file = self.path("data.txt")
+
+    def cached_files(self):
+        return [n for n in os.listdir(self.cache_dir) if n.endswith(".blob")]
+
+    def test_read_through(self):
+        self.server.put_object(self.BUCKET, "data.txt", b"x" * 1000)
+        self.assertEqual(self.contents_manager.get(self.file)["content"],
+                         "x" * 1000)
+        self.server.reset_stats()
+        # a restarted server reuses the cache
+        manager = self.create_manager(disk_cache_dir=self.cache_dir)
+        self.assertEqual(manager.get(self.file)["content"], "x" * 1000)
+        self.assertNotIn("objects.download", self.server.operations)
+        self.assertEqual(self.server.operations["objects.get"], 1)
+        # a new generation is downloaded
+        self.server.put_object(self.BUCKET, "data.txt", b"y")
+        self.assertEqual(manager.get(self.file)["content"], "y")
+        self.assertEqual(self.server.operations["objects.download"], 1)
+
+    def test_write_through(self):
+        nb = new_notebook(cells=[new_code_cell("1 + 1")])
+        path = self.path("nb.ipynb")
+        self.contents_manager.save({"type": "notebook", "content": nb}, path)
+        self.server.reset_stats()
+        model = self.contents_manager.get(path)
+        self.assertEqual(model["content"].cells[0].source, "1 + 1")
+        self.assertNotIn("objects.download", self.server.operations)
+
+    def test_corrupted(self):
+        self.server.put_object(self.BUCKET, "data.txt", b"abc")
+        self.contents_manager.get(self.file)
+        name, = self.cached_files()
+        with open(os.path.join(self.cache_dir, name), "wb") as fout:
+            fout.write(b"ab")
+        self.assertEqual(self.contents_manager.get(self.file)["content"],
+                         "abc")
+
+    def test_eviction(self):
+        self.contents_manager.disk_cache_size = 10000
+        for i in range(30):
+            self.server.put_object(self.BUCKET, "%d.txt" % i, b"x" * 900)
+            self.contents_manager.get(self.path("%d.txt" % i))
+            if i == 0:
+                os.utime(os.path.join(self.cache_dir, self.cached_files()[0]),
+                         (0, 0))
+        sizes = [os.path.getsize(os.path.join(self.cache_dir, n))
+                 for n in self.cached_files()]
+        self.assertLessEqual(sum(sizes), 10000)
+        self.assertGreater(len(sizes), 5)
+        self.server.reset_stats()
+        self.contents_manager.get(self.path("29.txt"))
+        self.assertNotIn("objects.download", self.server.operations)
+        self.contents_manager.get(self.path("0.txt"))
+        self.assertEqual(self.server.operations["objects.download"], 1)
+
+
+class PrefetchTest(FakeGCSTestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.contents_manager.prefetch_max_size = 10000
+        self.contents_manager.prefetch_max_files = 3
+        self.contents_manager.notary.db_file = ":memory:"
+        nb = new_notebook(cells=[new_code_cell("1 + 1")])
+        for name in ("a.ipynb", "b.ipynb"):
+            self.server.put_object(self.BUCKET, "dir/" + name, nbformat.writes(
+                nb).encode(), "application/x-ipynb+json")
+        self.server.put_object(self.BUCKET, "dir/small.txt", b"small")
+        self.server.put_object(self.BUCKET, "dir/big.txt", b"x" * 20000)
+        self.server.put_object(self.BUCKET, "dir/more.txt", b"more")
+
+    def list(self, path="dir"):
+        self.contents_manager.get(self.path(path))
+        self.contents_manager.prefetcher.wait()
+
+    def test_prefetch(self):
+        self.list()
+        prefetcher = self.contents_manager.prefetcher
+        self.assertEqual(prefetcher.stats["files"], 3)
+        self.assertGreater(prefetcher.bandwidth, 0)
+        self.server.reset_stats()
+        model = self.contents_manager.get(self.path("dir/a.ipynb"))
+        self.assertEqual(model["content"].cells[0].source, "1 + 1")
+        self.contents_manager.get(self.path("dir/b.ipynb"))
+        self.assertEqual(sum(self.server.operations.values()), 0)
+        self.assertEqual(prefetcher.stats["hits"], 2)
+        # the big file and the files beyond the limit are not prefetched
+        self.contents_manager.get(self.path("dir/big.txt"))
+        self.assertEqual(self.server.operations["objects.download"], 1)
+
+    def test_navigation(self):
+        self.list()
+        self.list("")
+        self.server.reset_stats()
+        self.contents_manager.get(self.path("dir/a.ipynb"))
+        self.assertEqual(self.server.operations["objects.download"], 1)
+
+    def test_write_invalidates(self):
+        self.list()
+        self.contents_manager.save({"type": "file", "format": "text",
+                                    "content": "new"},
+                                   self.path("dir/small.txt"))
+        self.assertEqual(
+            self.contents_manager.get(self.path("dir/small.txt"))["content"],
+            "new")
+        self.contents_manager.delete_file(self.path("dir/a.ipynb"))
+        self.assertRaises(HTTPError, self.contents_manager.get,
+                          self.path("dir/a.ipynb"))
+
+
+class HedgeTest(FakeGCSTestCase):
+    def test_slow_lookup(self):
+        calls = []
+
+        def latency(operation):
+            if operation != "objects.get":
+                return 0
+            calls.append(operation)
+            return 1.0 if len(calls) == 30 else 0.001
+
+        self.server.latency = latency
+        self.server.put_object(self.BUCKET, "file.txt", b"data")
+        manager = self.create_manager(hedge_reads=True, hedge_max_rate=0.5)
+        elapsed = []
+        for _ in range(40):
+            start = time.time()
+            self.assertTrue(manager.file_exists(self.path("file.txt")))
+            elapsed.append(time.time() - start)
+        self.assertLess(max(elapsed), 0.5)
+        stats = manager.hedger.stats
+        self.assertEqual(stats["blob.calls"], 40)
+        self.assertGreaterEqual(stats["blob.hedged"], 1)
+        self.assertGreaterEqual(stats["blob.wins"], 1)
+        self.assertLessEqual(stats["blob.hedged"], 20)
+
+    def test_errors(self):
+        hedger = Hedger(50, 0.01, 1.0)
+        for _ in range(Hedger.MIN_SAMPLES):
+            hedger.call("x", lambda: None)
+        attempts = []
+
+        def fail():
+            attempts.append(None)
+            time.sleep(0.05)
+            raise ValueError(len(attempts))
+
+        self.assertRaises(ValueError, hedger.call, "x", fail)
+        self.assertEqual(len(attempts), 2)
+
+        def slow_then_fast():
+            attempts.append(None)
+            if len(attempts) == 3:
+                time.sleep(0.05)
+                raise ValueError()
+            return "ok"
+
+        self.assertEqual(hedger.call("x", slow_then_fast), "ok")
+        self.assertEqual(hedger.stats["x.wins"], 1)
+
+
+class AdmissionTest(FakeGCSTestCase):
+    def test_limits(self):
+        self.server.put_object(self.BUCKET, "small.txt", b"x" * 100)
+        self.server.put_object(self.BUCKET, "big.txt", b"x" * 1000)
+        manager = self.create_manager(transfer_memory_limit=1000)
+        self.assertEqual(manager.get(self.path("small.txt"))["content"],
+                         "x" * 100)
+        with self.assertRaises(HTTPError) as e:
+            manager.get(self.path("big.txt"))
+        self.assertEqual(e.exception.status_code, 413)
+        # the metadata needs no memory
+        manager.get(self.path("big.txt"), content=False)
+        with self.assertRaises(HTTPError) as e:
+            manager.save({"type": "file", "format": "text",
+                          "content": "x" * 600}, self.path("new.txt"))
+        self.assertEqual(e.exception.status_code, 413)
+        budget = manager.memory_budget
+        self.assertEqual(budget.usage, {"used": 0, "limit": 1000,
+                                        "waiting": 0})
+        self.assertEqual(budget.stats["admitted"], 1)
+        self.assertEqual(budget.stats["too_large"], 2)
+
+    def test_notebook_reserved_before_serializing(self):
+        manager = self.create_manager(transfer_memory_limit=100000)
+        nb = make_notebook(100000)
+        with mock.patch.object(manager, "_writes_notebook") as writes:
+            with self.assertRaises(HTTPError) as e:
+                manager.save({"type": "notebook", "content": nb},
+                             self.path("nb.ipynb"))
+        self.assertEqual(e.exception.status_code, 413)
+        writes.assert_not_called()
+        manager.transfer_memory_limit = 1 << 20
+        manager._memory_budget = None
+        manager.save({"type": "notebook", "content": nb},
+                     self.path("nb.ipynb"))
+        self.assertEqual(manager.memory_budget.usage["used"], 0)
+
+    def test_first_checkpoint(self):
+        # the save and the read of the checkpoint do not fit at once
+        manager = self.create_manager(transfer_memory_limit=1 << 20,
+                                      transfer_memory_timeout=0.05)
+        path = self.path("nb.ipynb")
+        manager.save({"type": "notebook", "content": make_notebook(
+            192 * 1024)}, path)
+        self.assertEqual(len(manager.list_checkpoints(path)), 1)
+        self.assertEqual(manager.memory_budget.usage["used"], 0)
+
+    def test_busy(self):
+        self.server.put_object(self.BUCKET, "file.txt", b"x" * 100)
+        manager = self.create_manager(transfer_memory_limit=1000,
+                                      transfer_memory_timeout=0.05)
+        with manager.memory_budget.reserve(800):
+            with self.assertRaises(HTTPError) as e:
+                manager.get(self.path("file.txt"))
+            self.assertEqual(e.exception.status_code, 503)
+        self.assertEqual(manager.memory_budget.stats["rejected"], 1)
+        self.assertEqual(manager.get(self.path("file.txt"))["content"],
+                         "x" * 100)
+
+    def test_queue(self):
+        budget = MemoryBudget(100, 10)
+        budget.acquire(60)
+        done = []
+        thread = threading.Thread(target=lambda: done.append(
+            budget.acquire(50)))
+        thread.start()
+        while budget.usage["waiting"] == 0:
+            time.sleep(0.001)
+        self.assertFalse(done)
+        budget.release(60)
+        thread.join()
+        self.assertEqual(budget.usage["used"], 50)
+        self.assertEqual(budget.stats["queued"], 1)
+        self.assertEqual(budget.stats["peak"], 60)
+
+
+class IntegrityTest(FakeGCSTestCase):
+    def save(self, content, manager=None):
+        (manager or self.contents_manager).save(
+            {"type": "file", "format": "text", "content": content},
+            self.path("file.txt"))
+
+    def test_corrupted_upload(self):
+        self.save("old")
+        self.server.corrupt["objects.insert"] = 1
+        with self.assertRaises(HTTPError) as e:
+            self.save("new")
+        self.assertIn("CRC32C", e.exception.log_message)
+        self.assertEqual(self.server.buckets[self.BUCKET].objects[
+            "file.txt"].data, b"old")
+        # resumable uploads send the checksum with the last chunk
+        data = "x" * (9 << 20)
+        self.server.corrupt["objects.insert"] = 1
+        self.assertRaises(HTTPError, self.save, data)
+        self.save(data)
+        self.assertEqual(len(self.server.buckets[self.BUCKET].objects[
+            "file.txt"].data), len(data))
+
+    def test_corrupted_download(self):
+        self.server.put_object(self.BUCKET, "file.txt", b"data")
+        self.server.corrupt["objects.download"] = 1
+        self.assertEqual(
+            self.contents_manager.get(self.path("file.txt"))["content"],
+            "data")
+        self.assertEqual(self.server.operations["objects.download"], 2)
+        self.server.corrupt["objects.download"] = 2
+        with self.assertRaises(HTTPError) as e:
+            self.contents_manager.get(self.path("file.txt"))
+        self.assertEqual(e.exception.status_code, 502)
+
+    def test_corruption_before_storage_3(self):
+        # google-cloud-storage < 3.0 has no exceptions module
+        common = type(sys)("google.resumable_media.common")
+        common.DataCorruption = type("DataCorruption", (Exception,), {})
+        with mock.patch.dict(sys.modules, {
+                "google.cloud.storage.exceptions": None,
+                "google.resumable_media.common": common}):
+            self.assertTrue(_is_corrupted(common.DataCorruption(None)))
+            self.assertFalse(_is_corrupted(ValueError()))
+
+    def test_md5(self):
+        manager = self.create_manager(checksum="md5")
+        self.assertEqual(manager.checksum_type, "md5")
+        self.save("old", manager)
+        self.server.corrupt["objects.insert"] = 1
+        with self.assertRaises(HTTPError) as e:
+            self.save("new", manager)
+        self.assertIn("MD5", e.exception.log_message)
+        self.assertIsNone(self.create_manager(checksum="").checksum_type)
+
+
+class SearchTest(FakeGCSTestCase):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        for name in ("top.ipynb", "dir/Sales 2023.ipynb", "dir/sub/sales.csv",
+                     "dir/sub/other.txt", "dir/.hidden/sales.txt",
+                     "dir/.ipynb_checkpoints/sales-checkpoint.ipynb",
+                     "other/sales.txt", "dir/sub/"):
+            self.server.put_object(self.BUCKET, name, b"{}")
+        for i in range(30):
+            self.server.put_object(self.BUCKET, "many/%02d.txt" % i, b"")
+
+    def search(self, path, query, manager=None):
+        pages = list((manager or self.contents_manager).search(
+            self.path(path), query))
+        self.assertEqual(pages[-1].models, [])
+        return [m["path"] for p in pages for m in p.models], pages[-1]
+
+    def test_substring(self):
+        paths, last = self.search("dir", "SALES")
+        self.assertEqual(paths, [self.path("dir/Sales 2023.ipynb"),
+                                 self.path("dir/sub/sales.csv")])
+        self.assertFalse(last.truncated)
+        # matchGlob filters the listing on the server, the hidden files are
+        # filtered here
+        self.assertEqual(last.scanned, 4)
+        self.assertEqual(self.server.operations["objects.list"], 1)
+
+    def test_glob(self):
+        self.assertEqual(self.search("dir", "*.ipynb")[0],
+                         [self.path("dir/Sales 2023.ipynb")])
+        self.assertEqual(self.search("", "s*.{csv,txt}")[0],
+                         [self.path("dir/sub/sales.csv"),
+                          self.path("other/sales.txt")])
+        self.assertEqual(self.search("dir", "sub/*")[0],
+                         [self.path("dir/sub/other.txt"),
+                          self.path("dir/sub/sales.csv")])
+        self.assertEqual(self.search("dir", "[!s]*.txt")[0],
+                         [self.path("dir/sub/other.txt")])
+        self.assertEqual(self.search("dir", "*[*]*")[0], [])
+
+    def test_server_glob(self):
+        self.assertEqual(NameMatcher("dir/", "*.ipynb").glob,
+                         "dir/**/*.ipynb")
+        self.assertEqual(NameMatcher("", "ab").glob, "**/*[aA][bB]*")
+        self.assertEqual(NameMatcher("", "").glob, "**")
+        # "**/" also matches no directory
+        paths, last = self.search("", "*.ipynb")
+        self.assertEqual(paths, [self.path("dir/Sales 2023.ipynb"),
+                                 self.path("top.ipynb")])
+        self.assertEqual(last.scanned, 3)
+
+    def test_limits(self):
+        manager = self.create_manager(search_max_results=5)
+        paths, last = self.search("many", ".txt", manager)
+        self.assertEqual(len(paths), 5)
+        self.assertTrue(last.truncated)
+        manager = self.create_manager(search_max_scan=10)
+        paths, last = self.search("many", ".txt", manager)
+        self.assertEqual(len(paths), 10)
+        self.assertEqual(last.scanned, 10)
+        self.assertTrue(last.truncated)
+        paths, last = self.search("dir", "sales", manager)
+        self.assertFalse(last.truncated)
+        self.assertRaises(HTTPError, list,
+                          self.contents_manager.search("", "x"))
+        self.assertRaises(HTTPError, list,
+                          self.contents_manager.search("nope/dir", "x"))
+        self.assertRaises(HTTPError, list,
+                          self.contents_manager.search(self.BUCKET, ""))
+
+    def test_index(self):
+        manager = self.create_manager(search_index_ttl=60)
+        self.assertEqual(len(self.search("", "sales", manager)[0]), 3)
+        self.server.reset_stats()
+        self.assertEqual(self.search("dir/sub", "*.csv", manager)[0],
+                         [self.path("dir/sub/sales.csv")])
+        self.assertEqual(len(self.search("", "0?.txt", manager)[0]), 10)
+        self.assertNotIn("objects.list", self.server.operations)
+        manager.save({"type": "file", "format": "text", "content": ""},
+                     self.path("dir/new sales.txt"))
+        self.server.reset_stats()
+        self.assertEqual(len(self.search("dir", "sales", manager)[0]), 3)
+        self.assertEqual(self.server.operations["objects.list"], 1)
+
+
+class PrefixIndexTest(FakeGCSTestCase):
+    def setUp(self):
+        super(PrefixIndexTest, self).setUp()
+        for i in range(20):
+            self.server.put_object(self.BUCKET, "dir/%02d.txt" % i, b"x")
+        self.server.put_object(self.BUCKET, "dir/sub/a.txt", b"x")
+
+    def list(self, manager, path="dir"):
+        return {m["name"]: m for m in manager.get(
+            self.path(path), type="directory")["content"]}
+
+    def test_fresh(self):
+        manager = self.create_manager(index_ttl=60)
+        listing = self.list(manager)
+        self.assertEqual(len(listing), 21)
+        self.assertEqual(listing["sub"]["type"], "directory")
+        self.server.reset_stats()
+        self.assertEqual(self.list(manager), listing)
+        self.assertNotIn("objects.list", self.server.operations)
+        self.assertEqual(manager.prefix_index.stats["hits"], 1)
+
+    def test_refresh(self):
+        manager = self.create_manager(index_ttl=0.05)
+        before = self.list(manager)
+        self.server.reset_stats()
+        self.list(self.create_manager())
+        full = self.server.bytes_sent
+        self.server.put_object(self.BUCKET, "dir/05.txt", b"changed")
+        self.server.put_object(self.BUCKET, "dir/new.txt", b"new")
+        del self.server.buckets[self.BUCKET].objects["dir/07.txt"]
+        time.sleep(0.06)
+        self.server.reset_stats()
+        listing = self.list(manager)
+        self.assertGreater(listing["05.txt"]["last_modified"],
+                           before["05.txt"]["last_modified"])
+        self.assertIn("new.txt", listing)
+        self.assertNotIn("07.txt", listing)
+        self.assertEqual(self.server.operations["objects.list"], 1)
+        # the changed objects are fetched in one batch
+        self.assertEqual(self.server.round_trips["batch"], 1)
+        self.assertLess(self.server.bytes_sent, full / 2)
+        stats = manager.prefix_index.stats
+        self.assertEqual((stats["refreshes"], stats["changed"]), (1, 2))
+
+    def test_writes(self):
+        manager = self.create_manager(index_ttl=60)
+        self.list(manager)
+        manager.save({"type": "file", "format": "text", "content": "new"},
+                     self.path("dir/sub/new/file.txt"))
+        self.assertIn("new", self.list(manager, "dir/sub"))
+        manager.delete_file(self.path("dir/00.txt"))
+        self.assertNotIn("00.txt", self.list(manager))
+
+    def test_notifications(self):
+        manager = self.create_manager(index_ttl=60)
+        self.list(manager)
+        self.list(manager, "dir/sub")
+        index = manager.prefix_index
+        obj = self.server.put_object(self.BUCKET, "dir/new.txt", b"new")
+        index.notify({"eventType": "OBJECT_FINALIZE", "bucketId": self.BUCKET,
+                      "objectId": "dir/new.txt"}, obj.resource())
+        index.notify({"eventType": "OBJECT_DELETE", "bucketId": self.BUCKET,
+                      "objectId": "dir/00.txt"})
+        obj = self.server.put_object(self.BUCKET, "dir/other/b.txt", b"b")
+        index.notify({"eventType": "OBJECT_FINALIZE", "bucketId": self.BUCKET,
+                      "objectId": "dir/other/b.txt"}, obj.resource())
+        self.server.reset_stats()
+        listing = self.list(manager)
+        self.assertEqual(listing["new.txt"]["type"], "file")
+        self.assertNotIn("00.txt", listing)
+        self.assertEqual(listing["other"]["type"], "directory")
+        self.assertNotIn("objects.list", self.server.operations)
+        self.assertEqual(index.stats["notifications"], 3)
+        # a delete in a subdirectory may empty it
+        index.notify({"eventType": "OBJECT_DELETE", "bucketId": self.BUCKET,
+                      "objectId": "dir/sub/a.txt"})
+        del self.server.buckets[self.BUCKET].objects["dir/sub/a.txt"]
+        self.assertNotIn("sub", self.list(manager))
+        self.assertEqual(self.server.operations["objects.list"], 1)
+
+    def test_persisted(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.list(self.create_manager(index_ttl=60, index_dir=directory))
+        self.server.reset_stats()
+        manager = self.create_manager(index_ttl=60, index_dir=directory)
+        self.assertEqual(len(self.list(manager)), 21)
+        self.assertNotIn("objects.list", self.server.operations)
+
+
+class UsageTest(FakeGCSTestCase):
+    def setUp(self):
+        super(UsageTest, self).setUp()
+        for name, size in (("top.txt", 1), ("dir/a.txt", 10),
+                           ("dir/sub/b.txt", 100), ("dir/sub/deep/c.txt", 1000),
+                           ("dir/other/d.txt", 10000), ("dir/sub/", 0)):
+            self.server.put_object(self.BUCKET, name, b"x" * size)
+
+    def usage(self, path, manager=None):
+        return (manager or self.contents_manager).usage(self.path(path))
+
+    def test_totals(self):
+        usage = self.usage("dir")
+        self.assertEqual(usage["path"], self.path("dir"))
+        self.assertEqual((usage["size"], usage["count"]), (11110, 5))
+        self.assertIsNotNone(usage["last_modified"])
+        self.assertEqual([(c["path"], c["size"], c["count"])
+                          for c in usage["children"]],
+                         [(self.path("dir/other"), 10000, 1),
+                          (self.path("dir/sub"), 1100, 3)])
+        usage = self.usage("")
+        self.assertEqual((usage["size"], usage["count"]), (11111, 6))
+        self.assertRaises(HTTPError, self.contents_manager.usage, "")
+        self.assertRaises(HTTPError, self.contents_manager.usage, "nope/dir")
+
+    def test_cached(self):
+        manager = self.create_manager()
+        total = self.usage("", manager)
+        self.server.reset_stats()
+        self.assertEqual(self.usage("", manager), total)
+        # the nested directories were summed on the way
+        usage = self.usage("dir/sub", manager)
+        self.assertEqual((usage["size"], usage["count"]), (1100, 3))
+        self.assertEqual(usage["children"][0]["size"], 1000)
+        self.assertNotIn("objects.list", self.server.operations)
+
+    def test_invalidated(self):
+        manager = self.create_manager()
+        self.usage("", manager)
+        manager.save({"type": "file", "format": "text", "content": "12345"},
+                     self.path("dir/sub/new.txt"))
+        self.server.reset_stats()
+        self.assertEqual(self.usage("dir", manager)["size"], 11115)
+        self.assertEqual(self.usage("", manager)["size"], 11116)
+        self.assertEqual(self.usage("dir/other", manager)["size"], 10000)
+        manager.delete_file(self.path("dir/other/d.txt"))
+        self.assertEqual(self.usage("", manager)["size"], 1116)
+        manager = self.create_manager(usage_cache_ttl=0)
+        self.usage("", manager)
+        self.server.reset_stats()
+        self.usage("", manager)
+        self.assertIn("objects.list", self.server.operations)
+
+    def test_least_recently_used(self):
+        cache = UsageCache(60, max_entries=2)
+        cache.put("b", "one/", EMPTY_ROLLUP, [])
+        cache.put("b", "two/", EMPTY_ROLLUP, [])
+        self.assertIsNotNone(cache.get("b", "one/"))
+        cache.put("b", "three/", EMPTY_ROLLUP, [])
+        self.assertIsNone(cache.get("b", "two/"))
+        self.assertIsNotNone(cache.get("b", "one/"))
+        self.assertIsNotNone(cache.get("b", "three/"))
+        # a refreshed rollup is not counted twice
+        cache.put("b", "three/", EMPTY_ROLLUP, [])
+        self.assertIsNotNone(cache.get("b", "one/"))
+
+
+class BulkTest(FakeGCSTestCase):
+    def setUp(self):
+        super(BulkTest, self).setUp()
+        for name in ("dir/a.txt", "dir/sub/c.txt", "dir/sub/d/e.txt",
+                     "dir/f.txt", "other/x.txt"):
+            self.server.put_object(self.BUCKET, name, b"x")
+        self.contents_manager.save(
+            {"type": "notebook", "content": new_notebook()},
+            self.path("dir/b.ipynb"))
+        self.assertEqual(len(self.contents_manager.list_checkpoints(
+            self.path("dir/b.ipynb"))), 1)
+
+    def names(self):
+        return sorted(self.server.buckets[self.BUCKET].objects)
+
+    def bulk(self, action, paths, destination=None):
+        results = self.contents_manager.bulk(
+            action, [self.path(p) for p in paths],
+            destination and self.path(destination))
+        self.assertEqual([r["path"] for r in results],
+                         [self.path(p).rstrip("/") for p in paths])
+        return [r["status"] for r in results], results
+
+    def test_delete(self):
+        self.server.reset_stats()
+        statuses, _ = self.bulk("delete", [
+            "dir/a.txt", "dir/sub", "dir/sub/c.txt", "dir/missing",
+            "dir/b.ipynb", "dir/a.txt"])
+        self.assertEqual(statuses, [200, 200, 200, 404, 200, 200])
+        self.assertEqual(self.names(), ["dir/f.txt", "other/x.txt"])
+        # the parent, the subdirectory and the checkpoints
+        self.assertEqual(self.server.operations["objects.list"], 3)
+        self.assertNotIn("objects.get", self.server.operations)
+        self.assertEqual(self.server.round_trips["batch"], 1)
+
+    def test_batches(self):
+        for i in range(150):
+            self.server.put_object(self.BUCKET, "many/%03d.txt" % i, b"")
+        self.server.reset_stats()
+        statuses, _ = self.bulk("delete", ["many/%03d.txt" % i
+                                           for i in range(150)])
+        self.assertEqual(statuses, [200] * 150)
+        self.assertFalse([n for n in self.names() if n.startswith("many/")])
+        self.assertEqual(self.server.operations["objects.list"], 1)
+        self.assertEqual(self.server.round_trips["batch"], 2)
+
+    def test_parallel_batches(self):
+        self.server.create_bucket("second")
+        for i in range(3):
+            self.server.put_object("second", "%d.txt" % i, b"")
+        batch = self.contents_manager._batch
+        # fails unless both batches are sent at once
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait_and_batch(calls):
+            calls = list(calls)
+            barrier.wait()
+            return batch(calls)
+
+        with mock.patch.object(self.contents_manager, "_batch",
+                               side_effect=wait_and_batch):
+            results = self.contents_manager.bulk("delete", [
+                self.path("dir/f.txt"), "second/0.txt", "second/1.txt"])
+        self.assertEqual([r["status"] for r in results], [200] * 3)
+        self.assertEqual(sorted(self.server.buckets["second"].objects),
+                         ["2.txt"])
+        self.assertNotIn("dir/f.txt", self.names())
+
+    def test_stored_outputs_to_other_bucket(self):
+        self.server.create_bucket("second")
+        # fewer threads than notebooks: the copies must not wait for the
+        # pool from inside it
+        manager = self.contents_manager = self.create_manager(
+            io_threads=2, output_blob_threshold=1000)
+        images = [base64.b64encode(os.urandom(5000)).decode()
+                  for _ in range(4)]
+        for i, image in enumerate(images):
+            manager.save({"type": "notebook", "content": new_notebook(
+                cells=[new_code_cell("plot()", outputs=[new_output(
+                    "display_data", data={"image/png": image})])])},
+                self.path("nbs/%d.ipynb" % i))
+        paths = ["nbs/%d.ipynb" % i for i in range(4)]
+        results = manager.bulk("copy", [self.path(p) for p in paths],
+                               "second/copied")
+        self.assertEqual([r["status"] for r in results], [200] * 4)
+        results = manager.bulk("move", [self.path(p) for p in paths],
+                               "second/moved")
+        self.assertEqual([r["status"] for r in results], [200] * 4)
+        self.assertFalse([n for n in self.names() if n.startswith("nbs/")])
+        for i, image in enumerate(images):
+            for folder in ("copied", "moved"):
+                nb = manager.get("second/%s/%d.ipynb" % (folder, i))
+                self.assertEqual(
+                    nb["content"].cells[0].outputs[0].data["image/png"], image)
+        self.assertEqual(len([n for n in self.server.buckets["second"].objects
+                              if n.startswith(".ipynb_outputs/")]), 4)
+
+    def test_move(self):
+        statuses, results = self.bulk(
+            "move", ["dir/a.txt", "dir/sub", "dir/sub/d", "dir/b.ipynb"],
+            "other")
+        self.assertEqual(statuses, [200] * 4)
+        self.assertEqual([r["new_path"] for r in results],
+                         [self.path("other/a.txt"), self.path("other/sub"),
+                          self.path("other/sub/d"),
+                          self.path("other/b.ipynb")])
+        self.assertEqual([n for n in self.names()
+                          if not n.startswith("other/.")],
+                         ["dir/f.txt", "other/a.txt", "other/b.ipynb",
+                          "other/sub/c.txt", "other/sub/d/e.txt",
+                          "other/x.txt"])
+        self.assertEqual(len(self.contents_manager.list_checkpoints(
+            self.path("other/b.ipynb"))), 1)
+        self.assertEqual(self.contents_manager.get(
+            self.path("other/b.ipynb"))["type"], "notebook")
+
+    def test_copy(self):
+        statuses, _ = self.bulk("copy", ["dir/sub", "dir/f.txt"], "other")
+        self.assertEqual(statuses, [200, 200])
+        self.assertIn("dir/sub/d/e.txt", self.names())
+        self.assertIn("other/sub/d/e.txt", self.names())
+        statuses, results = self.bulk("copy", ["dir/sub", "dir/a.txt"],
+                                      "other")
+        self.assertEqual(statuses, [409, 200])
+        self.assertIn("already exists", results[0]["message"])
+
+    def test_conflicts(self):
+        statuses, _ = self.bulk("move", ["dir/sub", "dir/a.txt"], "dir/sub/d")
+        self.assertEqual(statuses, [400, 200])
+        self.assertIn("dir/sub/d/a.txt", self.names())
+        statuses, _ = self.bulk("move", ["dir/f.txt", "other/x.txt"], "dir")
+        self.assertEqual(statuses, [409, 200])
+        statuses, _ = self.bulk("delete", [""])
+        self.assertEqual(statuses, [400])
+        manager = self.contents_manager
+        self.assertRaises(HTTPError, manager.bulk, "chmod", ["x"])
+        self.assertRaises(HTTPError, manager.bulk, "delete", [])
+        self.assertRaises(HTTPError, manager.bulk, "move", ["x"])
+        self.assertRaises(HTTPError, manager.bulk, "copy",
+                          [self.path("dir/a.txt")], "nope/dir")
+        manager.bulk_max_paths = 1
+        self.assertRaises(HTTPError, manager.bulk, "delete", ["a", "b"])
+
+
+class GenerationTest(FakeGCSTestCase):
+    def save(self, model, path, generation=None, manager=None):
+        if generation is not None:
+            model = dict(model, generation=generation)
+        return (manager or self.contents_manager).save(model, self.path(path))
+
+    def text(self, content):
+        return {"type": "file", "format": "text", "content": content}
+
+    def test_file(self):
+        first = self.save(self.text("a"), "file.txt")
+        self.assertTrue(first["generation"])
+        self.assertEqual(self.contents_manager.get(
+            self.path("file.txt"))["generation"], first["generation"])
+        self.server.reset_stats()
+        second = self.save(self.text("b"), "file.txt", first["generation"])
+        self.assertNotEqual(second["generation"], first["generation"])
+        # the upload itself checks the generation
+        self.assertEqual(self.server.rpc_count, 1)
+        with self.assertRaises(HTTPError) as e:
+            self.save(self.text("c"), "file.txt", first["generation"])
+        self.assertEqual(e.exception.status_code, 409)
+        self.assertEqual(self.server.buckets[self.BUCKET]
+                         .objects["file.txt"].data, b"b")
+        with self.assertRaises(HTTPError) as e:
+            self.save(self.text("c"), "file.txt", 0)
+        self.assertEqual(e.exception.status_code, 409)
+        self.save(self.text("new"), "new.txt", 0)
+        with self.assertRaises(HTTPError) as e:
+            self.save(self.text("c"), "file.txt", "x")
+        self.assertEqual(e.exception.status_code, 400)
+
+    def test_notebook(self):
+        model = {"type": "notebook", "content": new_notebook()}
+        first = self.save(model, "nb.ipynb")
+        second = self.save(model, "nb.ipynb", first["generation"])
+        with self.assertRaises(HTTPError) as e:
+            self.save(model, "nb.ipynb", first["generation"])
+        self.assertEqual(e.exception.status_code, 409)
+        manager = self.create_manager(segmented_save_threshold=1)
+        model = {"type": "notebook", "content": make_notebook(100)}
+        third = self.save(model, "nb.ipynb", second["generation"], manager)
+        with self.assertRaises(HTTPError) as e:
+            self.save(model, "nb.ipynb", second["generation"], manager)
+        self.assertEqual(e.exception.status_code, 409)
+        self.save(model, "nb.ipynb", third["generation"], manager)
+
+    def test_copy(self):
+        self.save(self.text("a"), "dir/file.txt")
+        self.save({"type": "notebook", "content": new_notebook()},
+                  "dir/nb.ipynb")
+        for name in ("file.txt", "nb.ipynb"):
+            # the generation of the source is not a precondition of the copy
+            copied = self.contents_manager.copy(self.path("dir/" + name))
+            self.assertEqual(copied["path"], self.path(
+                "dir/" + name.replace(".", "-Copy1.")))
+            copied = self.contents_manager.copy(self.path("dir/" + name),
+                                                self.path("dir/copy-" + name))
+            self.assertEqual(copied["path"], self.path("dir/copy-" + name))
+        self.assertEqual(self.contents_manager.get(
+            self.path("dir/copy-file.txt"))["content"], "a")
+        with self.assertRaises(HTTPError) as e:
+            self.contents_manager.copy(self.path("dir"))
+        self.assertEqual(e.exception.status_code, 400)
+
+    def test_write_behind(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        manager = self.create_manager(write_behind_dir=directory,
+                                      write_behind_delay=3600)
+        self.addCleanup(lambda: manager.write_journal.close())
+        first = self.save(self.text("a"), "file.txt", 0, manager)
+        self.assertIn("file.txt", self.server.buckets[self.BUCKET].objects)
+        # another client saves in the background
+        self.save(self.text("b"), "file.txt", manager=manager)
+        with self.assertRaises(HTTPError) as e:
+            self.save(self.text("c"), "file.txt", first["generation"],
+                      manager)
+        self.assertEqual(e.exception.status_code, 409)
+        self.assertEqual(self.server.buckets[self.BUCKET]
+                         .objects["file.txt"].data, b"b")
+
+
+class TraceTest(FakeGCSTestCase):
+    def setUp(self):
+        super(TraceTest, self).setUp()
+        for name in ("dir/a.txt", "dir/b.txt", "dir/sub/c.txt"):
+            self.server.put_object(self.BUCKET, name, b"abc")
+        self.logger = logging.getLogger("jgscm.tests.trace")
+
+    def traces(self, logs):
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_slow(self):
+        manager = self.create_manager(slow_request_threshold=0,
+                                      log=self.logger)
+        self.server.reset_stats()
+        with self.assertLogs(self.logger, "WARNING") as logs:
+            manager.get(self.path("dir"), type="directory")
+            manager.get(self.path("dir/a.txt"))
+        listing, file = self.traces(logs)
+        self.assertTrue(listing["slow_request"])
+        self.assertEqual((listing["operation"], listing["path"]),
+                         ("get", self.path("dir")))
+        self.assertEqual(listing["rpcs"] + file["rpcs"],
+                         self.server.rpc_count)
+        self.assertEqual(listing["by_rpc"]["objects.list"], 1)
+        call = [c for c in file["calls"] if c["rpc"] == "objects.download"][0]
+        self.assertEqual(call["target"], self.path("dir/a.txt"))
+        self.assertEqual(call["status"], 200)
+        self.assertEqual(call["received"], 3)
+        self.assertEqual(file["retries"], 0)
+
+    def test_created_once(self):
+        manager = self.create_manager()
+        created = []
+
+        def create(*args):
+            # widens the window between the check and the creation
+            time.sleep(0.05)
+            created.append(Tracer(*args))
+            return created[-1]
+
+        with mock.patch("jgscm.Tracer", side_effect=create):
+            threads = [threading.Thread(target=lambda: manager.tracer)
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(created, [manager.tracer])
+        self.assertEqual(len(manager.client._http.hooks["response"]), 1)
+
+    def test_worker_threads(self):
+        manager = self.create_manager(slow_request_threshold=0,
+                                      log=self.logger)
+        manager.get(self.path("dir"), type="directory")
+        self.server.reset_stats()
+        with self.assertLogs(self.logger, "WARNING") as logs:
+            manager.bulk("copy", [self.path("dir/a.txt"),
+                                  self.path("dir/b.txt"),
+                                  self.path("dir/sub")], self.path("other"))
+        trace, = self.traces(logs)
+        # the copies run in io_pool
+        self.assertEqual(trace["rpcs"], self.server.rpc_count)
+        self.assertEqual(trace["by_rpc"]["objects.copy"], 3)
+
+    def test_summary(self):
+        manager = self.create_manager(log=self.logger)
+        for _ in range(3):
+            manager.get(self.path("dir/a.txt"))
+        manager.save({"type": "file", "format": "text", "content": "x"},
+                     self.path("dir/new.txt"))
+        summary = manager.tracer.summary()
+        self.assertEqual(summary["get"]["requests"], 3)
+        self.assertEqual(summary["get"]["slow"], 0)
+        self.assertGreater(summary["get"]["by_rpc"]["objects.download"], 0)
+        self.assertEqual(summary["save"]["by_rpc"]["objects.upload"], 1)
+        self.assertEqual(summary["save"]["requests"], 1)
+        self.assertIsNone(self.create_manager(
+            slow_request_threshold=-1).tracer)
+
+    def test_describe_rpc(self):
+        for method, url, expected in (
+                ("GET", "/storage/v1/b", ("buckets.list", "")),
+                ("GET", "/storage/v1/b/x/o?prefix=a", ("objects.list", "x")),
+                ("GET", "/storage/v1/b/x/o/a%2Fb", ("objects.get", "x/a/b")),
+                ("GET", "/download/storage/v1/b/x/o/a?alt=media",
+                 ("objects.download", "x/a")),
+                ("POST", "/upload/storage/v1/b/x/o?uploadType=multipart",
+                 ("objects.upload", "x")),
+                ("POST", "/storage/v1/b/x/o/a/compose",
+                 ("objects.compose", "x/a")),
+                ("POST", "/storage/v1/b/x/o/a/rewriteTo/b/y/o/b",
+                 ("objects.rewrite", "x/a")),
+                ("DELETE", "/storage/v1/b/x/o/a", ("objects.delete", "x/a")),
+                ("POST", "/batch/storage/v1", ("batch", ""))):
+            self.assertEqual(describe_rpc(method, "https://gcs" + url),
+                             expected)
+
+
+if __name__ == "__main__":
+    main()
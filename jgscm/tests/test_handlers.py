@@ -0,0 +1,273 @@
+import json
+from unittest import main, mock
+
+from jinja2 import DictLoader, Environment
+import nbformat
+from nbformat.v4 import new_code_cell, new_notebook, new_output
+from notebook.base.handlers import IPythonHandler
+from tornado.httpclient import HTTPClientError
+from tornado.testing import AsyncHTTPTestCase, ExpectLog
+from tornado.web import Application
+
+from jgscm import GoogleStorageContentManager
+from jgscm.handlers import default_handlers
+from jgscm.tests.fakegcs import FakeGCS
+
+
+class HandlersTestCase(AsyncHTTPTestCase):
+    BUCKET = "test"
+
+    def get_app(self):
+        self.server = FakeGCS()
+        self.server.create_bucket(self.BUCKET)
+        self.contents_manager = GoogleStorageContentManager()
+        self.contents_manager._client = self.server.client()
+        return Application(
+            default_handlers, contents_manager=self.contents_manager,
+            base_url="/", disable_check_xsrf=True, allow_remote_access=True,
+            log_function=lambda handler: None,
+            jinja2_env=Environment(loader=DictLoader({
+                "error.html": "{{status_code}} {{message}}"})))
+
+    def url(self, prefix, sub, **query):
+        url = "%s/%s/%s" % (prefix, self.BUCKET, sub)
+        if query:
+            url += "?" + "&".join("%s=%s" % p for p in sorted(query.items()))
+        return url
+
+    def assert_json_error(self, response, code):
+        self.assertEqual(response.code, code)
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        self.assertIn("message", json.loads(response.body.decode("utf-8")))
+
+    def assert_refused(self, url, method="GET", body=None):
+        """
+        Checks that the anonymous requests are refused instead of redirected
+        to the login page.
+        """
+        with mock.patch.object(IPythonHandler, "get_current_user",
+                               return_value=None):
+            response = self.fetch(url, method=method, body=body,
+                                  follow_redirects=False)
+        self.assertEqual(response.code, 403)
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+
+
+class RangeHandlerTest(HandlersTestCase):
+    def test_lines(self):
+        self.server.put_object(self.BUCKET, "log.txt", b"a\nb\nc\n")
+        response = self.fetch(self.url("/api/gcs/range", "log.txt", start=2,
+                                       lines=1))
+        self.assertEqual(response.code, 200)
+        model = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(model["content"], "b\n")
+        self.assertEqual(model["range"], {"start": 2, "end": 4, "size": 6})
+
+    def test_errors(self):
+        self.server.put_object(self.BUCKET, "log.txt", b"a\nb\nc\n")
+        response = self.fetch(self.url("/api/gcs/range", "log.txt",
+                                       start="x"))
+        self.assertEqual(response.code, 400)
+        response = self.fetch(self.url("/api/gcs/range", "missing.txt",
+                                       start=0))
+        self.assertEqual(response.code, 404)
+
+    def test_read_only(self):
+        self.server.put_object(self.BUCKET, "log.txt", b"a\n")
+        for method, body in (("PUT", "{}"), ("PATCH", "{}"), ("POST", "{}"),
+                             ("DELETE", None)):
+            response = self.fetch(self.url("/api/gcs/range", "log.txt"),
+                                  method=method, body=body,
+                                  allow_nonstandard_methods=True)
+            self.assertEqual(response.code, 405, method)
+        self.assertIn("log.txt", self.server.buckets[self.BUCKET].objects)
+
+
+class SearchHandlerTest(HandlersTestCase):
+    def test_search(self):
+        for name in ("a/x.ipynb", "a/b/x.txt", "a/y.txt"):
+            self.server.put_object(self.BUCKET, name, b"{}")
+        response = self.fetch(self.url("/api/gcs/search", "a", q="x."))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"],
+                         "application/x-ndjson")
+        lines = [json.loads(line) for line in
+                 response.body.decode("utf-8").splitlines()]
+        self.assertEqual([m["path"] for m in lines[:-1]],
+                         ["test/a/b/x.txt", "test/a/x.ipynb"])
+        self.assertEqual(lines[0]["type"], "file")
+        self.assertEqual(lines[1]["type"], "notebook")
+        self.assertEqual(lines[-1], {"scanned": 2, "truncated": False})
+        self.assertEqual(self.fetch(self.url("/api/gcs/search", "a")).code,
+                         400)
+        self.assert_json_error(self.fetch("/api/gcs/search/nope?q=x"), 404)
+        self.assert_refused(self.url("/api/gcs/search", "a", q="x."))
+
+
+class UsageHandlerTest(HandlersTestCase):
+    def test_usage(self):
+        for name in ("a/x.txt", "a/b/y.txt", "a/b/z.txt"):
+            self.server.put_object(self.BUCKET, name, b"12345")
+        response = self.fetch(self.url("/api/gcs/usage", "a"))
+        self.assertEqual(response.code, 200)
+        usage = json.loads(response.body.decode("utf-8"))
+        self.assertEqual((usage["size"], usage["count"]), (15, 3))
+        self.assertEqual([(c["path"], c["size"]) for c in usage["children"]],
+                         [("test/a/b", 10)])
+        self.assert_json_error(self.fetch("/api/gcs/usage/nope"), 404)
+        self.assert_refused(self.url("/api/gcs/usage", "a"))
+
+
+class BulkHandlerTest(HandlersTestCase):
+    def test_bulk(self):
+        for name in ("a/x.txt", "a/b/y.txt"):
+            self.server.put_object(self.BUCKET, name, b"12345")
+        response = self.fetch("/api/gcs/bulk", method="POST", body=json.dumps(
+            {"action": "move", "paths": ["test/a/x.txt", "test/a/b"],
+             "destination": "test/c"}))
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body.decode("utf-8"))["results"]
+        self.assertEqual(results, [
+            {"path": "test/a/x.txt", "status": 200, "new_path": "test/c/x.txt"},
+            {"path": "test/a/b", "status": 200, "new_path": "test/c/b"}])
+        self.assertEqual(sorted(self.server.buckets[self.BUCKET].objects),
+                         ["c/b/y.txt", "c/x.txt"])
+        for body in ("{", '{"action": "delete"}',
+                     '{"action": "nope", "paths": ["test/c"]}'):
+            response = self.fetch("/api/gcs/bulk", method="POST", body=body)
+            self.assert_json_error(response, 400)
+        self.assert_refused("/api/gcs/bulk", method="POST", body=json.dumps(
+            {"action": "delete", "paths": ["test/c/x.txt"]}))
+        self.assertIn("c/x.txt", self.server.buckets[self.BUCKET].objects)
+
+
+class TraceHandlerTest(HandlersTestCase):
+    def test_summary(self):
+        self.server.put_object(self.BUCKET, "a.txt", b"12345")
+        self.fetch(self.url("/api/gcs/range", "a.txt", start=0))
+        response = self.fetch("/api/gcs/trace")
+        self.assertEqual(response.code, 200)
+        summary = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(summary["get"]["requests"], 1)
+        self.assertIn("objects.download", summary["get"]["by_rpc"])
+        self.assert_refused("/api/gcs/trace")
+        self.contents_manager._tracer = None
+        self.contents_manager.slow_request_threshold = -1
+        self.assert_json_error(self.fetch("/api/gcs/trace"), 404)
+
+
+class StreamingFilesHandlerTest(HandlersTestCase):
+    def setUp(self):
+        super(StreamingFilesHandlerTest, self).setUp()
+        self.data = bytes(range(256)) * 1000
+        self.server.put_object(self.BUCKET, "blob.bin", self.data,
+                               "application/octet-stream")
+        self.contents_manager.stream_chunk_size = 10000
+
+    def test_stream(self):
+        self.server.reset_stats()
+        response = self.fetch(self.url("/gcs/files", "blob.bin"))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(response.headers["Content-Length"],
+                         str(len(self.data)))
+        self.assertEqual(response.headers["Content-Type"],
+                         "application/octet-stream")
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+        self.assertTrue(response.headers["ETag"])
+        self.assertEqual(self.server.operations["objects.download"], 26)
+        response = self.fetch(self.url("/gcs/files", "blob.bin",
+                                       download=1))
+        self.assertIn("attachment",
+                      response.headers["Content-Disposition"])
+
+    def test_content_type(self):
+        self.server.put_object(self.BUCKET, "data.csv", b"a,b\n",
+                               "application/octet-stream")
+        self.server.put_object(self.BUCKET, "log.txt", b"log\n",
+                               "text/plain")
+        response = self.fetch(self.url("/gcs/files", "data.csv"))
+        self.assertEqual(response.headers["Content-Type"], "text/csv")
+        response = self.fetch(self.url("/gcs/files", "log.txt"))
+        self.assertEqual(response.headers["Content-Type"],
+                         "text/plain; charset=UTF-8")
+
+    def test_range(self):
+        for header, start, end in (("bytes=10-19", 10, 20),
+                                   ("bytes=255990-", 255990, 256000),
+                                   ("bytes=-5", 255995, 256000),
+                                   ("bytes=100-999999", 100, 256000)):
+            response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                                  headers={"Range": header})
+            self.assertEqual(response.code, 206, header)
+            self.assertEqual(response.body, self.data[start:end], header)
+            self.assertEqual(response.headers["Content-Range"],
+                             "bytes %d-%d/%d" % (start, end - 1,
+                                                 len(self.data)))
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              headers={"Range": "bytes=300000-"})
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */256000")
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              headers={"Range": "bytes=0-1,5-6"})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(response.body), len(self.data))
+
+    def test_not_modified(self):
+        etag = self.fetch(self.url("/gcs/files", "blob.bin"),
+                          method="HEAD").headers["ETag"]
+        self.server.reset_stats()
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              headers={"If-None-Match": "W/" + etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b"")
+        self.assertNotIn("objects.download", self.server.operations)
+        self.server.put_object(self.BUCKET, "blob.bin", b"new")
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"new")
+
+    def test_stored_outputs(self):
+        self.contents_manager.output_blob_threshold = 1000
+        nb = new_notebook(cells=[new_code_cell("x", outputs=[new_output(
+            "stream", text="x" * 5000)])])
+        self.contents_manager.save({"type": "notebook", "content": nb},
+                                   self.BUCKET + "/nb.ipynb")
+        response = self.fetch(self.url("/gcs/files", "nb.ipynb"))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(nbformat.reads(response.body.decode(), 4), nb)
+        response = self.fetch(self.url("/gcs/files", "nb.ipynb"),
+                              headers={"Range": "bytes=-10"})
+        self.assertEqual(response.code, 206)
+        self.assertIn("/%d" % len(nbformat.writes(nb)),
+                      response.headers["Content-Range"])
+
+    def test_head_and_missing(self):
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              method="HEAD")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Length"],
+                         str(len(self.data)))
+        self.assertEqual(response.body, b"")
+        self.assertEqual(self.fetch(self.url("/gcs/files", "nope")).code, 404)
+        self.assertEqual(self.fetch(self.url("/gcs/files", "")).code, 404)
+
+    def test_corrupted(self):
+        self.server.corrupt["objects.download"] = 1
+        # the headers are sent, the connection is closed before the last
+        # chunk instead
+        with ExpectLog("tornado.general", ".*corrupted in transit"), \
+                ExpectLog("tornado.application", ".*", required=False):
+            self.assertRaises(HTTPClientError, self.fetch,
+                              self.url("/gcs/files", "blob.bin"))
+        # ranges cannot be verified against the object checksum
+        self.server.corrupt["objects.download"] = 1
+        response = self.fetch(self.url("/gcs/files", "blob.bin"),
+                              headers={"Range": "bytes=0-9"})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(len(response.body), 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+from unittest import main, TestCase
+
+from jgscm.tests import loadtest
+
+
+class LoadTestTest(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.95), 95)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile([7], 0.99), 7)
+
+    def test_run(self):
+        test = loadtest.LoadTest(users=3, duration=1.0, notebook_size=4096,
+                                 notebooks=2, files=3)
+        report = test.run()
+        self.assertEqual(set(report), set(loadtest.DEFAULT_MIX) | {"ping"})
+        for op, stats in report.items():
+            self.assertGreater(stats.count, 0, op)
+            self.assertEqual(stats.errors, 0, op)
+            self.assertLessEqual(stats.p50, stats.p99)
+        self.assertGreater(test.throughput, 0)
+        self.assertGreater(test.gcs.rpc_count, 0)
+
+
+if __name__ == "__main__":
+    main()
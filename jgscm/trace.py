@@ -0,0 +1,239 @@
+"""
+Per-request traces of the GCS calls. Every HTTP round trip to GCS made while
+serving a contents request, including the ones made by the worker threads,
+is recorded with its size and duration. The requests slower than the
+threshold are logged as one JSON line with all their calls, and the totals
+by request type are kept to spot the request types which make too many calls.
+"""
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import json
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+RpcRecord = namedtuple("RpcRecord", ("rpc", "target", "status", "duration",
+                                     "sent", "received", "retry"))
+
+_VERBS = {"GET": "get", "POST": "insert", "PUT": "update", "PATCH": "patch",
+          "DELETE": "delete"}
+
+# the trace of the request which is being served
+_current = contextvars.ContextVar("jgscm_trace", default=None)
+
+
+def describe_rpc(method, url):
+    """
+    :param method: HTTP method.
+    :param url: GCS JSON API URL.
+    :return: tuple(call name such as "objects.list", "bucket/name" or \
+             "bucket" it applies to).
+    """
+    parts = urlsplit(url)
+    # the names are quoted, "/" inside them is %2F
+    segments = parts.path.split("/")
+    if "batch" in segments:
+        return "batch", ""
+    if "b" not in segments:
+        return method.lower(), parts.path
+    upload = "upload" in segments
+    # bucket, "o", object name, e.g. "compose"
+    segments = segments[segments.index("b") + 1:]
+    names = [unquote(s) for s in segments[:1] + segments[2:3]]
+    if upload:
+        names += parse_qs(parts.query).get("name", [])[:1]
+        return "objects.upload", "/".join(names)
+    target = "/".join(names)
+    verb = _VERBS.get(method, method.lower())
+    if len(segments) <= 1:
+        if not segments and verb == "get":
+            verb = "list"
+        return "buckets." + verb, target
+    if len(segments) == 2:
+        return "objects." + ("list" if verb == "get" else verb), target
+    if len(segments) > 3:
+        # copyTo, rewriteTo, compose
+        return "objects." + segments[3].replace("To", ""), target
+    if verb == "get" and "alt=media" in parts.query:
+        verb = "download"
+    return "objects." + verb, target
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor which runs the tasks in the context of the submitter,
+    so that the calls made by the worker threads are traced too.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super(ContextExecutor, self).submit(
+            contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class RequestTrace(object):
+    """
+    The GCS calls of one request.
+    """
+
+    def __init__(self, operation, path):
+        """
+        :param operation: contents manager method, e.g. "get".
+        :param path: requested path.
+        """
+        self.operation = operation
+        self.path = path
+        self.start = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, method, url, status, duration, sent, received):
+        """
+        Records a GCS call. A call is a retry if the same call has failed.
+        """
+        rpc, target = describe_rpc(method, url)
+        with self._lock:
+            retry = any(r.rpc == rpc and r.target == target and
+                        (r.status >= 500 or r.status == 429)
+                        for r in self.records)
+            self.records.append(RpcRecord(rpc, target, status, duration,
+                                          sent, received, retry))
+
+    def to_json(self, duration, max_records):
+        """
+        :param duration: number of seconds the request took.
+        :param max_records: maximum number of the calls to include.
+        :return: JSON serializable dict.
+        """
+        records = self.records
+        return {
+            "operation": self.operation,
+            "path": self.path,
+            "duration": round(duration, 6),
+            "rpcs": len(records),
+            "retries": sum(r.retry for r in records),
+            "bytes_sent": sum(r.sent for r in records),
+            "bytes_received": sum(r.received for r in records),
+            "by_rpc": dict(Counter(r.rpc for r in records)),
+            "calls": [dict(r._asdict(), duration=round(r.duration, 6))
+                      for r in records[:max_records]],
+            "truncated": max(len(records) - max_records, 0),
+        }
+
+
+class Tracer(object):
+    """
+    Traces the requests, logs the slow ones and keeps the totals by the
+    request type.
+    """
+
+    # the calls of a slow request listed in the log line
+    MAX_LOGGED_CALLS = 100
+
+    def __init__(self, threshold, log):
+        """
+        :param threshold: number of seconds after which a request is slow.
+        :param log: :class:`logging.Logger` instance.
+        """
+        self.threshold = threshold
+        self.log = log
+        self._lock = threading.Lock()
+        # operation -> Counter with "requests", "slow", "rpcs", "retries",
+        # "bytes_sent", "bytes_received", "seconds", "max_rpcs" and the number
+        # of the calls by name
+        self._summary = {}
+
+    @staticmethod
+    def current():
+        """
+        :return: :class:`RequestTrace` of the request being served or None.
+        """
+        return _current.get()
+
+    def attach(self, session):
+        """
+        Records the responses of the HTTP session.
+        :param session: :class:`requests.Session` of the GCS client.
+        """
+        if self.on_response not in session.hooks["response"]:
+            session.hooks["response"].append(self.on_response)
+
+    def on_response(self, response, *args, **kwargs):
+        """
+        requests response hook.
+        """
+        trace = _current.get()
+        if trace is None:
+            return
+        request = response.request
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        try:
+            received = int(response.headers.get("Content-Length", 0))
+        except ValueError:
+            received = 0
+        trace.add(request.method, request.url, response.status_code,
+                  response.elapsed.total_seconds(), sent, received)
+
+    def run(self, operation, path, fn, args, kwargs):
+        """
+        Calls fn under a new trace unless a trace is already active.
+        :param operation: the request type.
+        :param path: requested path.
+        :param fn: callable.
+        :param args: tuple of the positional arguments of fn.
+        :param kwargs: dict of the keyword arguments of fn.
+        :return: fn(*args, **kwargs).
+        """
+        if _current.get() is not None:
+            return fn(*args, **kwargs)
+        trace = RequestTrace(operation, path)
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            self._finish(trace, time.time() - trace.start)
+
+    def _finish(self, trace, duration):
+        records = list(trace.records)
+        slow = duration >= self.threshold
+        with self._lock:
+            totals = self._summary.setdefault(trace.operation, Counter())
+            totals["requests"] += 1
+            totals["slow"] += slow
+            totals["rpcs"] += len(records)
+            totals["max_rpcs"] = max(totals["max_rpcs"], len(records))
+            totals["seconds"] += duration
+            for r in records:
+                totals["retries"] += r.retry
+                totals["bytes_sent"] += r.sent
+                totals["bytes_received"] += r.received
+                totals["rpc:" + r.rpc] += 1
+        if slow:
+            self.log.warning(json.dumps(
+                dict(trace.to_json(duration, self.MAX_LOGGED_CALLS),
+                     slow_request=True), default=str))
+
+    def summary(self):
+        """
+        :return: dict from the request type to dict with "requests", \
+                 "slow", "rpcs", "rpcs_per_request", "max_rpcs", "retries", \
+                 "bytes_sent", "bytes_received", "seconds" and "by_rpc" - \
+                 the number of the calls by name.
+        """
+        with self._lock:
+            summary = {op: Counter(totals)
+                       for op, totals in self._summary.items()}
+        result = {}
+        for op, totals in summary.items():
+            model = {key: totals[key] for key in (
+                "requests", "slow", "rpcs", "max_rpcs", "retries",
+                "bytes_sent", "bytes_received")}
+            model["seconds"] = round(totals["seconds"], 6)
+            model["rpcs_per_request"] = totals["rpcs"] / totals["requests"]
+            model["by_rpc"] = {key[4:]: value for key, value in totals.items()
+                               if key.startswith("rpc:")}
+            result[op] = model
+        return result
@@ -0,0 +1,95 @@
+"""
+Storage usage of the directories: the total size, the number of objects and
+the newest modification time under a prefix. The rollups of the directories
+are cached, so asking again about a big tree, or about any directory in it,
+does not list it again.
+"""
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+
+class Rollup(namedtuple("Rollup", ("size", "count", "last_modified"))):
+    """
+    Usage of a set of objects. last_modified is a datetime or None.
+    """
+    __slots__ = ()
+
+    def add(self, other):
+        """
+        :param other: :class:`Rollup` of other objects.
+        :return: :class:`Rollup` of both.
+        """
+        last_modified = self.last_modified
+        if last_modified is None or other.last_modified is not None and \
+                other.last_modified > last_modified:
+            last_modified = other.last_modified
+        return Rollup(self.size + other.size, self.count + other.count,
+                      last_modified)
+
+
+EMPTY = Rollup(0, 0, None)
+
+
+class UsageCache(object):
+    """
+    The rollups of the directories by bucket name and prefix. The least
+    recently used rollups are dropped first.
+    """
+
+    def __init__(self, ttl, max_entries=65536):
+        """
+        :param ttl: number of seconds to keep a rollup.
+        :param max_entries: maximum number of the kept rollups.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # tuple(bucket name, prefix) -> tuple(expiration time,
+        #                                     tuple(Rollup, folders)),
+        # from the least recently used
+        self._entries = OrderedDict()
+
+    def get(self, bucket, prefix):
+        """
+        :param bucket: bucket name.
+        :param prefix: directory blob name prefix.
+        :return: tuple(:class:`Rollup`, sorted list of the subdirectory \
+                 prefixes) or None.
+        """
+        with self._lock:
+            entry = self._entries.get((bucket, prefix))
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[(bucket, prefix)]
+                return None
+            self._entries.move_to_end((bucket, prefix))
+            return entry[1]
+
+    def put(self, bucket, prefix, rollup, folders):
+        """
+        :param bucket: bucket name.
+        :param prefix: directory blob name prefix.
+        :param rollup: :class:`Rollup` of everything under the prefix.
+        :param folders: sorted list of the subdirectory prefixes.
+        """
+        key = (bucket, prefix)
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (time.time() + self.ttl, (rollup, folders))
+
+    def invalidate(self, bucket, name):
+        """
+        Drops the rollups which include the changed blob: the ones of its
+        ancestors and, if it is a directory, of its descendants.
+        :param bucket: bucket name.
+        :param name: changed blob name or prefix.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == bucket and (name.startswith(key[1]) or
+                                         key[1].startswith(name)):
+                    del self._entries[key]
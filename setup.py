@@ -13,9 +13,11 @@ setup(
     packages=["jgscm"],
     keywords=["jupyter", "ipython", "gcloud", "gcs"],
     install_requires=["google-api-python-client>=1.7",
-                      "google-cloud-storage>=1.14",
+                      "google-cloud-storage>=1.31",
                       "notebook>=5.7", "nbformat>=4.4",
-                      "tornado>=6.0", "traitlets>=4.3"],
+                      "tornado>=6.0", "traitlets>=4.3",
+                      "contextvars>=2.4; python_version<'3.7'"],
+    extras_require={"fast": ["orjson>=3.0"]},
     package_data={"": ["requirements.txt", "LICENSE", "README.md"]},
     classifiers=[
         "Development Status :: 3 - Alpha",